@@ -0,0 +1,273 @@
+import argparse
+import os
+import tempfile
+import time
+
+from bencode3 import bencode
+
+from metacache import MetainfoCache
+from message import Message, MessageParser, MessageType, PieceMessage, block_message
+from ratelimit import RateLimits
+from torrent import Torrent
+
+"""Micro-benchmarks for DripDrop's hot paths.
+
+Run from the root directory:
+
+    python3 benchmarks.py metainfo
+"""
+
+
+def write_synthetic_torrent(path, num_pieces, piece_length=2 ** 18):
+    """Write a single file .torrent with num_pieces made up piece hashes."""
+    metadict = {
+        'announce': 'http://127.0.0.1:8000/announce',
+        'info': {
+            'name': 'synthetic.bin',
+            'length': num_pieces * piece_length,
+            'piece length': piece_length,
+            'pieces': os.urandom(num_pieces * 20),
+        }
+    }
+    with open(path, 'wb') as tor_file:
+        tor_file.write(bencode(metadict))
+
+
+def bench_metainfo(piece_counts=(1000, 10000, 100000, 1000000), repeat=3):
+    """Time how long Torrent takes to load synthetic torrents of
+    increasing size."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for num_pieces in piece_counts:
+            path = os.path.join(directory, '{}.torrent'.format(num_pieces))
+            write_synthetic_torrent(path, num_pieces)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                torrent = Torrent(path)
+                torrent.piece_hashes[num_pieces - 1]
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results.append((num_pieces, os.path.getsize(path), best))
+            print('metainfo | pieces: {:>8} | size: {:>10} bytes | load: {:8.2f} ms'.format(
+                num_pieces, os.path.getsize(path), best * 1000))
+    return results
+
+
+def bench_metacache(num_pieces=1000000, repeat=3):
+    """Compare loading a large torrent by parsing against loading it from
+    the metainfo cache."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'large.torrent')
+        write_synthetic_torrent(path, num_pieces)
+        cache = MetainfoCache(os.path.join(directory, 'cache'))
+        Torrent(path, cache)
+        timings = {}
+        for label, use_cache in (('parse', None), ('cached', cache)):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                Torrent(path, use_cache)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[label] = best
+            print('metacache | pieces: {:>8} | {:>6}: {:8.2f} ms'.format(num_pieces, label, best * 1000))
+    return timings
+
+
+def bench_ratelimit(calls=200000, chunk=2 ** 16):
+    """Measure the cost of charging a network read to a global -> torrent
+    -> peer chain of token buckets."""
+    limits = RateLimits(download_rate=10 ** 12).child(10 ** 12).child(10 ** 12)
+    bucket = limits.download
+    start = time.perf_counter()
+    for _ in range(calls):
+        bucket.consume(chunk)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / calls
+    # At this chunk size, how much data could be metered per second of CPU.
+    gbps = chunk * 8 / per_call / 10 ** 9
+    print('ratelimit | {:.2f} us per consume | {:.0f} Gbit/s metered per CPU second'.format(per_call * 10 ** 6, gbps))
+    return per_call
+
+
+def bench_serialize(count=100000):
+    """Compare building outgoing messages as one bytestring against
+    building them as chunks for writeSequence."""
+    block = os.urandom(2 ** 14)
+    messages = {
+        'request': [block_message(MessageType.REQUEST, i, 0, 2 ** 14) for i in range(count)],
+        'piece': [PieceMessage.from_block(i, 0, block) for i in range(count // 10)],
+    }
+    results = {}
+    for label, batch in messages.items():
+        for method in ('to_bytes', 'to_chunks'):
+            start = time.perf_counter()
+            for message in batch:
+                getattr(message, method)()
+            elapsed = time.perf_counter() - start
+            results[(label, method)] = elapsed / len(batch)
+            print('serialize | {:>7} | {:>9}: {:.2f} us per message'.format(
+                label, method, elapsed / len(batch) * 10 ** 6))
+    return results
+
+
+def bench_dispatch(rounds=20000):
+    """Parse a stream of typical download traffic and dispatch each message
+    to its Peer handler. Reports messages per second."""
+    from types import SimpleNamespace
+    from peer import Peer
+
+    torrent = SimpleNamespace(info_hash=b'\x00' * 20, num_pieces=64)
+    peer = Peer('-DD0001-000000000000', '127.0.0.1', 6881, torrent)
+    handlers = peer._handlers
+    block = os.urandom(2 ** 14)
+    traffic = [
+        Message.factory(MessageType.UNCHOKE),
+        Message(MessageType.HAVE, (3).to_bytes(4, 'big')),
+        block_message(MessageType.REQUEST, 1, 0, 2 ** 14),
+        PieceMessage.from_block(1, 0, block),
+        Message.factory(MessageType.KEEP_ALIVE),
+    ]
+    stream = b''.join(message.to_bytes() for message in traffic)
+    parser = MessageParser()
+
+    count = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in parser(stream):
+            handlers[message.type](message.payload)
+            count += 1
+    elapsed = time.perf_counter() - start
+    print('dispatch | {:.0f} messages per second ({} messages)'.format(count / elapsed, count))
+    return count / elapsed
+
+
+def bench_metrics(blocks=200000):
+    """Measure what the metrics cost per downloaded 16 KiB block: a peer
+    meter feeding the client meter, and a request RTT observation."""
+    from metrics import ClientMetrics, RateMeter
+
+    client_metrics = ClientMetrics()
+    peer_meter = RateMeter(parent=client_metrics.download)
+    start = time.perf_counter()
+    for _ in range(blocks):
+        peer_meter.add(2 ** 14 + 13)
+        client_metrics.request_rtt.observe(0.05)
+    elapsed = time.perf_counter() - start
+    per_block = elapsed / blocks
+    # Share of one CPU spent on metrics when downloading at 1 Gbit/s.
+    blocks_per_second = 10 ** 9 / 8 / 2 ** 14
+    print('metrics | {:.2f} us per block | {:.2%} of a CPU at 1 Gbit/s'.format(
+        per_block * 10 ** 6, per_block * blocks_per_second))
+    return per_block
+
+
+def bench_profiling(rounds=200000):
+    """Measure what the profiling hooks add to parsing a small message,
+    while disabled, enabled, and enabled timing one call in 16."""
+    from profiling import PROFILER
+
+    stream = block_message(MessageType.REQUEST, 1, 0, 2 ** 14).to_bytes()
+    parser = MessageParser()
+    results = {}
+    for label, enabled, sample_every in (('disabled', False, 1), ('enabled', True, 1), ('sampled', True, 16)):
+        PROFILER.enabled = enabled
+        PROFILER.sample_every = sample_every
+        start = time.perf_counter()
+        for _ in range(rounds):
+            # The parser is a generator, so nothing is parsed until it is consumed.
+            for _ in parser(stream):
+                pass
+        elapsed = time.perf_counter() - start
+        results[label] = elapsed / rounds
+        print('profiling | {:>8}: {:.2f} us per parse'.format(label, elapsed / rounds * 10 ** 6))
+    PROFILER.disable()
+    PROFILER.reset()
+    return results
+
+
+def bench_storage(size=256 * 2 ** 20, piece_length=2 ** 18):
+    """Write a file's pieces in random order, one write per piece against
+    writing through the Storage write cache. Reports MB/s and write calls."""
+    import random
+    from storage import Storage
+
+    num_pieces = size // piece_length
+    piece = os.urandom(piece_length)
+    order = list(range(num_pieces))
+    random.Random(0).shuffle(order)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'target.bin')
+        start = time.perf_counter()
+        with open(path, 'wb') as target_file:
+            target_file.truncate(size)
+            for index in order:
+                target_file.seek(index * piece_length)
+                target_file.write(piece)
+        results['per_piece'] = (time.perf_counter() - start, num_pieces)
+        os.remove(path)
+
+        start = time.perf_counter()
+        storage = Storage(path, size, piece_length)
+        for index in order:
+            storage.write_piece(index, piece)
+        storage.close()
+        results['storage'] = (time.perf_counter() - start, storage.writes)
+
+    for label, (elapsed, writes) in results.items():
+        print('storage | {:>9}: {:.0f} MB/s | {} writes'.format(label, size / elapsed / 2 ** 20, writes))
+    return results
+
+
+def bench_swarm(size=64 * 2 ** 20):
+    """Download a file from an in-process simulated swarm (see simulate.py)
+    under a few network conditions."""
+    from twisted.internet import reactor
+    from simulate import Swarm, run_download, format_result
+
+    data = os.urandom(size)
+    scenarios = (
+        ('loopback', {}),
+        ('latency', {'latency': 0.02}),
+        ('churn', {'latency': 0.01, 'churn': 0.5}),
+        ('corrupt', {'corrupt': 0.01}),
+    )
+    results = {}
+    try:
+        for label, options in scenarios:
+            results[label] = run_download(Swarm(data, seeders=8, **options))
+            print('swarm | {:>8} | {}'.format(label, format_result(results[label])))
+    finally:
+        reactor.callFromThread(reactor.stop)
+    return results
+
+
+BENCHMARKS = {
+    'dispatch': bench_dispatch,
+    'metacache': bench_metacache,
+    'metainfo': bench_metainfo,
+    'metrics': bench_metrics,
+    'profiling': bench_profiling,
+    'ratelimit': bench_ratelimit,
+    'serialize': bench_serialize,
+    'storage': bench_storage,
+    'swarm': bench_swarm,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run DripDrop micro-benchmarks.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all): {}'.format(
+        ', '.join(sorted(BENCHMARKS))))
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: {}'.format(', '.join(sorted(unknown))))
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,22 @@
+import os
+import time
+from struct import pack, unpack
+from threading import RLock
+
 from twisted.internet import reactor
 
-from tracker import Tracker, TrackerEvent
+from tracker import Tracker, TrackerEvent, TrackerError
 from torrent import Torrent
-from message import MessageType, Message
-from piece import piece_factory
-from peer import Peer, PeerError, PeerConnectionError
+from message import MessageType, Message, PieceMessage, block_message, parse_hash_message
+from piece import piece_factory, merkle_piece_factory, MerklePiece, PieceError, PieceHashError, BlockHashError
+from peer import Peer, PeerError, PeerConnectionError, allowed_fast_set
+from ratelimit import RateLimits
+from timerwheel import TimerWheel
+from metrics import ClientMetrics
+from tracelog import TraceWriter
+from profiling import PROFILER
+from storage import Storage, StorageError, ReadCache
+from memory import MemoryBudget
 import constants
 
 """Represent a client to connect to the BitTorrent swarm"""
@@ -17,30 +29,175 @@ class ClientError(Exception):
 class Client:
     """Represents a client connected to a single tracker for
     a single bittorrent file
+
+    Requests for pieces we have are answered from a ReadCache over the
+    storage, for up to UPLOAD_SLOTS interested peers at a time. Other
+    interested peers wait, in order, for a slot to be released.
+
+    Each peer downloads one piece at a time, keeping up to
+    REQUEST_PIPELINE_DEPTH block requests outstanding. The health of every
+    connection is checked periodically on a timer wheel: quiet connections
+    get keep-alives or are dropped, and a peer whose requests time out or
+    which stops sending blocks (is snubbing us) has its piece handed to
+    another peer. A snubbing peer is sent a single request after
+    SNUB_BACKOFF, and dropped if that goes unanswered too.
+
+    Piece buffers, peers' queues and parsers and the write cache are
+    accounted to a MemoryBudget. While it is short of room, peers are given
+    no new pieces, only ones already part downloaded, and their pipelines
+    are shortened. A client with no piece in progress may always start one,
+    so a full budget slows a download but cannot stall it.
     """
 
-    def __init__(self):
+    def __init__(self, metainfo_cache=None, connection_limiter=None,
+                 max_connections=constants.MAX_CONNECTIONS_PER_TORRENT, on_complete=None, rate_limits=None,
+                 timer_wheel=None, download_directory='.', trace_directory=constants.TRACE_DIRECTORY,
+                 peer_cache=None, memory_budget=None, on_failed=None):
+        """
+        Args:
+            metainfo_cache: optional MetainfoCache used when loading torrents.
+            connection_limiter: optional ConnectionLimiter shared with other
+                clients, which caps the connections open across all of them.
+            max_connections: cap on the connections open for this client.
+            on_complete: optional callback called with the client when the
+                download completes. Without one the reactor is stopped.
+            on_failed: optional callback called with the client and a
+                ClientError when it has had no peers for STARVED_TIMEOUT,
+                despite re-announcing. Without one it keeps re-announcing.
+            rate_limits: optional RateLimits for this torrent. Each peer's
+                limits are made beneath them.
+            timer_wheel: optional TimerWheel shared with other clients, on
+                which connection health checks run.
+            download_directory: where the downloaded file is written. Pieces
+                are written as they are verified, through a Storage write
+                cache.
+            trace_directory: optional directory to write a wire trace of
+                every peer connection to (see tracelog).
+            peer_cache: optional PeerCache. The peers it remembers for the
+                torrent are dialed as soon as it starts, alongside the
+                tracker announce, and the peers we exchange data with are
+                remembered in it.
+            memory_budget: optional MemoryBudget shared with other clients.
+                Without one the client has its own, of MEMORY_BUDGET bytes.
+        """
         self.peer_id = '-DD0001-123456789013'
         self._peers = []
+        self._candidate_peers = []
         self.pieces = []
         self.unrequested_pieces = None
+        self._pieces_by_index = {}
+        self._released_pieces = []
+        self._completed_pieces = 0
+        self._lock = RLock()
         self._torrent = None
         self.complete = False
+        self._stopping = False
+        self._metainfo_cache = metainfo_cache
+        self._connection_limiter = connection_limiter
+        self.max_connections = max_connections
+        self._on_complete = on_complete
+        self._on_failed = on_failed
+        self._tracker = None
+        # When the client last ran out of peers, if it has none now, and
+        # whether a re-announce is waiting on the timer wheel.
+        self._starved_since = None
+        self._reannounce_scheduled = False
+        self.rate_limits = rate_limits or RateLimits()
+        self.metrics = ClientMetrics()
+        self.download_directory = download_directory
+        self._storage = None
+        self._read_cache = None
+        self._unchoked = set()
+        self._waiting_for_slot = []
+        self.trace_directory = trace_directory
+        self._peer_cache = peer_cache
+        self.memory = memory_budget if memory_budget is not None else MemoryBudget()
+        self._storage_memory = None
+        # Peers which were given no piece because memory was short.
+        self._waiting_for_memory = set()
+        self._owns_timer_wheel = timer_wheel is None
+        self._timer_wheel = timer_wheel or TimerWheel()
+
+    @property
+    def torrent(self):
+        return self._torrent
+
+    @property
+    def info_hash(self):
+        return self._torrent.info_hash if self._torrent else None
+
+    @property
+    def connected_peers(self):
+        return len(self._peers)
+
+    def queue_stats(self):
+        """Return the message queue depth metrics of each connected peer."""
+        return {repr(peer): peer.queue_stats() for peer in list(self._peers)}
+
+    def metrics_snapshot(self):
+        """Return the client's current metrics as a dictionary."""
+        peers = {}
+        inbound_queue_depth = 0
+        for peer in list(self._peers):
+            depth = peer.messages_from_peer.qsize()
+            inbound_queue_depth += depth
+            peers[repr(peer)] = {
+                'downloaded_bytes': peer.download_meter.total,
+                'uploaded_bytes': peer.upload_meter.total,
+                'download_rate_bytes': peer.download_meter.rate(),
+                'upload_rate_bytes': peer.upload_meter.rate(),
+                'inbound_queue_depth': depth,
+            }
+        return {
+            'downloaded_bytes': self.metrics.download.total,
+            'uploaded_bytes': self.metrics.upload.total,
+            'download_rate_bytes': self.metrics.download.rate(),
+            'upload_rate_bytes': self.metrics.upload.rate(),
+            'wasted_bytes': self.metrics.wasted_bytes,
+            'hash_failures': self.metrics.hash_failures,
+            'connected_peers': len(peers),
+            'inbound_queue_depth': inbound_queue_depth,
+            'read_cache_hits': self._read_cache.hits if self._read_cache else 0,
+            'read_cache_misses': self._read_cache.misses if self._read_cache else 0,
+            'request_rtt': self.metrics.request_rtt.snapshot(),
+            'piece_latency': self.metrics.piece_latency.snapshot(),
+            'memory': self.memory.usage(),
+            'peers': peers,
+        }
+
+    @property
+    def num_completed_pieces(self):
+        return self._completed_pieces
 
     def add_torrent(self, tor_file_path):
         """Give the Client at Torrent to use."""
         if self._torrent:
             raise ClientError('Client already has a Torrent')
         else:
-            self._torrent = Torrent(tor_file_path)
-            self.unrequested_pieces = piece_factory(self._torrent.length, self._torrent.piece_length, self._torrent.piece_hashes)
+            self._torrent = Torrent(tor_file_path, self._metainfo_cache)
+            if self._torrent.piece_layers is not None:
+                self.unrequested_pieces = merkle_piece_factory(self._torrent.piece_layers)
+            else:
+                self.unrequested_pieces = piece_factory(self._torrent.length, self._torrent.piece_length, self._torrent.piece_hashes)
 
     def start_torrent(self):
         """Begin the torrent process by contacting the Tracker and
         waiting for the response."""
         if not self._torrent:
             raise ClientError('Client Has Not Been Assigned Torrent')
-        self._connect_tracker(self._torrent.announce, self._torrent.info_hash)
+        if self._owns_timer_wheel:
+            self._timer_wheel.start()
+        if self._peer_cache is not None:
+            # Connections are made on the reactor, so these are dialed while
+            # the announce below waits on the tracker.
+            self._try_peers(self._peer_cache.peers(self._torrent.info_hash))
+            self._timer_wheel.schedule(constants.PEER_CACHE_SAVE_INTERVAL, self._save_peer_cache)
+        try:
+            self._connect_tracker(self._torrent.announce, self._torrent.info_hash)
+        except TrackerError as e:
+            if not self._peers:
+                raise
+            print('Tracker Unavailable, Carrying On With Cached Peers:', e)
 
     def _connect_tracker(self, announce, info_hash):
         """Establish initial contact with the HTTP Tracker."""
@@ -49,6 +206,46 @@ class Client:
         response = self._tracker.request(event, self.peer_id, constants.LISTENING_PORT)
         self._handle_tracker_contact(response)
 
+    def _check_starved(self):
+        """With no peers left to talk to or try, ask the tracker for more
+        after REANNOUNCE_DELAY."""
+        if self._peers or self._candidate_peers or self._stopping or self.complete:
+            return
+        if self._starved_since is None:
+            self._starved_since = time.monotonic()
+        if not self._reannounce_scheduled:
+            self._reannounce_scheduled = True
+            self._timer_wheel.schedule(constants.REANNOUNCE_DELAY, self._reannounce)
+
+    def _reannounce(self):
+        """Runs on the timer wheel, handing the announce to the thread
+        pool."""
+        self._reannounce_scheduled = False
+        if self._peers or self._stopping or self.complete or self._starved_since is None:
+            return
+        if time.monotonic() - self._starved_since >= constants.STARVED_TIMEOUT:
+            error = ClientError('No Peers For {} Seconds'.format(constants.STARVED_TIMEOUT))
+            if self._on_failed:
+                self._on_failed(self, error)
+                return
+            print(error)
+            self._starved_since = time.monotonic()
+        reactor.callInThread(self._announce_again)
+
+    def _announce_again(self):
+        """Runs on the thread pool. Only the announce is made here: the
+        peer lists are left to the reactor, which disconnects peers from
+        them."""
+        if self._tracker is None:
+            self._tracker = Tracker(self._torrent.announce, self._torrent.info_hash)
+        try:
+            response = self._tracker.request(TrackerEvent.NONE, self.peer_id, constants.LISTENING_PORT)
+            reactor.callFromThread(self._try_peers, response['peers'])
+        except TrackerError as e:
+            print('Re-announce Failed:', e)
+        # Try again later if none of the peers (if any) could be reached.
+        reactor.callFromThread(self._check_starved)
+
     def _handle_tracker_contact(self, response):
         """Handle the initial HTTP response from the tracker.
 
@@ -58,27 +255,211 @@ class Client:
         """
         peers = response['peers']
         self._try_peers(peers)
+        # A tracker with no peers for us yet is asked again later.
+        reactor.callFromThread(self._check_starved)
 
     def _try_peers(self, peers):
-        """Loops through the list of peers and tries to connect to them (only
-        one at a time right now).
+        """Queue up the peers from the tracker and connect to as many as the
+        connection limits allow. The rest are held back and tried as
+        connections are lost.
 
         TODO: We're currently connecting to multiple peers, but not coordinating the work we send
               well.
         """
-        for peer_entry in peers:
-            if peer_entry['id'] == self.peer_id:
+        known = {(peer.ip, peer.port) for peer in self._peers}
+        known.update((entry['ip'], entry['port']) for entry in self._candidate_peers)
+        for entry in peers:
+            if (entry['ip'], entry['port']) not in known:
+                known.add((entry['ip'], entry['port']))
+                self._candidate_peers.append(entry)
+        self._connect_candidates()
+
+    def _connect_candidates(self):
+        while self._candidate_peers and len(self._peers) < self.max_connections and not self._stopping:
+            peer_entry = self._candidate_peers.pop(0)
+            if peer_entry.get('id') == self.peer_id:
                 continue
 
+            if self._connection_limiter and not self._connection_limiter.acquire():
+                # Out of global connection slots, wait for one to be released.
+                self._candidate_peers.insert(0, peer_entry)
+                return
+
             print('Trying peer: {}'.format(peer_entry))
-            peer = Peer(peer_entry['id'], peer_entry['ip'], peer_entry['port'], self._torrent)
+            peer = self._new_peer(peer_entry.get('id'), peer_entry['ip'], peer_entry['port'])
             try:
                 peer.connect(self.peer_id)
             except PeerConnectionError:
+                self._release_connection()
                 continue
             else:
-                self._peers.append(peer)
-                peer.subscribe_for_messages_to_client(self.peer_message_receiver(peer))
+                self._add_peer(peer)
+
+    def accept_peer(self, ip, port):
+        """Take on a peer which connected to us, once its handshake has
+        named our torrent. Called on the reactor thread.
+
+        Returns:
+            The Peer, with our handshake queued for it, or None if we are out
+            of connections or not downloading.
+        """
+        if self._stopping or self.complete or len(self._peers) >= self.max_connections:
+            return None
+        if self._connection_limiter and not self._connection_limiter.acquire():
+            return None
+        peer = self._new_peer(None, ip, port)
+        peer.inbound = True
+        peer.shake_hands(self.peer_id)
+        self._add_peer(peer)
+        return peer
+
+    def _new_peer(self, peer_id, ip, port):
+        peer = Peer(peer_id, ip, port, self._torrent, rate_limits=self.rate_limits, metrics=self.metrics,
+                    memory=self.memory)
+        if self.trace_directory:
+            peer.trace = TraceWriter.for_peer(self.trace_directory, peer)
+        return peer
+
+    def _add_peer(self, peer):
+        self._peers.append(peer)
+        peer.subscribe_for_disconnect(self._handle_peer_disconnect)
+        peer.subscribe_for_messages_to_client(self.peer_message_receiver(peer))
+        self._timer_wheel.schedule(constants.HEALTH_CHECK_INTERVAL, self._check_peer_health, peer)
+
+    def _handle_peer_disconnect(self, peer, reason):
+        self._remember_peer(peer)
+        with self._lock:
+            self._release_piece(peer)
+            if peer in self._waiting_for_slot:
+                self._waiting_for_slot.remove(peer)
+            released = peer in self._unchoked
+            self._unchoked.discard(peer)
+        if released:
+            self._unchoke_next()
+        if peer in self._peers:
+            self._peers.remove(peer)
+            self._release_connection()
+        self._connect_candidates()
+        self._check_starved()
+
+    def _remember_peer(self, peer):
+        """Record how a connection we made went in the peer cache. Peers
+        which connected to us are left out, as their port is not one we
+        could dial."""
+        if self._peer_cache is None or peer.inbound:
+            return
+        if peer.connected_at is None:
+            self._peer_cache.record_failure(self.info_hash, peer.ip, peer.port)
+        else:
+            seconds = max(time.monotonic() - peer.connected_at, 1e-3)
+            self._peer_cache.record_success(self.info_hash, peer.ip, peer.port, peer.peer_id,
+                                            peer.download_meter.total / seconds)
+
+    def _save_peer_cache(self):
+        """Runs on the timer wheel, handing the disk work to the thread pool."""
+        if self._stopping:
+            return
+        for peer in list(self._peers):
+            self._remember_peer(peer)
+        reactor.callInThread(self._peer_cache.save, self.info_hash)
+        self._timer_wheel.schedule(constants.PEER_CACHE_SAVE_INTERVAL, self._save_peer_cache)
+
+    def _release_connection(self):
+        if self._connection_limiter:
+            self._connection_limiter.release()
+
+    def stop(self):
+        """Close every peer connection without completing the download."""
+        self._stopping = True
+        self._candidate_peers = []
+        if self._peer_cache is not None and self._torrent:
+            for peer in list(self._peers):
+                self._remember_peer(peer)
+            try:
+                self._peer_cache.save(self.info_hash)
+            except OSError as e:
+                print('Could Not Save Peer Cache:', e)
+        for peer in list(self._peers):
+            peer.close_connection()
+        if self._owns_timer_wheel:
+            self._timer_wheel.stop()
+        if self._storage:
+            self._storage.close()
+            self._storage_memory.close()
+        with self._lock:
+            for piece in self.pieces:
+                if piece.memory is not None:
+                    piece.memory.close()
+
+    @property
+    def storage(self):
+        """The Storage for the target file, opened on first use."""
+        with self._lock:
+            if self._storage is None:
+                self._storage = Storage(os.path.join(self.download_directory, self._torrent.target_file_name),
+                                        self._torrent.length, self._torrent.piece_length)
+                self._read_cache = ReadCache(self._storage)
+                self._storage_memory = self.memory.account('storage')
+                self._timer_wheel.schedule(constants.WRITE_FLUSH_INTERVAL, self._flush_storage)
+            return self._storage
+
+    def _flush_storage(self):
+        """Runs on the timer wheel, handing the disk work to the thread pool."""
+        if self._storage.closed:
+            return
+        reactor.callInThread(self._flush_expired)
+        self._timer_wheel.schedule(constants.WRITE_FLUSH_INTERVAL, self._flush_storage)
+
+    def _flush_expired(self):
+        # The client may have stopped since this was handed to the pool.
+        if self._storage.closed:
+            return
+        self._storage.flush_expired()
+        self._storage_memory.set(self._storage.cached_bytes)
+
+    def _check_peer_health(self, peer):
+        """Runs on the timer wheel every HEALTH_CHECK_INTERVAL for each
+        connected peer."""
+        if peer.disconnected or self._stopping:
+            return
+
+        now = time.monotonic()
+        if now - peer.last_received > constants.PEER_TIMEOUT:
+            print('Peer Timed Out:', peer)
+            peer.close_connection()
+            return
+
+        if now - peer.last_sent > constants.KEEP_ALIVE_INTERVAL:
+            peer.message_peer(Message.factory(MessageType.KEEP_ALIVE))
+
+        probe = False
+        with self._lock:
+            if peer.snubbed and now - peer.snubbed_at > constants.SNUB_BACKOFF:
+                peer.snubbed = False
+                probe = True
+            oldest_request = peer.oldest_request_time()
+            if oldest_request is not None:
+                # A snub is checked first: a request timing out is also true
+                # of any snub when SNUB_TIMEOUT is not below REQUEST_TIMEOUT.
+                if now - max(peer.last_piece_received, oldest_request) > constants.SNUB_TIMEOUT:
+                    self._release_piece(peer)
+                    if peer.snubbed_at is not None:
+                        # It has ignored the probe as well, so its slot is
+                        # given to another peer.
+                        print('Dropping Snubbing Peer:', peer)
+                        peer.close_connection()
+                        return
+                    peer.snubbed = True
+                    peer.snubbed_at = now
+                elif now - oldest_request > constants.REQUEST_TIMEOUT:
+                    self._release_piece(peer)
+        if probe:
+            self._fill_requests(peer)
+
+        # Memory held by other clients sharing the budget is freed without
+        # telling us, so peers waiting on it are retried here as well.
+        self._fill_waiting_peers()
+        self._timer_wheel.schedule(constants.HEALTH_CHECK_INTERVAL, self._check_peer_health, peer)
 
     def peer_message_receiver(self, peer):
         def handle_peer_message(message):
@@ -88,63 +469,372 @@ class Client:
                 msg = "Peer is sending messages without shaking our hand."
                 raise PeerError(msg)
 
+            # If the message is a piece message find the appropriate piece and add to it.
+            if message.type == MessageType.PIECE:
+                self._handle_piece_message(peer, message)
+            elif message.type == MessageType.HANDSHAKE:
+                self._starved_since = None
+                self._greet(peer)
+            elif message.type == MessageType.CHOKE:
+                # A choking peer throws away the requests we have sent it.
+                # With the Fast Extension it rejects each one instead.
+                if not peer.fast:
+                    with self._lock:
+                        self._release_piece(peer)
+            elif message.type == MessageType.REJECT:
+                self._handle_reject(peer, message)
+            elif message.type == MessageType.REQUEST:
+                self._handle_request(peer, message)
+            elif message.type == MessageType.HASHES:
+                self._handle_hashes(peer, message)
+            elif message.type == MessageType.HASH_REJECT:
+                self._handle_hash_reject(peer, message)
+            elif message.type == MessageType.HASH_REQUEST:
+                # We don't keep the leaf hashes of what we have to send on.
+                peer.message_peer(Message(MessageType.HASH_REJECT, message.payload))
+            elif message.type == MessageType.INTERESTED:
+                self._unchoke(peer)
+            elif message.type == MessageType.UNINTERESTED:
+                self._choke(peer)
+
+            if self.complete:
+                return
+
             if peer.is_choking:
-                peer.message_peer(Message.factory(MessageType.INTERESTED))  # Possibly this
-                # message passing should be replaced by method calls (ie, peer.show_interest()).
-                # But that could happen later.
-                # It is impolite to do anything before the peer has unchoked us.
+                if not peer.interested:
+                    peer.message_peer(Message.factory(MessageType.INTERESTED))  # Possibly this
+                    # message passing should be replaced by method calls (ie, peer.show_interest()).
+                    # But that could happen later.
+                    peer.interested = True
+                # It is impolite to do anything before the peer has unchoked us,
+                # except ask for the pieces it has allowed us while choked.
+                if not peer.allowed_fast:
+                    return
+
+            self._fill_requests(peer)
+
+        return handle_peer_message
+
+    def _fill_requests(self, peer):
+        """Make sure the peer has a piece to work on and a full pipeline of
+        requests for it."""
+        with self._lock:
+            if peer.snubbed or peer.disconnected or self.complete:
                 return
+            allowed = peer.allowed_fast if peer.is_choking else None
+            if peer.piece is None:
+                fresh = self._has_memory_for_piece()
+                peer.piece = self._next_piece_for(peer, allowed, fresh)
+                if peer.piece is None:
+                    if not fresh:
+                        self._waiting_for_memory.add(peer)
+                    return
+                if peer.piece.started_at is None:
+                    peer.piece.started_at = time.monotonic()
 
-            if not peer.working_on_piece and peer.pieces and len(self.pieces) < self._torrent.num_pieces:
-                self._request_next_piece(peer)
+            piece = peer.piece
+            if allowed is not None and piece.index not in allowed:
                 return
+            if isinstance(piece, MerklePiece) and piece.needs_block_hashes and peer.v2 and not peer.hashes_rejected:
+                piece.hashes_requested = True
+                peer.message_peer(piece.hash_request())
+            depth = self.memory.request_depth(constants.REQUEST_PIPELINE_DEPTH)
+            if peer.snubbed_at is not None:
+                # A probe of a peer which snubbed us.
+                depth = 1
+            while len(peer.outstanding_requests) < depth and piece.has_unrequested_blocks:
+                index, offset, length = piece.next_request()
+                peer.add_request(index, offset, length)
+                peer.message_peer(block_message(MessageType.REQUEST, index, offset, length))
 
-            # If the message is a piece message find the appropriate piece and add to it.
-            if message.type == MessageType.PIECE:
-                complete = self._handle_piece_message(message)
-                if complete:
-                    peer.working_on_piece = False
-                    if len(self.pieces) < self._torrent.num_pieces:
-                        self._request_next_piece(peer)
-                        return
-                    else:
-                        self._complete()
+    def _has_memory_for_piece(self):
+        """Whether a new piece may be started. Call with the lock held."""
+        return (self.memory.has_room(self._torrent.piece_length)
+                or not any(peer.piece is not None for peer in self._peers))
 
-        return handle_peer_message
+    def _fill_waiting_peers(self):
+        """Try again to give pieces to the peers turned away for want of
+        memory."""
+        with self._lock:
+            waiting, self._waiting_for_memory = self._waiting_for_memory, set()
+            for peer in waiting:
+                if not peer.is_choking or peer.allowed_fast:
+                    self._fill_requests(peer)
+
+    def _next_piece_for(self, peer, allowed=None, fresh=True):
+        """Pick a piece the peer has, preferring pieces it suggested, then
+        pieces other peers gave up on. Only the pieces in allowed are
+        considered if it is given, and unless fresh only pieces already part
+        downloaded. Returns None if there is nothing for the peer to do."""
+        def wanted(piece):
+            return (peer.has_piece(piece.index) and (allowed is None or piece.index in allowed)
+                    and piece is not peer.spoiled_piece and (fresh or piece.bytes_downloaded))
 
-    def _request_next_piece(self, peer):
-        next_piece = next(self.unrequested_pieces)
-        peer.message_peer(next_piece.get_next_request_message())
-        self.pieces.append(next_piece)
-        peer.working_on_piece = True
+        # Suggestions can only be taken up for pieces already handed out of
+        # the piece generator, which yields them in order.
+        for index in peer.suggested:
+            piece = self._pieces_by_index.get(index)
+            if piece in self._released_pieces and wanted(piece):
+                self._released_pieces.remove(piece)
+                return piece
 
-    def _handle_piece_message(self, piece_message):
+        for i, piece in enumerate(self._released_pieces):
+            if wanted(piece):
+                return self._released_pieces.pop(i)
+
+        if fresh:
+            for piece in self.unrequested_pieces:
+                piece.memory = self.memory.account('pieces')
+                self.pieces.append(piece)
+                self._pieces_by_index[piece.index] = piece
+                if wanted(piece):
+                    return piece
+                self._released_pieces.append(piece)
+
+        piece, peer.spoiled_piece = peer.spoiled_piece, None
+        if (piece in self._released_pieces and peer.has_piece(piece.index)
+                and (allowed is None or piece.index in allowed) and (fresh or piece.bytes_downloaded)):
+            self._released_pieces.remove(piece)
+            return piece
+        return None
+
+    def _release_piece(self, peer):
+        """Take the peer's piece back, cancelling its outstanding requests,
+        and offer the piece to the other peers. Call with the lock held."""
+        piece = peer.piece
+        requests = peer.clear_requests()
+        if piece is None:
+            return
+
+        if not peer.disconnected:
+            for index, offset, length in requests:
+                peer.message_peer(block_message(MessageType.CANCEL, index, offset, length))
+        peer.piece = None
+        piece.reset_requests()
+        self._released_pieces.append(piece)
+
+        for other in self._peers:
+            if other is not peer and other.piece is None and not other.is_choking:
+                self._fill_requests(other)
+
+    def _greet(self, peer):
+        """Tell a peer which has just shaken hands what we have. A peer
+        with the Fast Extension must be told even if it is nothing, and is
+        given its allowed fast set."""
+        if peer.fast:
+            if self._completed_pieces == 0:
+                peer.message_peer(Message.factory(MessageType.HAVE_NONE))
+            elif self._completed_pieces == self._torrent.num_pieces:
+                peer.message_peer(Message.factory(MessageType.HAVE_ALL))
+            else:
+                peer.message_peer(self._bitfield_message())
+            peer.granted_fast = allowed_fast_set(self._torrent.info_hash, peer.ip, self._torrent.num_pieces)
+            for index in sorted(peer.granted_fast):
+                peer.message_peer(Message(MessageType.ALLOWED_FAST, pack('!I', index)))
+        elif self._completed_pieces:
+            peer.message_peer(self._bitfield_message())
+
+    def _bitfield_message(self):
+        bitfield = bytearray((self._torrent.num_pieces + 7) // 8)
+        for index in range(self._torrent.num_pieces):
+            if self._storage and self._storage.has_piece(index):
+                bitfield[index // 8] |= 0x80 >> (index % 8)
+        return Message(MessageType.BITFIELD, bytes(bitfield))
+
+    def _handle_request(self, peer, request):
+        """Upload a block to the peer, if it is unchoked (or the piece is in
+        its allowed fast set) and we have it. Anything else is dropped, or
+        rejected for a peer with the Fast Extension."""
+        index, offset, length = unpack('!III', request.payload)
+        allowed = not peer.choked or index in peer.granted_fast
+        block = None
+        # The storage is closed once the client stops, and requests still
+        # queued behind it must not read from it.
+        if (allowed and length <= constants.MAX_REQUEST_LENGTH and self._read_cache is not None
+                and not self._stopping):
+            try:
+                block = self._read_cache.read_block(index, offset, length)
+            except StorageError:
+                pass
+        if block is not None:
+            peer.message_peer(PieceMessage.from_block(index, offset, block))
+        elif peer.fast:
+            peer.message_peer(block_message(MessageType.REJECT, index, offset, length))
+
+    def _handle_hashes(self, peer, message):
+        """Give a v2 piece the leaf hashes it asked the peer for. Blocks
+        already downloaded which don't match them are discarded."""
+        if self._torrent.piece_layers is None:
+            # Only v2 torrents have hashes to ask for, so these weren't.
+            return
+        root, _, index, _, _, hashes = parse_hash_message(message.payload)
+        piece_index = self._torrent.piece_layers.piece_index(root, index)
+        with self._lock:
+            piece = self._pieces_by_index.get(piece_index)
+            if not isinstance(piece, MerklePiece) or piece.completed or piece.block_hashes is not None:
+                return
+            downloaded = piece.bytes_downloaded
+            try:
+                bad = piece.set_block_hashes(hashes)
+            except PieceHashError as e:
+                print('Bad Hashes From Peer:', peer, e)
+                piece.hashes_requested = False
+                peer.hashes_rejected = True
+                return
+            if bad:
+                holder = next((other for other in self._peers if other.piece is piece), None)
+                self._discard_bad_blocks(holder, bad, downloaded - piece.bytes_downloaded)
+
+    def _handle_hash_reject(self, peer, message):
+        """The peer won't send the hashes, so another peer may be asked."""
+        if self._torrent.piece_layers is None:
+            return
+        root, _, index, _, _, _ = parse_hash_message(message.payload)
+        with self._lock:
+            piece = self._pieces_by_index.get(self._torrent.piece_layers.piece_index(root, index))
+            if isinstance(piece, MerklePiece) and piece.block_hashes is None:
+                piece.hashes_requested = False
+
+    def _discard_bad_blocks(self, holder, bad, wasted):
+        """Blame the senders of blocks which failed their merkle hashes, and
+        take the piece back from holder, the peer downloading it, so it is
+        requested again from the first bad block. Peers sending too many bad
+        blocks are dropped. Call with the lock held."""
+        for offset, source in bad:
+            print('Discarding Block:', offset, 'from', source)
+            self.metrics.hash_failures += 1
+            if source is not None:
+                source.bad_blocks += 1
+                if source.bad_blocks >= constants.MAX_BAD_BLOCKS and not source.disconnected:
+                    source.close_connection()
+        self.metrics.wasted_bytes += wasted
+        if holder is not None:
+            holder.spoiled_piece = holder.piece
+            self._release_piece(holder)
+
+    def _handle_reject(self, peer, reject):
+        """A peer with the Fast Extension won't answer a request. The rest
+        of the piece can't be used without the rejected block, so the piece
+        is released straight away rather than when the request times out."""
+        index, offset, length = unpack('!III', reject.payload)
+        with self._lock:
+            if peer.complete_request(index, offset) is not None:
+                self._release_piece(peer)
+
+    def _unchoke(self, peer):
+        """Unchoke an interested peer if an upload slot is free, or else
+        queue it for the next one released."""
+        with self._lock:
+            if not peer.choked or peer.disconnected:
+                return
+            if len(self._unchoked) >= constants.UPLOAD_SLOTS:
+                if peer not in self._waiting_for_slot:
+                    self._waiting_for_slot.append(peer)
+                return
+            self._unchoked.add(peer)
+            peer.choked = False
+        peer.message_peer(Message.factory(MessageType.UNCHOKE))
+
+    def _choke(self, peer):
+        with self._lock:
+            if peer in self._waiting_for_slot:
+                self._waiting_for_slot.remove(peer)
+            if peer.choked:
+                return
+            self._unchoked.discard(peer)
+            peer.choked = True
+        peer.message_peer(Message.factory(MessageType.CHOKE))
+        self._unchoke_next()
+
+    def _unchoke_next(self):
+        """Give a released upload slot to the peer which has waited
+        longest for one."""
+        with self._lock:
+            if not self._waiting_for_slot or len(self._unchoked) >= constants.UPLOAD_SLOTS:
+                return
+            peer = self._waiting_for_slot.pop(0)
+        self._unchoke(peer)
+
+    def _handle_piece_message(self, peer, piece_message):
         """Take in a Piece Message and route the data to the
         appropriate Piece Object
 
+        Blocks we did not ask this peer for, or no longer want from it, are
+        dropped. A piece which fails its hash check is thrown away and
+        offered to other peers.
+
         Returns:
             True if the piece is now completed.
             False if not.
         """
-        piece = None
-        for p in self.pieces:
-            if p.index == piece_message.index:
-                piece = p
+        with self._lock:
+            sent = peer.complete_request(piece_message.index, piece_message.offset)
+            piece = peer.piece
+            if sent is None or piece is None or piece.index != piece_message.index:
+                self.metrics.wasted_bytes += len(piece_message.payload)
+                return False
 
-        if not piece:
-            raise ClientError("Peer sending unrequested piece")
-        piece.download(piece_message.offset, piece_message.payload)
-        return piece.completed
+            now = time.monotonic()
+            self.metrics.request_rtt.observe(now - sent)
+            peer.snubbed = False
+            peer.snubbed_at = None
+            try:
+                piece.download(piece_message.offset, piece_message.payload, peer)
+            except BlockHashError as e:
+                self._discard_bad_blocks(peer, [(e.offset, peer)], len(piece_message.payload))
+                return False
+            except PieceError as e:
+                print('Discarding Piece:', piece, e)
+                if isinstance(e, PieceHashError):
+                    self.metrics.hash_failures += 1
+                self.metrics.wasted_bytes += piece.bytes_downloaded
+                piece.reset()
+                self._release_piece(peer)
+                return False
 
-    def _complete(self):
+            if not piece.completed:
+                return False
 
-        for peer in self._peers:
-            peer.close_connection()
+            self.metrics.piece_latency.observe(now - piece.started_at)
+            peer.piece = None
 
-        self.pieces.sort()
-        with open(self._torrent.target_file_name, 'wb') as target_file:
-            for piece in self.pieces:
-                piece.writeout(target_file)
+        # Storing the piece happens outside the lock, so the reactor isn't held
+        # up by disconnects waiting on the disk. It is only counted once
+        # stored, so the download cannot complete with pieces still on their
+        # way to storage.
+        try:
+            with PROFILER.timing('writeout'):
+                self.storage.write_piece(piece.index, piece.take_data())
+            self._storage_memory.set(self.storage.cached_bytes)
+        except StorageError as e:
+            print('Could Not Store Piece:', piece, e)
+            with self._lock:
+                piece.reset()
+                self._released_pieces.append(piece)
+            return False
+        with self._lock:
+            self._completed_pieces += 1
+            finished = self._completed_pieces == self._torrent.num_pieces and not self.complete
+            if finished:
+                self.complete = True
+
+        have = Message(MessageType.HAVE, pack('!I', piece.index))
+        for other in list(self._peers):
+            if not other.disconnected:
+                other.message_peer(have)
+        self._fill_waiting_peers()
+
+        if finished:
+            self._complete()
+        return True
+
+    def _complete(self):
         self.complete = True
-        reactor.stop()
+        # Stopping closes the storage, writing out whatever it still holds.
+        with PROFILER.timing('stop'):
+            self.stop()
         print('File Has Completed Downloading')
+        if self._on_complete:
+            self._on_complete(self)
+        else:
+            reactor.callFromThread(reactor.stop)
@@ -2,16 +2,93 @@
 
 # Network Configuration
 LISTENING_PORT = 6881
-LISTENING_HOST = '127.0.0.1'  # '' will default to all interfaces
+LISTENING_HOST = ''  # every interface, as peers are announced our public address
+
+# Session Configuration
+MAX_CONNECTIONS = 200
+MAX_CONNECTIONS_PER_TORRENT = 30
+MAX_ACTIVE_TORRENTS = 8
+
+# Rate Limit Configuration (bytes per second, None for unlimited)
+PEER_DOWNLOAD_RATE = None
+PEER_UPLOAD_RATE = None
+RATE_LIMIT_BURST_SECONDS = 0.25
+
+# Queue Configuration (in messages)
+INBOUND_QUEUE_HIGH_WATER = 256
+INBOUND_QUEUE_LOW_WATER = 64
+OUTBOUND_QUEUE_HIGH_WATER = 256
+OUTBOUND_QUEUE_LOW_WATER = 64
+
+# Tracker Re-announce Configuration (in seconds)
+REANNOUNCE_DELAY = 30  # after running out of peers, and between re-announces while out
+STARVED_TIMEOUT = 600  # without a connected peer before a session fails the torrent
+
+# Connection Health Configuration (in seconds)
+KEEP_ALIVE_INTERVAL = 90
+PEER_TIMEOUT = 180
+REQUEST_TIMEOUT = 60
+SNUB_TIMEOUT = 60
+SNUB_BACKOFF = 120  # before a snubbing peer is probed with a request again
+HEALTH_CHECK_INTERVAL = 5
+TIMER_WHEEL_TICK = 1.0
+TIMER_WHEEL_SLOTS = 512
+
+# Metrics Configuration
+METRICS_PORT = 9881
+METRICS_RATE_WINDOW = 20  # seconds
+REQUEST_RTT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PIECE_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Storage Configuration
+WRITE_CACHE_SIZE = 64 * 2 ** 20  # bytes of verified pieces held before writing
+WRITE_EXTENT_SIZE = 4 * 2 ** 20  # written as soon as complete; keep a multiple of the piece length
+WRITE_FLUSH_INTERVAL = 5  # seconds a piece may wait in the cache
+WRITE_FSYNC = False
+WRITE_FADVISE = False
+READ_CACHE_SIZE = 32 * 2 ** 20  # bytes of pieces kept to answer block requests
+READ_AHEAD_PIECES = 4
+
+# Memory Configuration
+MEMORY_BUDGET = None  # bytes of pieces, buffers and queues a client or session may hold, or None
+MEMORY_THROTTLE = 0.8  # share of the budget in use at which new pieces stop being started
+
+# Trace Configuration
+TRACE_DIRECTORY = None  # A directory to write per-connection wire traces to, or None
+
+# Profiling Configuration
+PROFILING = False  # Time the hot paths from start up (see profiling)
+PROFILE_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1)
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_CAPTURE_SECONDS = 30
 
 # Handshake Configuration
 PSTR = b"BitTorrent protocol"
-RESERVED = b"\x00\x00\x00\x00\x00\x00\x00\x00"
+FAST_EXTENSION = 0x04  # Bit of the last reserved byte offering the Fast Extension (BEP 6)
+V2_EXTENSION = 0x10  # Bit of the last reserved byte offering v2 torrents and hash requests (BEP 52)
+RESERVED = b"\x00\x00\x00\x00\x00\x00\x00" + bytes([FAST_EXTENSION | V2_EXTENSION])
+RESERVED_V1 = b"\x00\x00\x00\x00\x00\x00\x00" + bytes([FAST_EXTENSION])  # for torrents without piece layers
 INFO_HASH_LEN = 20
 PEER_ID_LEN = 20
 
+# Metainfo Cache Configuration
+METAINFO_CACHE_SIZE = 256 * 2 ** 20
+
+# Peer Cache Configuration
+PEER_CACHE_DIRECTORY = '.dripdrop-peers'  # where dripdrop.py remembers good peers, or None
+PEER_CACHE_PEERS = 50  # peers remembered per torrent
+PEER_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # seconds a peer is remembered after it was last seen
+PEER_CACHE_MAX_FAILURES = 3  # failed connections in a row before a peer is forgotten
+PEER_CACHE_SIZE = 4 * 2 ** 20
+PEER_CACHE_SAVE_INTERVAL = 60  # seconds between saves while downloading
+
 # Request Configuration
 REQUEST_LENGTH = 2 ** 14
+REQUEST_PIPELINE_DEPTH = 8
+MAX_REQUEST_LENGTH = 2 ** 17  # the largest block we will upload
+UPLOAD_SLOTS = 4  # peers unchoked at once
+ALLOWED_FAST_SET_SIZE = 10  # pieces a peer may request from us while choked
+MAX_BAD_BLOCKS = 3  # blocks failing their merkle hash before a peer is dropped
 
 # Tracker Configuration
 PEER_BYTE_LENGTH = 6
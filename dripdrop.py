@@ -1,14 +1,32 @@
+"""The dripdrop command line.
+
+Run without arguments it asks for a .torrent file and downloads it. The
+download, status and recheck commands instead take their torrents and
+options as arguments, for use from scripts:
+
+    python3 dripdrop.py download a.torrent b.torrent --output-dir downloads --json
+    python3 dripdrop.py recheck a.torrent --output-dir downloads
+
+Only download needs Twisted and requests, so they are imported when it
+runs, and status and recheck start in milliseconds. Each command exits with
+one of the EXIT_ codes below.
+"""
+
+import argparse
+import json
 import os
-from client import Client
-from torrent import TorrentError
+import sys
+import time
+from hashlib import sha1
 
-# TODO: Handle problem if tracker is unavailable.
+from merkle import block_hashes, merkle_root
+from torrent import Torrent, TorrentError
+import constants
 
 # TODO: Store Partial File Download? Perhaps just completed pieces - But
 #       allow for reinitiailzation on Torrent load
 
 # TODO: Control file download process more closely.
-# TODO: Open ourselves up for proactive seed connections.
 
 # TODO: Good documentation in files.
 
@@ -19,31 +37,277 @@ from torrent import TorrentError
 # 4. Message
 # 5. Peer
 
-client = Client()
+EXIT_OK = 0
+EXIT_FAILED = 1  # a torrent could not be loaded, or its download failed
+EXIT_USAGE = 2  # bad arguments, as argparse exits with
+EXIT_INCOMPLETE = 3  # a download timed out, or a recheck found pieces missing
+EXIT_INTERRUPTED = 130
+
+FINISHED_STATES = ('complete', 'failed', 'stopped')
+
+
+class Reporter:
+    """Writes what a command has to say to stdout: a line of text per
+    event, or with as_json a JSON object per line. Errors go to stderr as
+    text, but to stdout with everything else as JSON."""
+    def __init__(self, as_json=False, out=None):
+        self.as_json = as_json
+        self.out = out or sys.stdout
+
+    def report(self, event, text, **fields):
+        if self.as_json:
+            fields['event'] = event
+            self.out.write(json.dumps(fields) + '\n')
+        else:
+            self.out.write(text + '\n')
+        self.out.flush()
+
+    def error(self, path, error):
+        if self.as_json:
+            self.report('error', '', torrent=path, error=str(error))
+        else:
+            sys.stderr.write('{}: {}\n'.format(path, error))
+
+
+def load_torrents(paths, reporter):
+    """Load each .torrent file, reporting the ones which can't be.
+
+    Returns:
+        (path, Torrent) of each loaded torrent, and whether any failed.
+    """
+    torrents = []
+    failed = False
+    for path in paths:
+        try:
+            torrents.append((path, Torrent(path)))
+        except TorrentError as e:
+            reporter.error(path, e)
+            failed = True
+    return torrents, failed
+
+
+def status(args, reporter):
+    """Report each torrent's metadata and how much of its target file is
+    on disk, without reading it."""
+    torrents, failed = load_torrents(args.torrents, reporter)
+    for path, torrent in torrents:
+        target = os.path.join(args.output_dir, torrent.target_file_name)
+        try:
+            on_disk = os.path.getsize(target)
+        except OSError:
+            on_disk = None
+        reporter.report(
+            'status', '{} | {} | {} bytes in {} pieces | {}'.format(
+                torrent.name, torrent.info_hash.hex(), torrent.length, torrent.num_pieces,
+                'not started' if on_disk is None else '{} bytes on disk'.format(on_disk)),
+            torrent=path, name=torrent.name, info_hash=torrent.info_hash.hex(), meta_version=torrent.meta_version,
+            length=torrent.length, piece_length=torrent.piece_length, num_pieces=torrent.num_pieces,
+            target=target, on_disk=on_disk)
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def recheck(args, reporter):
+    """Hash each torrent's target file piece by piece and report how many
+    pieces are good."""
+    torrents, failed = load_torrents(args.torrents, reporter)
+    incomplete = False
+    for path, torrent in torrents:
+        target = os.path.join(args.output_dir, torrent.target_file_name)
+        verified = verify_pieces(torrent, target)
+        incomplete = incomplete or len(verified) < torrent.num_pieces
+        reporter.report(
+            'recheck', '{} | {}/{} pieces verified'.format(torrent.name, len(verified), torrent.num_pieces),
+            torrent=path, name=torrent.name, info_hash=torrent.info_hash.hex(), target=target,
+            verified=len(verified), num_pieces=torrent.num_pieces,
+            complete=len(verified) == torrent.num_pieces)
+    if failed:
+        return EXIT_FAILED
+    return EXIT_INCOMPLETE if incomplete else EXIT_OK
+
+
+def verify_pieces(torrent, target):
+    """Return the indexes of the pieces of target, a torrent's downloaded
+    file, which match their hashes. A missing file has none."""
+    verified = []
+    try:
+        target_file = open(target, 'rb')
+    except FileNotFoundError:
+        return verified
+    with target_file:
+        for index in range(torrent.num_pieces):
+            data = target_file.read(torrent.piece_length)
+            if piece_is_valid(torrent, index, data):
+                verified.append(index)
+    return verified
+
 
-print(" __              __")
-print("|  \\  __    __  |  \\  __  __   __")
-print("|__/ |   | |__| |__/ |   |__| |__|")
-print("           |                  |")
-print("")
-print("")
+def piece_is_valid(torrent, index, data):
+    """Check a piece read from the target file. v2 pieces are followed by
+    padding up to the piece length, which is not hashed."""
+    if torrent.piece_hashes is not None:
+        return len(data) == _piece_size(torrent, index) and sha1(data).digest() == torrent.piece_hashes[index]
+    layer = torrent.piece_layers[index]
+    return len(data) >= layer.length and merkle_root(block_hashes(data[:layer.length]), layer.width) == layer.hash
 
-def get_and_assign_file():
-    file_name = input(".torrent file: ")
 
-    if os.path.splitext(file_name)[-1] != '.torrent':
-        print("Must be .torrent file")
-        get_and_assign_file()
+def _piece_size(torrent, index):
+    return min(torrent.piece_length, torrent.length - index * torrent.piece_length)
+
+
+def download(args, reporter):
+    """Download the torrents in one Session, reporting their progress every
+    interval seconds until all have finished or timeout passes."""
+    from session import Session, SessionError
+    from peercache import PeerCache
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    peer_cache = PeerCache(constants.PEER_CACHE_DIRECTORY) if constants.PEER_CACHE_DIRECTORY else None
+    session = Session(max_active_torrents=args.max_active, max_connections=args.max_connections,
+                      max_connections_per_torrent=args.max_connections_per_torrent,
+                      download_rate=args.download_rate, upload_rate=args.upload_rate,
+                      listen_port=None if args.no_listen else args.port,
+                      listen_interface=args.listen_interface, peer_cache=peer_cache,
+                      download_directory=args.output_dir, memory_budget=args.memory_budget)
+
+    failed = False
+    paths = {}
+    for path in args.torrents:
+        try:
+            paths[session.add_torrent(path).hex()] = path
+        except (TorrentError, SessionError) as e:
+            reporter.error(path, e)
+            failed = True
+    if not paths:
+        return EXIT_FAILED
+
+    started = time.monotonic()
+    session.start()
     try:
-        client.add_torrent(file_name)
-    except TorrentError as e:
-        print(e)
-        get_and_assign_file()
+        while True:
+            time.sleep(args.interval)
+            statuses = session.status()
+            finished = all(s['state'] in FINISHED_STATES for s in statuses)
+            timed_out = args.timeout is not None and time.monotonic() - started >= args.timeout
+            if finished or timed_out:
+                break
+            for s in statuses:
+                _report_progress(reporter, 'progress', paths, s)
+            usage = session.memory_usage()
+            reporter.report('memory', 'memory | {} of {} bytes{}'.format(
+                usage['used'], usage['limit'] or 'unlimited', ' | throttled' if usage['throttled'] else ''), **usage)
+    except KeyboardInterrupt:
+        session.stop()
+        return EXIT_INTERRUPTED
+
+    session.stop()
+    for s in statuses:
+        _report_progress(reporter, 'done', paths, s)
+        failed = failed or s['state'] == 'failed'
+    if failed:
+        return EXIT_FAILED
+    return EXIT_OK if finished else EXIT_INCOMPLETE
+
+
+def _report_progress(reporter, event, paths, status):
+    text = '{} | {} | {}/{} pieces | {} peers'.format(
+        status['name'], status['state'], status['pieces'], status['num_pieces'], status['peers'])
+    if status['error']:
+        text += ' | ' + status['error']
+    reporter.report(event, text, torrent=paths[status['info_hash']], **status)
+
+
+def interactive():
+    """Ask for a .torrent file and download it into the current
+    directory."""
+    from twisted.internet import reactor
+
+    from client import Client
+    from peer import PeerConnectionFactory, listen_for_peers
+    from peercache import PeerCache
+
+    client = Client(peer_cache=PeerCache(constants.PEER_CACHE_DIRECTORY) if constants.PEER_CACHE_DIRECTORY else None)
+
+    print(" __              __")
+    print("|  \\  __    __  |  \\  __  __   __")
+    print("|__/ |   | |__| |__/ |   |__| |__|")
+    print("           |                  |")
+    print("")
+    print("")
+
+    while True:
+        file_name = input(".torrent file: ")
+        if os.path.splitext(file_name)[-1] != '.torrent':
+            print("Must be .torrent file")
+            continue
+        try:
+            client.add_torrent(file_name)
+            break
+        except TorrentError as e:
+            print(e)
+
+    # Accept connections from peers who learn about us from the tracker.
+    PeerConnectionFactory.ensure_reactor()
+    reactor.callFromThread(listen_for_peers, lambda info_hash: client if info_hash == client.info_hash else None)
+    client.start_torrent()
+    return EXIT_OK
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Download torrents with DripDrop. '
+                                                 'Without a command, asks for a .torrent file.')
+    commands = parser.add_subparsers(dest='command')
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('torrents', nargs='+', help='.torrent files')
+    common.add_argument('-o', '--output-dir', default='.', help='where the downloaded files are (default: .)')
+    common.add_argument('--json', action='store_true', help='write a JSON object per line instead of text')
+
+    command = commands.add_parser('download', parents=[common], help='download torrents until all finish')
+    command.add_argument('--max-active', type=int, default=constants.MAX_ACTIVE_TORRENTS,
+                         help='torrents downloading at once (default: %(default)s)')
+    command.add_argument('--max-connections', type=int, default=constants.MAX_CONNECTIONS,
+                         help='peer connections across all torrents (default: %(default)s)')
+    command.add_argument('--max-connections-per-torrent', type=int, default=constants.MAX_CONNECTIONS_PER_TORRENT,
+                         help='peer connections per torrent (default: %(default)s)')
+    command.add_argument('--download-rate', type=int, help='download limit in bytes per second')
+    command.add_argument('--upload-rate', type=int, help='upload limit in bytes per second')
+    command.add_argument('--memory-budget', type=int, default=constants.MEMORY_BUDGET,
+                         help='bytes of pieces, buffers and queues held across all torrents')
+    command.add_argument('--port', type=int, default=constants.LISTENING_PORT,
+                         help='port to accept peers on (default: %(default)s)')
+    command.add_argument('--listen-interface', default=constants.LISTENING_HOST,
+                         help='address to accept peers on (default: every interface)')
+    command.add_argument('--no-listen', action='store_true', help='do not accept peer connections')
+    command.add_argument('--interval', type=float, default=1.0,
+                         help='seconds between progress reports (default: %(default)s)')
+    command.add_argument('--timeout', type=float, help='give up after this many seconds')
+    command.set_defaults(run=download)
+
+    command = commands.add_parser('status', parents=[common], help="show torrents' metadata and files on disk")
+    command.set_defaults(run=status)
 
-get_and_assign_file()
-client.start_torrent()
+    command = commands.add_parser('recheck', parents=[common], help="hash torrents' downloaded files")
+    command.set_defaults(run=recheck)
+    return parser
 
 
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command in (None, 'download'):
+        # Downloads run long enough to be worth profiling in place (see
+        # profiling), so SIGUSR2 captures a profile of them.
+        from profiling import install_signal_handler
+        install_signal_handler()
+    if args.command is None:
+        return interactive()
 
+    reporter = Reporter(args.json)
+    if args.command == 'download' and args.json:
+        # The client narrates connections and pieces on stdout, which is
+        # left to the JSON.
+        sys.stdout = sys.stderr
+    return args.run(args, reporter)
 
 
+if __name__ == '__main__':
+    sys.exit(main())
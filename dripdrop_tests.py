@@ -1,11 +1,41 @@
+import io
+import json
+import os
+import subprocess
+import sys
 import unittest
+import unittest.mock
+from types import SimpleNamespace
 import pickle
+import threading
+import time
+import tempfile
+from hashlib import sha1, sha256
+from struct import pack, unpack
 
-from tracker import Tracker, TrackerEvent
+from bencode3 import bencode
+
+from tracker import Tracker, TrackerEvent, TrackerError
 from client import Client, ClientError
-from message import MessageParser, MessageType, _strip_message
-from peer import Peer
+from message import Message, MessageException, MessageParser, MessageType, MessageQueue, PieceMessage, block_message, get_handshake, parse_handshake, hash_message, parse_hash_message, _strip_message
+from peer import Peer, PeerConnection, PeerError, ConnectionLimiter, PeerListenerFactory, allowed_fast_set
+from ratelimit import TokenBucket, RateLimits
+from session import Session, SessionError, TorrentState
+from timerwheel import TimerWheel
+from metrics import RateMeter, Histogram, render_prometheus
+from tracelog import TraceWriter, read_trace, flush_traces, INBOUND, OUTBOUND
+from replay import replay
+from profiling import Profiler, StackSampler
+from simulate import Swarm, SimulatedSeeder
+from storage import Storage, StorageError, ReadCache
+import constants
+from piece import piece_factory, merkle_piece_factory, BlockHashError, PieceHashError
+from merkle import BLOCK_LENGTH, block_hashes, merkle_root, next_power_of_two, pad_hash
 from torrent import Torrent, TorrentError
+from metacache import MetainfoCache
+from peercache import PeerCache
+from memory import MemoryBudget
+import dripdrop
 
 class ClientTests(unittest.TestCase):
     def setUp(self):
@@ -55,6 +85,57 @@ class TrackerTests(unittest.TestCase):
         peers = attempt['peers']
         self.assertEqual(len(peers), 15, peers)
 
+class InboundConnectionTests(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet.testing import StringTransport
+        self.info_hash = b'\x01' * 20
+        self.accepted = []
+        self.client = SimpleNamespace(accept_peer=self.accept_peer)
+        self.patcher = unittest.mock.patch('peer.reactor')
+        self.patcher.start().callFromThread = lambda f, *args: f(*args)
+        factory = PeerListenerFactory(lambda info_hash: self.client if info_hash == self.info_hash else None)
+        self.connection = factory.buildProtocol(None)
+        self.transport = StringTransport(peerAddress=SimpleNamespace(host='10.0.0.7', port=51413))
+        self.connection.makeConnection(self.transport)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def accept_peer(self, ip, port):
+        peer = Peer(None, ip, port, SimpleNamespace(info_hash=self.info_hash, num_pieces=16))
+        peer.subscribe_for_messages_to_peer = lambda callback: None
+        self.accepted.append(peer)
+        return peer
+
+    def test_accepts_handshake_for_our_torrent(self):
+        handshake = get_handshake('-XX0001-000000000001', self.info_hash).to_bytes()
+        interested = Message.factory(MessageType.INTERESTED).to_bytes()
+        self.connection.dataReceived(handshake[:30])
+        self.assertFalse(self.accepted)
+        self.connection.dataReceived(handshake[30:] + interested)
+        peer, = self.accepted
+        self.assertIs(self.connection.peer, peer)
+        self.assertEqual((peer.ip, peer.port), ('10.0.0.7', 51413))
+        self.assertTrue(peer.hands_shook)
+        self.assertEqual(peer.peer_id, '-XX0001-000000000001')
+        self.assertTrue(peer.is_interested)
+        self.assertFalse(self.transport.disconnecting)
+
+    def test_rejects_other_torrents(self):
+        self.connection.dataReceived(get_handshake('-XX0001-000000000001', b'\x02' * 20).to_bytes())
+        self.assertFalse(self.accepted)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_rejects_other_protocols(self):
+        self.connection.dataReceived(b'GET / HTTP/1.1')
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_rejects_when_client_is_full(self):
+        self.client.accept_peer = lambda ip, port: None
+        self.connection.dataReceived(get_handshake('-XX0001-000000000001', self.info_hash).to_bytes())
+        self.assertTrue(self.transport.disconnecting)
+
+
 class MessageTests(unittest.TestCase):
     def test_message_parser(self):
 
@@ -97,6 +178,81 @@ class MessageTests(unittest.TestCase):
         self.assertEqual(answers[0].type, MessageType.BITFIELD)
         self.assertEqual(answers[0].payload, b'\xff\x80')
 
+    def test_serialize_round_trip(self):
+        block = os.urandom(100)
+        outgoing = [
+            block_message(MessageType.REQUEST, 3, 2 ** 14, 2 ** 14),
+            block_message(MessageType.CANCEL, 3, 0, 2 ** 14),
+            Message(MessageType.HAVE, b'\x00\x00\x00\x07'),
+            Message.factory(MessageType.KEEP_ALIVE),
+            Message.factory(MessageType.INTERESTED),
+            PieceMessage.from_block(5, 32, block),
+        ]
+        wire = b''.join(chunk for message in outgoing for chunk in message.to_chunks())
+        incoming = list(MessageParser()(wire))
+        self.assertEqual([m.type for m in incoming], [m.type for m in outgoing])
+        self.assertEqual(incoming[0].payload, outgoing[0].payload)
+        self.assertEqual((incoming[-1].index, incoming[-1].offset, incoming[-1].payload), (5, 32, block))
+
+    def test_payloadless_messages_are_shared(self):
+        self.assertIs(Message.factory(MessageType.CHOKE), Message.factory(MessageType.CHOKE))
+        parsed = list(MessageParser()(b'\x00\x00\x00\x01\x02' * 2))
+        self.assertIs(parsed[0], parsed[1])
+        self.assertFalse(hasattr(parsed[0], '__dict__'))
+        self.assertFalse(hasattr(PieceMessage.from_block(0, 0, b'x'), '__dict__'))
+
+    def test_split_length_prefix(self):
+        parser = MessageParser()
+        self.assertEqual(list(parser(b'\x00\x00')), [])
+        messages = list(parser(b'\x00\x01\x01'))
+        self.assertEqual([m.type for m in messages], [MessageType.UNCHOKE])
+
+    def test_unknown_message_type(self):
+        with self.assertRaises(MessageException):
+            list(MessageParser()(b'\x00\x00\x00\x01\x63'))
+
+    def test_piece_payload_not_copied(self):
+        block = os.urandom(2 ** 14)
+        chunks = PieceMessage.from_block(1, 0, block).to_chunks()
+        self.assertIs(chunks[-1], block)
+
+    def test_fast_extension_messages(self):
+        outgoing = [
+            Message.factory(MessageType.HAVE_ALL),
+            Message.factory(MessageType.HAVE_NONE),
+            Message(MessageType.SUGGEST, b'\x00\x00\x00\x02'),
+            Message(MessageType.ALLOWED_FAST, b'\x00\x00\x00\x04'),
+            block_message(MessageType.REJECT, 1, 0, 2 ** 14),
+        ]
+        wire = b''.join(message.to_bytes() for message in outgoing)
+        incoming = list(MessageParser()(wire))
+        self.assertEqual([m.type for m in incoming], [m.type for m in outgoing])
+        self.assertIs(incoming[0], outgoing[0])
+        self.assertEqual(incoming[-1].payload, outgoing[-1].payload)
+
+    def test_handshake_negotiates_extensions(self):
+        info_hash = bytes(20)
+        offered = parse_handshake(get_handshake('-XX0001-000000000001', info_hash).to_bytes())
+        self.assertTrue(offered['fast'])
+        self.assertTrue(offered['v2'])
+        plain = parse_handshake(get_handshake('-XX0001-000000000001', info_hash, bytes(8)).to_bytes())
+        self.assertFalse(plain['fast'])
+        self.assertFalse(plain['v2'])
+
+    def test_hash_messages(self):
+        root = os.urandom(32)
+        hashes = os.urandom(64)
+        outgoing = [
+            hash_message(MessageType.HASH_REQUEST, root, 0, 4, 2, 0),
+            hash_message(MessageType.HASHES, root, 0, 4, 2, 0, hashes),
+            hash_message(MessageType.HASH_REJECT, root, 0, 4, 2, 0),
+        ]
+        incoming = list(MessageParser()(b''.join(message.to_bytes() for message in outgoing)))
+        self.assertEqual([m.type for m in incoming], [m.type for m in outgoing])
+        self.assertEqual(parse_hash_message(incoming[1].payload), (root, 0, 4, 2, 0, hashes))
+        with self.assertRaises(MessageException):
+            parse_hash_message(root)
+
     def test_strip_message(self):
         a = b'12345678910'
         b, c = _strip_message(a, 4)
@@ -108,6 +264,1520 @@ class MessageTests(unittest.TestCase):
 
         print("I did it?")
 
+def write_torrent(directory, data, piece_length=32, name='target.bin'):
+    """Write a single file .torrent describing data and return its path."""
+    hashes = b''.join(sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+    metadict = {
+        'announce': 'http://127.0.0.1:8000/announce',
+        'info': {'name': name, 'length': len(data), 'piece length': piece_length, 'pieces': hashes}
+    }
+    path = os.path.join(directory, 'test.torrent')
+    with open(path, 'wb') as tor_file:
+        tor_file.write(bencode(metadict))
+    return path
+
+
+def write_v2_torrent(directory, files, piece_length=2 ** 15, hybrid=False):
+    """Write a v2 .torrent of the (name, data) files and return its path.
+    A hybrid torrent also gets v1 pieces, with pad files lining the files
+    up on piece boundaries."""
+    tree = {}
+    layers = {}
+    blocks_per_piece = piece_length // BLOCK_LENGTH
+    v1_files = []
+    v1_data = b''
+    for name, data in files:
+        leaves = block_hashes(data)
+        root = merkle_root(leaves, next_power_of_two(len(leaves)))
+        tree[name] = {'': {'length': len(data), 'pieces root': root}}
+        if len(data) > piece_length:
+            layers[root] = b''.join(merkle_root(leaves[i:i + blocks_per_piece], blocks_per_piece)
+                                    for i in range(0, len(leaves), blocks_per_piece))
+        v1_files.append({'length': len(data), 'path': [name]})
+        v1_data += data
+        pad = -len(data) % piece_length
+        if pad and name != files[-1][0]:
+            v1_files.append({'length': pad, 'path': ['.pad', str(pad)], 'attr': 'p'})
+            v1_data += bytes(pad)
+    info = {'name': 'multi', 'piece length': piece_length, 'meta version': 2, 'file tree': tree}
+    if hybrid:
+        info['files'] = v1_files
+        info['pieces'] = b''.join(sha1(v1_data[i:i + piece_length]).digest()
+                                  for i in range(0, len(v1_data), piece_length))
+    metadict = {'announce': 'http://127.0.0.1:8000/announce', 'info': info, 'piece layers': layers}
+    path = os.path.join(directory, 'v2.torrent')
+    with open(path, 'wb') as tor_file:
+        tor_file.write(bencode(metadict))
+    return path
+
+
+class TorrentTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = bytes(range(256)) * 3 + b'tail'
+        self.path = write_torrent(self.directory.name, self.data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_info_hash_matches_bencoded_info(self):
+        t = Torrent(self.path)
+        info = {'name': 'target.bin', 'length': len(self.data), 'piece length': 32,
+                'pieces': bytes(t.piece_hashes.blob)}
+        self.assertEqual(t.info_hash, sha1(bencode(info)).digest())
+        self.assertEqual(t.announce, 'http://127.0.0.1:8000/announce')
+        self.assertEqual(t.target_file_name, 'target.bin')
+
+    def test_piece_hashes_view(self):
+        t = Torrent(self.path)
+        self.assertEqual(t.num_pieces, 25)
+        self.assertEqual(t.piece_hashes[0], sha1(self.data[:32]).digest())
+        self.assertEqual(t.piece_hashes[-1], sha1(b'tail').digest())
+        self.assertIsInstance(t.piece_hashes[3], memoryview)
+        with self.assertRaises(IndexError):
+            t.piece_hashes[25]
+
+    def test_piece_factory_lengths(self):
+        t = Torrent(self.path)
+        pieces = list(piece_factory(t.length, t.piece_length, t.piece_hashes))
+        self.assertEqual(len(pieces), t.num_pieces)
+        self.assertEqual(pieces[-1].length, 4)
+
+    def test_malformed_torrent(self):
+        with open(self.path, 'r+b') as tor_file:
+            tor_file.truncate(40)
+        with self.assertRaises(TorrentError):
+            Torrent(self.path)
+
+        for metainfo in (b'd1:a-3:xe', b'd1:a+1:xe', b'd1:a01:xe'):
+            with open(self.path, 'wb') as tor_file:
+                tor_file.write(metainfo)
+            with self.assertRaises(TorrentError):
+                Torrent(self.path)
+
+
+class MerkleTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.big = os.urandom(3 * 2 ** 15 + 5000)
+        self.small = os.urandom(20000)
+        self.files = [('a.bin', self.big), ('b.bin', self.small)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_tree_padding(self):
+        leaf = block_hashes(bytes(BLOCK_LENGTH))[0]
+        self.assertEqual(merkle_root([leaf], 2), sha256(leaf + bytes(32)).digest())
+        self.assertEqual(merkle_root([], 4), pad_hash(4))
+        self.assertEqual(pad_hash(2), sha256(bytes(64)).digest(), 'Padding leaves are zero hashes')
+        self.assertEqual([next_power_of_two(n) for n in (1, 2, 3, 5)], [1, 2, 4, 8])
+
+    def test_v2_torrent(self):
+        path = write_v2_torrent(self.directory.name, self.files)
+        t = Torrent(path)
+        with open(path, 'rb') as tor_file:
+            metainfo = tor_file.read()
+        info = metainfo[metainfo.index(b'4:infod') + 6:metainfo.index(b'12:piece layers')]
+        self.assertEqual(t.info_hash_v2, sha256(info).digest())
+        self.assertEqual(t.info_hash, t.info_hash_v2[:20], 'v2 swarms use the truncated hash')
+        self.assertIsNone(t.piece_hashes)
+        self.assertEqual(t.files, [('multi/a.bin', 0, len(self.big)), ('multi/b.bin', 4 * 2 ** 15, 20000)])
+        self.assertEqual(t.length, 4 * 2 ** 15 + 20000)
+        self.assertEqual(t.num_pieces, 5)
+        pieces = list(merkle_piece_factory(t.piece_layers))
+        self.assertEqual([p.length for p in pieces], [2 ** 15] * 3 + [5000, 20000])
+        self.assertEqual([p.padded_length for p in pieces], [2 ** 15] * 4 + [20000])
+        self.assertEqual(pieces[4].layer.width, 2, 'A small file is one tree of its blocks')
+
+    def test_hybrid_torrent(self):
+        path = write_v2_torrent(self.directory.name, self.files, hybrid=True)
+        t = Torrent(path)
+        with open(path, 'rb') as tor_file:
+            metainfo = tor_file.read()
+        info = metainfo[metainfo.index(b'4:infod') + 6:metainfo.index(b'12:piece layers')]
+        self.assertEqual(t.info_hash, sha1(info).digest(), 'Hybrid torrents join the v1 swarm')
+        self.assertEqual(t.info_hash_v2, sha256(info).digest())
+        self.assertEqual(len(t.piece_hashes), 5)
+        self.assertEqual(t.num_pieces, 5)
+        self.assertIsNotNone(t.piece_layers)
+
+    def test_bad_piece_layer(self):
+        path = write_v2_torrent(self.directory.name, self.files)
+        with open(path, 'rb') as tor_file:
+            metainfo = bytearray(tor_file.read())
+        metainfo[-10] ^= 0xff
+        with open(path, 'wb') as tor_file:
+            tor_file.write(metainfo)
+        with self.assertRaises(TorrentError):
+            Torrent(path)
+
+    def test_blocks_checked_on_arrival(self):
+        t = Torrent(write_v2_torrent(self.directory.name, self.files))
+        piece = next(merkle_piece_factory(t.piece_layers))
+        self.assertTrue(piece.needs_block_hashes)
+        request = parse_hash_message(piece.hash_request().payload)
+        self.assertEqual(request[1:5], (0, 0, 2, 0))
+        piece.set_block_hashes(b''.join(block_hashes(self.big[:2 ** 15])))
+
+        piece.download(0, self.big[:BLOCK_LENGTH], 'good')
+        bad = bytes([self.big[BLOCK_LENGTH] ^ 1]) + self.big[BLOCK_LENGTH + 1:2 ** 15]
+        with self.assertRaises(BlockHashError) as raised:
+            piece.download(BLOCK_LENGTH, bad, 'bad')
+        self.assertEqual((raised.exception.offset, raised.exception.source), (BLOCK_LENGTH, 'bad'))
+        self.assertEqual(piece.bytes_downloaded, BLOCK_LENGTH, 'The good block is kept')
+        piece.download(BLOCK_LENGTH, self.big[BLOCK_LENGTH:2 ** 15], 'good')
+        self.assertTrue(piece.completed)
+
+    def test_late_hashes_find_bad_blocks(self):
+        t = Torrent(write_v2_torrent(self.directory.name, self.files))
+        piece = next(merkle_piece_factory(t.piece_layers))
+        piece.download(0, bytes(BLOCK_LENGTH), 'bad')
+        with self.assertRaises(PieceHashError):
+            piece.set_block_hashes(bytes(64))
+        self.assertEqual(piece.set_block_hashes(b''.join(block_hashes(self.big[:2 ** 15]))), [(0, 'bad')])
+        self.assertEqual(piece.bytes_downloaded, 0)
+
+    def test_whole_piece_checked_without_block_hashes(self):
+        t = Torrent(write_v2_torrent(self.directory.name, self.files))
+        pieces = list(merkle_piece_factory(t.piece_layers))
+        pieces[3].download(0, self.big[3 * 2 ** 15:])
+        self.assertTrue(pieces[3].completed)
+        self.assertEqual(pieces[3].take_data(), self.big[3 * 2 ** 15:] + bytes(2 ** 15 - 5000))
+        with self.assertRaises(PieceHashError):
+            pieces[4].download(0, bytes(20000))
+
+
+class MetainfoCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(1000)
+        self.path = write_torrent(self.directory.name, self.data)
+        self.cache = MetainfoCache(os.path.join(self.directory.name, 'cache'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_cached_load_matches_parse(self):
+        parsed = Torrent(self.path, self.cache)
+        self.assertIsNotNone(parsed.info)
+        cached = Torrent(self.path, self.cache)
+        self.assertIsNone(cached.info, 'Second load should come from the cache')
+        for attr in ('info_hash', 'announce', 'length', 'piece_length', 'target_file_name', 'files',
+                     'num_pieces'):
+            self.assertEqual(getattr(parsed, attr), getattr(cached, attr), attr)
+        self.assertEqual(bytes(parsed.piece_hashes.blob), bytes(cached.piece_hashes.blob))
+
+    def test_cached_v2_load_matches_parse(self):
+        path = write_v2_torrent(self.directory.name, [('a.bin', os.urandom(70000)), ('b.bin', os.urandom(100))],
+                                hybrid=True)
+        parsed = Torrent(path, self.cache)
+        cached = Torrent(path, self.cache)
+        self.assertIsNone(cached.info, 'Second load should come from the cache')
+        for attr in ('info_hash', 'info_hash_v2', 'meta_version', 'files', 'num_pieces'):
+            self.assertEqual(getattr(parsed, attr), getattr(cached, attr), attr)
+        self.assertEqual([(p.hash, p.width) for p in parsed.piece_layers],
+                         [(bytes(p.hash), p.width) for p in cached.piece_layers])
+
+    def test_changed_file_invalidates(self):
+        Torrent(self.path, self.cache)
+        self.data = os.urandom(2000)
+        stat = os.stat(self.path)
+        write_torrent(self.directory.name, self.data)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        t = Torrent(self.path, self.cache)
+        self.assertIsNotNone(t.info, 'Changed file should be parsed again')
+        self.assertEqual(t.length, 2000)
+
+    def test_corrupt_entry_is_discarded(self):
+        Torrent(self.path, self.cache)
+        entry_path = self.cache._entry_path(os.path.abspath(self.path))
+        with open(entry_path, 'wb') as entry_file:
+            entry_file.write(b'garbage')
+        self.assertIsNone(self.cache.get(self.path))
+        self.assertFalse(os.path.exists(entry_path))
+
+    def rewrite_entry(self, change_header, blob_length):
+        """Rewrite the torrent's entry with a changed header and its blob cut
+        to blob_length bytes."""
+        entry_path = self.cache._entry_path(os.path.abspath(self.path))
+        with open(entry_path, 'rb') as entry_file:
+            data = entry_file.read()
+        header_length = unpack('!I', data[4:8])[0]
+        header = json.loads(data[8:8 + header_length])
+        change_header(header)
+        header_bytes = json.dumps(header).encode('utf-8')
+        with open(entry_path, 'wb') as entry_file:
+            entry_file.write(data[:4] + pack('!I', len(header_bytes)) + header_bytes
+                             + data[8 + header_length:8 + header_length + blob_length])
+        return entry_path
+
+    def test_damaged_entries_fall_back_to_parsing(self):
+        for change_header, blob_length in ((lambda header: None, 30),
+                                           (lambda header: header.pop('announce'), 640),
+                                           (lambda header: header.update(pieces_length=30), 30)):
+            Torrent(self.path, self.cache)
+            entry_path = self.rewrite_entry(change_header, blob_length)
+            self.assertIsNone(self.cache.get(self.path))
+            self.assertFalse(os.path.exists(entry_path))
+
+            Torrent(self.path, self.cache)
+            self.rewrite_entry(change_header, blob_length)
+            torrent = Torrent(self.path, self.cache)
+            self.assertIsNotNone(torrent.info, 'A damaged entry should be parsed around')
+            self.assertEqual(torrent.num_pieces, 32)
+
+    def test_failed_put_is_ignored(self):
+        with unittest.mock.patch('tempfile.mkstemp', side_effect=OSError('No space left on device')):
+            torrent = Torrent(self.path, self.cache)
+        self.assertEqual(torrent.num_pieces, 32)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 2500
+        paths = []
+        for i in range(3):
+            directory = os.path.join(self.directory.name, str(i))
+            os.mkdir(directory)
+            paths.append(write_torrent(directory, os.urandom(1000)))
+            Torrent(paths[-1], self.cache)
+            entry_path = self.cache._entry_path(os.path.abspath(paths[-1]))
+            os.utime(entry_path, ns=(i * 10 ** 9, i * 10 ** 9))
+        self.cache._evict()
+        self.assertIsNone(self.cache.get(paths[0]))
+        self.assertIsNotNone(self.cache.get(paths[2]))
+        self.assertLessEqual(self.cache.size, 2500)
+
+
+class PeerCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.now = 1000000.0
+        self.cache = self.make_cache()
+        self.info_hash = os.urandom(20)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_cache(self, **options):
+        return PeerCache(self.directory.name, clock=lambda: self.now, **options)
+
+    def test_best_peers_first(self):
+        self.cache.record_success(self.info_hash, '10.0.0.1', 6881, 'slow', 100.0)
+        self.now += 10
+        self.cache.record_success(self.info_hash, '10.0.0.2', 6881, 'fast', 5000.0)
+        self.cache.record_success(self.info_hash, '10.0.0.3', 6881, 'recent', 100.0)
+        self.assertEqual([peer['id'] for peer in self.cache.peers(self.info_hash)], ['fast', 'recent', 'slow'])
+        self.assertEqual(self.cache.peers(os.urandom(20)), [])
+
+    def test_survives_restart(self):
+        self.cache.record_success(self.info_hash, '10.0.0.1', 6881, 'peer', 100.0)
+        self.cache.save(self.info_hash)
+        self.assertEqual(self.make_cache().peers(self.info_hash), [{'ip': '10.0.0.1', 'port': 6881, 'id': 'peer'}])
+
+    def test_aging_and_failures(self):
+        cache = self.make_cache(max_age=60, max_failures=2)
+        cache.record_success(self.info_hash, '10.0.0.1', 6881, 'old', 100.0)
+        self.now += 30
+        cache.record_success(self.info_hash, '10.0.0.2', 6881, 'failing', 100.0)
+        cache.record_failure(self.info_hash, '10.0.0.2', 6881)
+        cache.record_failure(self.info_hash, '10.0.0.9', 6881)
+        self.assertEqual(len(cache.peers(self.info_hash)), 2, 'Unknown peers are not added by failures')
+        cache.record_failure(self.info_hash, '10.0.0.2', 6881)
+        self.assertEqual([peer['id'] for peer in cache.peers(self.info_hash)], ['old'])
+        self.now += 31
+        self.assertEqual(cache.peers(self.info_hash), [])
+
+    def test_eviction(self):
+        cache = self.make_cache(max_peers=2)
+        for i in range(4):
+            cache.record_success(self.info_hash, '10.0.0.{}'.format(i), 6881, str(i), float(i))
+        self.assertEqual([peer['id'] for peer in cache.peers(self.info_hash)], ['3', '2'])
+
+        cache = self.make_cache(max_bytes=1)
+        cache.record_success(self.info_hash, '10.0.0.1', 6881, 'peer', 100.0)
+        cache.save(self.info_hash)
+        self.assertEqual(os.listdir(self.directory.name), [], 'Files past max_bytes are removed')
+
+    def test_damaged_file(self):
+        with open(os.path.join(self.directory.name, self.info_hash.hex() + '.peers'), 'w') as entry_file:
+            entry_file.write('{"version": 1, "peers": [{"ip"')
+        self.assertEqual(self.cache.peers(self.info_hash), [])
+
+
+class SessionTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(3):
+            directory = os.path.join(self.directory.name, str(i))
+            os.mkdir(directory)
+            self.paths.append(write_torrent(directory, os.urandom(100)))
+        self.session = Session(max_active_torrents=2, max_connections=5)
+        self.started = []
+        self.session._start_client = lambda info_hash, client: self.started.append(info_hash)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_scheduler_caps_active_torrents(self):
+        hashes = [self.session.add_torrent(path) for path in self.paths]
+        with unittest.mock.patch('session.reactor') as mock_reactor:
+            mock_reactor.callInThread = lambda f, *args: f(*args)
+            self.session._schedule()
+            self.assertEqual(self.started, hashes[:2])
+            self.assertIsNone(self.session.client_for(hashes[2]))
+            self.assertIs(self.session.client_for(hashes[0]), self.session._clients[hashes[0]])
+
+            self.session._finish(hashes[0], TorrentState.COMPLETE)
+            self.assertEqual(self.started, hashes)
+            self.assertIsNone(self.session.client_for(hashes[0]))
+            states = [status['state'] for status in self.session.status()]
+            self.assertEqual(states, ['complete', 'active', 'active'])
+
+    def test_duplicate_torrent(self):
+        self.session.add_torrent(self.paths[0])
+        with self.assertRaises(SessionError):
+            self.session.add_torrent(self.paths[0])
+
+    def test_metrics_keyed_by_info_hash(self):
+        hashes = [self.session.add_torrent(path) for path in self.paths]
+        self.assertEqual(sorted(self.session.metrics()), sorted(info_hash.hex() for info_hash in hashes))
+
+    def test_listens_on_every_interface(self):
+        with unittest.mock.patch('session.listen_for_peers') as listen:
+            self.session._listen()
+        listen.assert_called_once_with(self.session.client_for, constants.LISTENING_PORT, '')
+        args = dripdrop.build_parser().parse_args(['download', self.paths[0]])
+        self.assertEqual(args.listen_interface, '')
+
+    def test_connection_limiter(self):
+        limiter = ConnectionLimiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertEqual(limiter.available, 1)
+
+
+class CommandLineTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(100)
+        self.path = write_torrent(self.directory.name, self.data)
+        self.target = os.path.join(self.directory.name, 'target.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_command(self, *args):
+        """Run dripdrop's main with --json, returning the exit code and the
+        objects written."""
+        out = io.StringIO()
+        with unittest.mock.patch('sys.stdout', out):
+            code = dripdrop.main(list(args) + ['--output-dir', self.directory.name, '--json'])
+        return code, [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_status(self):
+        code, reports = self.run_command('status', self.path)
+        self.assertEqual(code, dripdrop.EXIT_OK)
+        self.assertEqual(reports[0]['num_pieces'], 4)
+        self.assertIsNone(reports[0]['on_disk'])
+
+        code, reports = self.run_command('status', self.path, os.path.join(self.directory.name, 'missing.torrent'))
+        self.assertEqual(code, dripdrop.EXIT_FAILED)
+        self.assertEqual([report['event'] for report in reports], ['error', 'status'])
+
+    def test_recheck(self):
+        code, reports = self.run_command('recheck', self.path)
+        self.assertEqual(code, dripdrop.EXIT_INCOMPLETE)
+        self.assertEqual(reports[0]['verified'], 0)
+
+        with open(self.target, 'wb') as target_file:
+            target_file.write(self.data)
+        code, reports = self.run_command('recheck', self.path)
+        self.assertEqual(code, dripdrop.EXIT_OK)
+        self.assertTrue(reports[0]['complete'])
+
+        with open(self.target, 'r+b') as target_file:
+            target_file.seek(40)
+            target_file.write(bytes([self.data[40] ^ 1]))
+        self.assertEqual(dripdrop.verify_pieces(Torrent(self.path), self.target), [0, 2, 3])
+
+    def test_recheck_v2(self):
+        files = [('a.bin', os.urandom(2 ** 15 + 100)), ('b.bin', os.urandom(5000))]
+        path = write_v2_torrent(self.directory.name, files)
+        # Files start on piece boundaries.
+        with open(os.path.join(self.directory.name, 'multi'), 'wb') as target_file:
+            target_file.write(files[0][1] + bytes(2 ** 15 - 100) + files[1][1])
+        self.assertEqual(dripdrop.verify_pieces(Torrent(path), os.path.join(self.directory.name, 'multi')),
+                         [0, 1, 2])
+
+    def test_download_without_torrents(self):
+        code, reports = self.run_command('download', os.path.join(self.directory.name, 'missing.torrent'))
+        self.assertEqual(code, dripdrop.EXIT_FAILED)
+        self.assertEqual(reports[0]['event'], 'error')
+
+    def test_status_does_not_import_twisted(self):
+        check = ('import sys, dripdrop; dripdrop.main(["status", sys.argv[1]]); '
+                 'sys.exit("twisted" in sys.modules or "requests" in sys.modules)')
+        result = subprocess.run([sys.executable, '-c', check, self.path], cwd=os.path.dirname(dripdrop.__file__),
+                                stdout=subprocess.DEVNULL)
+        self.assertEqual(result.returncode, 0)
+
+
+class RateLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.clock = lambda: self.now
+
+    def test_unlimited(self):
+        bucket = TokenBucket()
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+
+    def test_debt_and_refill(self):
+        bucket = TokenBucket(1000, burst=500, clock=self.clock)
+        self.assertEqual(bucket.consume(500), 0)
+        self.assertAlmostEqual(bucket.consume(1000), 1.0)
+        self.now = 1.0
+        self.assertEqual(bucket.consume(0), 0)
+        self.now = 10.0
+        # The bucket never holds more than its burst.
+        self.assertAlmostEqual(bucket.consume(1000), 0.5)
+
+    def test_hierarchy(self):
+        session_limits = RateLimits(download_rate=1000)
+        session_limits.download._clock = self.clock
+        session_limits.download.set_rate(1000, burst=1000)
+        peer_limits = session_limits.child().child()
+        self.assertEqual(peer_limits.download.consume(1000), 0)
+        self.assertAlmostEqual(peer_limits.download.consume(2000), 2.0)
+        self.assertEqual(peer_limits.upload.consume(10 ** 9), 0)
+
+
+class MessageQueueTests(unittest.TestCase):
+    def test_water_marks(self):
+        events = []
+        queue = MessageQueue(high_water=4, low_water=1)
+        queue.on_high = lambda: events.append('high')
+        queue.on_low = lambda: events.append('low')
+        for i in range(6):
+            queue.put(i)
+        self.assertEqual(events, ['high'])
+        for _ in range(4):
+            queue.get()
+        self.assertEqual(events, ['high'])
+        queue.get()
+        self.assertEqual(events, ['high', 'low'])
+        stats = queue.stats()
+        self.assertEqual(stats['depth'], 1)
+        self.assertEqual(stats['peak'], 6)
+        self.assertFalse(stats['above_high_water'])
+
+    def test_unbounded(self):
+        queue = MessageQueue()
+        for i in range(1000):
+            queue.put(i)
+        self.assertFalse(queue.above_high_water)
+
+
+class PeerConnectionTests(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet.testing import StringTransport
+        torrent = SimpleNamespace(info_hash=b'\x01' * 20, num_pieces=16)
+        self.peer = Peer('-DD00011234567891234', '127.0.0.1', 8201, torrent)
+        self.patcher = unittest.mock.patch('peer.reactor')
+        self.mock_reactor = self.patcher.start()
+        self.mock_reactor.callFromThread = lambda f, *args: f(*args)
+        self.peer.subscribe_for_messages_to_peer = lambda callback: None
+        self.connection = PeerConnection(SimpleNamespace(peer=self.peer))
+        self.transport = StringTransport()
+        self.connection.makeConnection(self.transport)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_inbound_backpressure(self):
+        unchoke = b'\x00\x00\x00\x01\x01'
+        high_water = self.peer.messages_from_peer.high_water
+        self.connection.dataReceived(unchoke * high_water)
+        self.assertEqual(self.transport.producerState, 'paused')
+        while self.peer.messages_from_peer.qsize() > self.peer.messages_from_peer.low_water:
+            self.assertEqual(self.transport.producerState, 'paused')
+            self.peer.messages_from_peer.get()
+        self.assertEqual(self.transport.producerState, 'producing')
+
+    def test_writes_coalesce_per_tick(self):
+        scheduled = []
+        self.mock_reactor.callFromThread = lambda f, *args: scheduled.append((f, args))
+        self.transport.writeSequence = unittest.mock.Mock(wraps=self.transport.writeSequence)
+        for offset in range(0, 5 * 2 ** 14, 2 ** 14):
+            self.connection.send_message(block_message(MessageType.REQUEST, 0, offset, 2 ** 14))
+        self.assertEqual(len(scheduled), 1, 'Only one flush should be scheduled per tick')
+        f, args = scheduled.pop()
+        f(*args)
+        self.assertEqual(self.transport.writeSequence.call_count, 1)
+        self.assertEqual(len(list(MessageParser()(self.transport.value()))), 5)
+
+    def test_pause_reasons_combine(self):
+        self.connection.pause_reading('rate')
+        self.connection.pause_reading('inbound')
+        self.connection.resume_reading('rate')
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.connection.resume_reading('inbound')
+        self.assertEqual(self.transport.producerState, 'producing')
+
+    def test_cancel_drops_queued_block(self):
+        outbound = self.peer.messages_to_peer
+        for offset in (0, 2 ** 14):
+            self.peer.message_peer(PieceMessage.from_block(3, offset, bytes(2 ** 14)))
+        self.peer.handle_messages(block_message(MessageType.CANCEL, 3, 0, 2 ** 14).to_bytes())
+        self.peer.handle_messages(block_message(MessageType.CANCEL, 4, 0, 2 ** 14).to_bytes())
+        self.assertEqual([(m.index, m.offset) for m in drain(outbound)], [(3, 2 ** 14)])
+        outbound.task_done()
+        self.assertEqual(outbound.unfinished_tasks, 0)
+
+    def test_queues_pause_independently(self):
+        unchoke = b'\x00\x00\x00\x01\x01'
+        inbound, outbound = self.peer.messages_from_peer, self.peer.messages_to_peer
+        for _ in range(outbound.high_water):
+            outbound.put(Message.factory(MessageType.KEEP_ALIVE))
+        self.connection.dataReceived(unchoke * inbound.high_water)
+        self.assertEqual(self.transport.producerState, 'paused')
+        while inbound.qsize() > inbound.low_water:
+            inbound.get()
+        self.assertEqual(self.transport.producerState, 'paused', 'The outbound queue is still full')
+        while outbound.qsize() > outbound.low_water:
+            outbound.get()
+        self.assertEqual(self.transport.producerState, 'producing')
+
+
+class TimerWheelTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.fired = []
+        self.wheel = TimerWheel(tick=1.0, slots=8, clock=lambda: self.now)
+
+    def advance_to(self, now):
+        self.now = now
+        self.wheel.advance()
+
+    def test_fires_after_delay(self):
+        self.wheel.schedule(2.5, self.fired.append, 'a')
+        self.advance_to(2.0)
+        self.assertEqual(self.fired, [])
+        self.advance_to(3.0)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_multiple_rounds(self):
+        self.wheel.schedule(20, self.fired.append, 'late')
+        self.wheel.schedule(4, self.fired.append, 'early')
+        self.advance_to(8)
+        self.assertEqual(self.fired, ['early'])
+        self.advance_to(19)
+        self.assertEqual(self.fired, ['early'])
+        self.advance_to(20)
+        self.assertEqual(self.fired, ['early', 'late'])
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(1, self.fired.append, 'a')
+        timer.cancel()
+        self.advance_to(5)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(len(self.wheel), 0)
+
+
+class MetricsTests(unittest.TestCase):
+    def test_rate_meter(self):
+        now = [100.0]
+        parent = RateMeter(window=4, clock=lambda: now[0])
+        meter = RateMeter(window=4, parent=parent, clock=lambda: now[0])
+        meter.add(400)
+        now[0] = 101.5
+        meter.add(400)
+        self.assertEqual(meter.rate(), 200)
+        self.assertEqual(parent.total, 800)
+        now[0] = 104.0
+        self.assertEqual(meter.rate(), 100, 'The first second has left the window')
+        now[0] = 200.0
+        self.assertEqual(meter.rate(), 0)
+        self.assertEqual(meter.total, 800)
+
+    def test_histogram(self):
+        histogram = Histogram([1, 5])
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'], [(1, 2), (5, 3), ('+Inf', 4)])
+        self.assertEqual(snapshot['count'], 4)
+
+    def test_render_prometheus(self):
+        histogram = Histogram([1]).snapshot()
+        snapshot = {
+            'downloaded_bytes': 10, 'uploaded_bytes': 0, 'download_rate_bytes': 0.5, 'upload_rate_bytes': 0,
+            'wasted_bytes': 0, 'hash_failures': 1, 'connected_peers': 1, 'inbound_queue_depth': 0,
+            'read_cache_hits': 3, 'read_cache_misses': 1,
+            'request_rtt': histogram, 'piece_latency': histogram,
+            'memory': {'categories': {'pieces': 2 ** 18, 'queues': 0}},
+            'peers': {'Peer "a"': {'download_rate_bytes': 0.5, 'upload_rate_bytes': 0}},
+        }
+        text = render_prometheus({'ubuntu': snapshot})
+        self.assertIn('dripdrop_downloaded_bytes_total{torrent="ubuntu"} 10', text)
+        self.assertIn('dripdrop_read_cache_hits_total{torrent="ubuntu"} 3', text)
+        self.assertIn('dripdrop_request_rtt_seconds_bucket{torrent="ubuntu",le="+Inf"} 0', text)
+        self.assertIn('dripdrop_peer_download_rate_bytes{torrent="ubuntu",peer="Peer \\"a\\""} 0.5', text)
+        self.assertIn('dripdrop_memory_used_bytes{torrent="ubuntu",category="pieces"} 262144', text)
+
+
+class MemoryBudgetTests(unittest.TestCase):
+    def test_accounts(self):
+        budget = MemoryBudget(1000)
+        pieces, queues = budget.account('pieces'), budget.account('queues')
+        pieces.set(300)
+        queues.add(200)
+        queues.add(-50)
+        self.assertEqual(budget.used, 450)
+        pieces.close()
+        self.assertTrue(pieces.closed)
+        pieces.set(100)
+        usage = budget.usage()
+        self.assertEqual(usage['categories']['pieces'], 0)
+        self.assertEqual((usage['used'], usage['peak']), (150, 500))
+        with self.assertRaises(ValueError):
+            budget.account('heap')
+
+    def test_throttle(self):
+        budget = MemoryBudget(1000, throttle_at=0.5)
+        account = budget.account('pieces')
+        self.assertTrue(budget.has_room(500))
+        self.assertFalse(budget.has_room(501))
+        self.assertEqual(budget.request_depth(8), 8)
+        account.set(750)
+        self.assertTrue(budget.throttled)
+        self.assertEqual(budget.request_depth(8), 4)
+        account.set(2000)
+        self.assertEqual(budget.request_depth(8), 1)
+
+        unlimited = MemoryBudget(None)
+        unlimited.account('pieces').set(10 ** 12)
+        self.assertTrue(unlimited.has_room(10 ** 12))
+        self.assertFalse(unlimited.throttled)
+
+    def test_peer_buffers(self):
+        budget = MemoryBudget()
+        peer = Peer('-DD0001-000000000000', '127.0.0.1', 7000, SimpleNamespace(info_hash=bytes(20)), memory=budget)
+        peer.message_peer(block_message(MessageType.REQUEST, 0, 0, 2 ** 14))
+        peer.handle_messages(pack('!IBII', 2 ** 14 + 9, MessageType.PIECE.value, 0, 0) + bytes(100))
+        self.assertEqual(budget.usage()['categories'], {'pieces': 0, 'parsers': 113, 'queues': 12, 'storage': 0})
+        peer.messages_to_peer.get_nowait()
+        self.assertEqual(budget.usage()['categories']['queues'], 0)
+        peer.connection_lost()
+        self.assertEqual(budget.used, 0)
+
+
+def drain(queue):
+    """Return everything waiting in a queue."""
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+class ClientDownloadTests(unittest.TestCase):
+    """Drive a Client's piece and request logic with unconnected peers."""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(2 ** 16 + 100)
+        path = write_torrent(self.directory.name, self.data, piece_length=2 ** 15)
+        self.completed = []
+        self.client = Client(on_complete=self.completed.append, timer_wheel=unittest.mock.Mock(),
+                             download_directory=self.directory.name)
+        self.client.add_torrent(path)
+        self.peers = [self.add_peer(i) for i in range(2)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def add_peer(self, number):
+        peer = Peer('-DD0001-00000000000{}'.format(number), '127.0.0.1', 7000 + number, self.client.torrent)
+        peer.hands_shook = True
+        peer.is_choking = False
+        peer.pieces = set(range(self.client.torrent.num_pieces))
+        self.client._peers.append(peer)
+        return peer
+
+    def deliver(self, peer, index, offset, length):
+        start = index * 2 ** 15 + offset
+        block = self.data[start:start + length]
+        self.client.peer_message_receiver(peer)(PieceMessage.from_block(index, offset, block))
+
+    def test_pipelined_download(self):
+        receiver = self.client.peer_message_receiver(self.peers[0])
+        receiver(Message.factory(MessageType.UNCHOKE))
+        while not self.client.complete:
+            requests = [m for m in drain(self.peers[0].messages_to_peer) if m.type == MessageType.REQUEST]
+            self.assertTrue(requests, 'Peer should always have requests outstanding')
+            for request in requests:
+                self.deliver(self.peers[0], *unpack('!III', request.payload))
+        self.assertEqual(self.completed, [self.client])
+        self.assertEqual(self.client.num_completed_pieces, 3)
+        with open(os.path.join(self.directory.name, 'target.bin'), 'rb') as target_file:
+            self.assertEqual(target_file.read(), self.data)
+
+        snapshot = self.client.metrics_snapshot()
+        self.assertEqual(snapshot['request_rtt']['count'], 5)
+        self.assertEqual(snapshot['piece_latency']['count'], 3)
+        self.assertEqual(snapshot['wasted_bytes'], 0)
+
+    def test_memory_budget_throttles_new_pieces(self):
+        self.client.memory = MemoryBudget(40000, throttle_at=1.0)
+        first, second = self.peers
+        self.client.peer_message_receiver(first)(Message.factory(MessageType.UNCHOKE))
+        piece = first.piece
+        self.deliver(first, piece.index, 0, 2 ** 14)
+        self.assertEqual(self.client.memory.usage()['categories']['pieces'], 2 ** 14)
+
+        # Another piece would pass the budget.
+        self.client.peer_message_receiver(second)(Message.factory(MessageType.UNCHOKE))
+        self.assertIsNone(second.piece)
+
+        # Once the first piece is done nothing is in progress, so the waiting
+        # peer may start one even though the write cache still holds it.
+        self.deliver(first, piece.index, 2 ** 14, 2 ** 14)
+        self.assertEqual(self.client.memory.usage()['categories'], {'pieces': 0, 'parsers': 0, 'queues': 0,
+                                                                    'storage': 2 ** 15})
+        self.assertIsNotNone(second.piece)
+        self.assertIsNone(first.piece)
+
+    def test_uploads_stored_pieces(self):
+        downloader, uploader = self.peers
+        self.client.peer_message_receiver(downloader)(Message.factory(MessageType.UNCHOKE))
+        piece = downloader.piece
+        drain(downloader.messages_to_peer)
+        self.deliver(downloader, piece.index, 0, 2 ** 14)
+        self.deliver(downloader, piece.index, 2 ** 14, 2 ** 14)
+        haves = [m for m in drain(uploader.messages_to_peer) if m.type == MessageType.HAVE]
+        self.assertEqual([unpack('!I', m.payload)[0] for m in haves], [piece.index])
+
+        receiver = self.client.peer_message_receiver(uploader)
+        request = block_message(MessageType.REQUEST, piece.index, 2 ** 14, 100)
+        receiver(request)
+        self.assertNotIn(MessageType.PIECE, [m.type for m in drain(uploader.messages_to_peer)],
+                         'Choked peers are not served')
+        receiver(Message.factory(MessageType.INTERESTED))
+        receiver(request)
+        receiver(block_message(MessageType.REQUEST, (piece.index + 1) % 3, 0, 100))
+        sent = drain(uploader.messages_to_peer)
+        self.assertEqual([m.type for m in sent if m.type != MessageType.REQUEST],
+                         [MessageType.UNCHOKE, MessageType.PIECE])
+        block = [m for m in sent if m.type == MessageType.PIECE][0]
+        start = piece.index * 2 ** 15 + 2 ** 14
+        self.assertEqual(block.payload, self.data[start:start + 100])
+
+        # Requests handled after the client stops don't touch the closed storage.
+        self.client.stop()
+        receiver(request)
+        self.assertNotIn(MessageType.PIECE, [getattr(m, 'type', None) for m in drain(uploader.messages_to_peer)])
+
+    def test_flush_after_stop(self):
+        storage = self.client.storage
+        self.client.stop()
+        self.assertTrue(storage.closed)
+        with unittest.mock.patch.object(storage, 'flush_expired') as flush_expired:
+            self.client._flush_expired()
+        flush_expired.assert_not_called()
+
+    def test_waiting_peers_take_released_upload_slots(self):
+        first, second = self.peers
+        interested = Message.factory(MessageType.INTERESTED)
+        with unittest.mock.patch('constants.UPLOAD_SLOTS', 1):
+            self.client.peer_message_receiver(first)(interested)
+            self.client.peer_message_receiver(second)(interested)
+            self.assertFalse(first.choked)
+            self.assertTrue(second.choked, 'Only one upload slot')
+
+            self.client.peer_message_receiver(first)(Message.factory(MessageType.UNINTERESTED))
+            self.assertFalse(second.choked, 'The slot is passed on when the peer loses interest')
+
+            self.client.peer_message_receiver(first)(interested)
+            self.assertTrue(first.choked)
+            self.client._handle_peer_disconnect(second, None)
+            self.assertFalse(first.choked, 'The slot is passed on when the peer disconnects')
+
+    def test_accept_peer_respects_limits(self):
+        limiter = ConnectionLimiter(1)
+        self.client._connection_limiter = limiter
+        self.client.max_connections = 4
+        peer = self.client.accept_peer('10.0.0.7', 51413)
+        self.addCleanup(peer.connection_lost)
+        self.assertIn(peer, self.client._peers)
+        self.assertEqual(drain(peer.messages_to_peer)[0].type, MessageType.HANDSHAKE)
+        self.assertIsNone(self.client.accept_peer('10.0.0.8', 51413), 'Global limit reached')
+        limiter.release()
+        self.client.max_connections = 3
+        self.assertIsNone(self.client.accept_peer('10.0.0.8', 51413), 'Client limit reached')
+
+    def test_greets_fast_peers(self):
+        peer = self.peers[0]
+        peer.fast = True
+        self.client.peer_message_receiver(peer)(get_handshake(peer.peer_id, self.client.torrent.info_hash))
+        sent = drain(peer.messages_to_peer)
+        self.assertEqual(sent[0].type, MessageType.HAVE_NONE)
+        allowed = {unpack('!I', m.payload)[0] for m in sent if m.type == MessageType.ALLOWED_FAST}
+        self.assertEqual(allowed, set(range(3)), 'A torrent this small is allowed whole')
+        self.assertEqual(peer.granted_fast, allowed)
+
+    def test_reject_releases_piece(self):
+        rejecter, other = self.peers
+        rejecter.fast = True
+        other.is_choking = True
+        receiver = self.client.peer_message_receiver(rejecter)
+        receiver(Message.factory(MessageType.UNCHOKE))
+        piece = rejecter.piece
+        drain(rejecter.messages_to_peer)
+        rejecter.is_choking = True
+        receiver(Message.factory(MessageType.CHOKE))
+        self.assertIs(rejecter.piece, piece, 'A fast peer rejects requests rather than dropping them on choke')
+
+        receiver(block_message(MessageType.REJECT, piece.index, 0, 2 ** 14))
+        self.assertIsNone(rejecter.piece)
+        self.assertIn(piece, self.client._released_pieces)
+        cancels = [unpack('!III', m.payload) for m in drain(rejecter.messages_to_peer) if m.type == MessageType.CANCEL]
+        self.assertEqual(cancels, [(piece.index, 2 ** 14, 2 ** 14)])
+
+    def test_allowed_fast_requests_while_choked(self):
+        peer = self.peers[0]
+        peer.fast = True
+        peer.is_choking = True
+        receiver = self.client.peer_message_receiver(peer)
+        receiver(Message.factory(MessageType.UNCHOKE))
+        self.assertEqual([m.type for m in drain(peer.messages_to_peer)], [MessageType.INTERESTED])
+
+        peer.allowed_fast.add(2)
+        receiver(Message(MessageType.ALLOWED_FAST, b'\x00\x00\x00\x02'))
+        requests = [unpack('!III', m.payload) for m in drain(peer.messages_to_peer) if m.type == MessageType.REQUEST]
+        self.assertEqual({index for index, _, _ in requests}, {2})
+
+    def test_warm_start_dials_cached_peers(self):
+        cache = PeerCache(os.path.join(self.directory.name, 'peers'))
+        cache.record_success(self.client.info_hash, '10.0.0.5', 6881, '-XX0001-000000000005', 1000.0)
+        self.client._peer_cache = cache
+        self.client._peers = []
+        dialed = []
+        with unittest.mock.patch.object(Peer, 'connect', lambda peer, peer_id: dialed.append(peer.ip)), \
+                unittest.mock.patch.object(Tracker, 'request', side_effect=TrackerError('down')):
+            self.client.start_torrent()
+        self.assertEqual(dialed, ['10.0.0.5'], 'Cached peers are dialed even with the tracker down')
+
+        peer = self.client._peers[0]
+        peer.connected_at = time.monotonic() - 2
+        peer.download_meter.add(4000)
+        self.client.stop()
+        cached = PeerCache(cache.directory).peers(self.client.info_hash)
+        self.assertEqual([(p['ip'], p['port']) for p in cached], [('10.0.0.5', 6881)])
+
+    def test_tracker_peers_are_not_dialed_twice(self):
+        self.client._peers = []
+        self.client.max_connections = 0
+        self.client._try_peers([{'ip': '10.0.0.5', 'port': 6881}])
+        self.client._try_peers([{'ip': '10.0.0.5', 'port': 6881}, {'ip': '10.0.0.6', 'port': 6881}])
+        self.assertEqual([entry['ip'] for entry in self.client._candidate_peers], ['10.0.0.5', '10.0.0.6'])
+
+    def test_request_timeout_reassigns_piece(self):
+        slow, fast = self.peers
+        self.client.peer_message_receiver(slow)(Message.factory(MessageType.UNCHOKE))
+        piece = slow.piece
+        drain(slow.messages_to_peer)
+        for key, (length, sent) in slow.outstanding_requests.items():
+            slow.outstanding_requests[key] = (length, sent - constants.REQUEST_TIMEOUT - 1)
+
+        self.client._check_peer_health(slow)
+        self.assertIsNone(slow.piece)
+        self.assertFalse(slow.outstanding_requests)
+        self.assertFalse(slow.snubbed, 'The peer sent a block recently, so is only slow')
+        cancels = [m for m in drain(slow.messages_to_peer) if m.type == MessageType.CANCEL]
+        self.assertEqual(len(cancels), 2)
+        self.assertIs(fast.piece, piece, 'Released piece should go to the idle peer')
+
+        # A late block from the slow peer is dropped rather than corrupting the piece.
+        self.deliver(slow, piece.index, 0, 2 ** 14)
+        self.assertEqual(piece.bytes_downloaded, 0)
+
+    def test_snubbed_peer(self):
+        peer = self.peers[0]
+        self.client.peer_message_receiver(peer)(Message.factory(MessageType.UNCHOKE))
+        peer.last_piece_received -= constants.SNUB_TIMEOUT + 1
+        for key, (length, sent) in peer.outstanding_requests.items():
+            peer.outstanding_requests[key] = (length, sent - constants.SNUB_TIMEOUT - 1)
+        # With the default timeouts, where the requests have timed out too.
+        self.client._check_peer_health(peer)
+        self.assertTrue(peer.snubbed)
+        self.assertIsNone(peer.piece)
+        self.client._fill_requests(peer)
+        self.assertIsNone(peer.piece, 'Snubbed peers are not given new work')
+
+    def snub(self, peer):
+        """Age the peer's requests and last block past SNUB_TIMEOUT, and
+        check its health."""
+        peer.last_piece_received -= constants.SNUB_TIMEOUT + 1
+        for key, (length, sent) in peer.outstanding_requests.items():
+            peer.outstanding_requests[key] = (length, sent - constants.SNUB_TIMEOUT - 1)
+        self.client._check_peer_health(peer)
+
+    def probe(self, peer):
+        """Let SNUB_BACKOFF pass, returning the requests of the probe."""
+        drain(peer.messages_to_peer)
+        peer.snubbed_at -= constants.SNUB_BACKOFF + 1
+        self.client._check_peer_health(peer)
+        self.assertFalse(peer.snubbed)
+        return [m for m in drain(peer.messages_to_peer) if m.type == MessageType.REQUEST]
+
+    def test_snubbed_peer_is_probed_and_recovers(self):
+        peer = self.peers[0]
+        self.client.peer_message_receiver(peer)(Message.factory(MessageType.UNCHOKE))
+        self.snub(peer)
+        requests = self.probe(peer)
+        self.assertEqual(len(requests), 1)
+        self.deliver(peer, *unpack('!III', requests[0].payload))
+        self.assertIsNone(peer.snubbed_at)
+        self.assertTrue(peer.outstanding_requests, 'A recovered peer is given work again')
+
+    def test_snubbed_peer_ignoring_probe_is_dropped(self):
+        peer = self.peers[0]
+        self.client.peer_message_receiver(peer)(Message.factory(MessageType.UNCHOKE))
+        self.snub(peer)
+        self.probe(peer)
+        self.snub(peer)
+        self.assertIn(MessageType.CLOSE, [getattr(m, 'type', None) for m in drain(peer.messages_to_peer)])
+        self.assertIsNone(peer.piece)
+
+    def test_keep_alive_and_timeout(self):
+        peer = self.peers[0]
+        peer.last_sent -= constants.KEEP_ALIVE_INTERVAL + 1
+        self.client._check_peer_health(peer)
+        self.assertEqual([m.type for m in drain(peer.messages_to_peer)], [MessageType.KEEP_ALIVE])
+
+        peer.last_received -= constants.PEER_TIMEOUT + 1
+        self.client._check_peer_health(peer)
+        self.assertEqual(drain(peer.messages_to_peer)[0].type, MessageType.CLOSE)
+
+    def test_starved_client_reannounces_then_fails(self):
+        failed = []
+        self.client._on_failed = lambda client, error: failed.append(error)
+        tracker = self.client._tracker = unittest.mock.Mock()
+        tracker.request.return_value = {'peers': []}
+        on_reactor = []
+        with unittest.mock.patch('client.reactor') as mock_reactor:
+            mock_reactor.callInThread = lambda f, *args: f(*args)
+            mock_reactor.callFromThread = lambda f, *args: on_reactor.append(f) or f(*args)
+            for peer in list(self.peers):
+                self.client._handle_peer_disconnect(peer, None)
+            self.client._timer_wheel.schedule.assert_called_with(constants.REANNOUNCE_DELAY,
+                                                                 self.client._reannounce)
+            self.client._reannounce()
+            tracker.request.assert_called_once_with(TrackerEvent.NONE, self.client.peer_id,
+                                                    constants.LISTENING_PORT)
+            self.assertIn(self.client._try_peers, on_reactor, 'New peers are added on the reactor')
+            self.assertFalse(failed)
+
+            self.client._starved_since -= constants.STARVED_TIMEOUT
+            self.client._reannounce()
+            self.assertEqual(tracker.request.call_count, 1)
+            self.assertIsInstance(failed[0], ClientError)
+
+    def test_v1_ignores_hash_messages(self):
+        peer = self.peers[0]
+        self.assertFalse(peer.offers_v2)
+        peer.shake_hands('-DD0001-000000000009')
+        self.assertFalse(parse_handshake(drain(peer.messages_to_peer)[0].to_bytes())['v2'])
+
+        receiver = self.client.peer_message_receiver(peer)
+        receiver(Message.factory(MessageType.UNCHOKE))
+        piece = peer.piece
+        receiver(hash_message(MessageType.HASHES, bytes(32), 0, 0, 2, 0, bytes(64)))
+        receiver(hash_message(MessageType.HASH_REJECT, bytes(32), 0, 0, 2, 0))
+        self.assertIs(peer.piece, piece)
+
+    def test_bad_hash_discards_piece(self):
+        peer = self.peers[0]
+        self.client.peer_message_receiver(peer)(Message.factory(MessageType.UNCHOKE))
+        piece = peer.piece
+        self.client.peer_message_receiver(peer)(PieceMessage.from_block(piece.index, 0, b'\x00' * 2 ** 14))
+        self.client.peer_message_receiver(peer)(PieceMessage.from_block(piece.index, 2 ** 14, b'\x00' * 2 ** 14))
+        self.assertFalse(piece.completed)
+        self.assertEqual(piece.bytes_downloaded, 0)
+        self.assertEqual(self.client.num_completed_pieces, 0)
+        self.assertEqual(self.client.metrics.hash_failures, 1)
+        self.assertEqual(self.client.metrics.wasted_bytes, 2 ** 15)
+
+
+class MerkleDownloadTests(unittest.TestCase):
+    """Drive a Client downloading a v2 torrent with unconnected peers."""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(2 ** 16 + 100)
+        self.leaves = block_hashes(self.data)
+        path = write_v2_torrent(self.directory.name, [('target.bin', self.data)])
+        self.client = Client(on_complete=lambda client: None, timer_wheel=unittest.mock.Mock(),
+                             download_directory=self.directory.name)
+        self.client.add_torrent(path)
+        self.peers = []
+        for number in range(2):
+            peer = Peer('-DD0001-00000000000{}'.format(number), '127.0.0.1', 7000 + number, self.client.torrent)
+            peer.hands_shook = True
+            peer.is_choking = False
+            peer.v2 = True
+            peer.pieces = set(range(self.client.torrent.num_pieces))
+            self.client._peers.append(peer)
+            self.peers.append(peer)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def answer(self, peer, messages):
+        """Answer the hash requests and block requests sent to the peer."""
+        receiver = self.client.peer_message_receiver(peer)
+        for message in messages:
+            if message.type == MessageType.HASH_REQUEST:
+                root, _, index, length, _, _ = parse_hash_message(message.payload)
+                hashes = self.leaves[index:index + length]
+                hashes += [bytes(32)] * (length - len(hashes))
+                receiver(hash_message(MessageType.HASHES, root, 0, index, length, 0, b''.join(hashes)))
+            elif message.type == MessageType.REQUEST:
+                index, offset, length = unpack('!III', message.payload)
+                start = index * 2 ** 15 + offset
+                receiver(PieceMessage.from_block(index, offset, self.data[start:start + length]))
+
+    def test_v2_download(self):
+        peer = self.peers[0]
+        self.client.peer_message_receiver(peer)(Message.factory(MessageType.UNCHOKE))
+        while not self.client.complete:
+            messages = drain(peer.messages_to_peer)
+            self.assertTrue(messages)
+            self.answer(peer, messages)
+        with open(os.path.join(self.directory.name, 'multi'), 'rb') as target_file:
+            self.assertEqual(target_file.read(), self.data)
+        self.assertEqual(self.client.metrics.hash_failures, 0)
+
+    def test_bad_block_is_blamed(self):
+        sender, other = self.peers
+        receiver = self.client.peer_message_receiver(sender)
+        receiver(Message.factory(MessageType.UNCHOKE))
+        piece = sender.piece
+        sent = drain(sender.messages_to_peer)
+        self.assertEqual(sent[0].type, MessageType.HASH_REQUEST)
+        self.answer(sender, sent[:1])
+        self.assertIsNotNone(piece.block_hashes)
+
+        start = piece.index * 2 ** 15
+        receiver(PieceMessage.from_block(piece.index, 0, self.data[start:start + BLOCK_LENGTH]))
+        receiver(PieceMessage.from_block(piece.index, BLOCK_LENGTH, bytes(BLOCK_LENGTH)))
+        self.assertEqual(self.client.metrics.hash_failures, 1)
+        self.assertEqual(sender.bad_blocks, 1)
+        self.assertEqual(piece.bytes_downloaded, BLOCK_LENGTH, 'Only the bad block is thrown away')
+        self.assertIs(other.piece, piece, 'The rest of the piece goes to another peer')
+        self.assertIsNot(sender.piece, piece)
+        requests = [unpack('!III', m.payload) for m in drain(other.messages_to_peer) if m.type == MessageType.REQUEST]
+        self.assertEqual(requests[0], (piece.index, BLOCK_LENGTH, BLOCK_LENGTH))
+
+    def test_hash_requests_are_rejected(self):
+        peer = self.peers[0]
+        request = hash_message(MessageType.HASH_REQUEST, bytes(32), 0, 0, 2, 0)
+        self.client.peer_message_receiver(peer)(request)
+        reject = drain(peer.messages_to_peer)[0]
+        self.assertEqual((reject.type, reject.payload), (MessageType.HASH_REJECT, request.payload))
+
+
+class TraceReplayTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(2 ** 16 + 100)
+        self.torrent_path = write_torrent(self.directory.name, self.data, piece_length=2 ** 15)
+        self.data_path = os.path.join(self.directory.name, 'data.bin')
+        with open(self.data_path, 'wb') as data_file:
+            data_file.write(self.data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record_download(self):
+        """Download the torrent from one simulated peer, tracing the
+        connection, and return the trace path."""
+        client = Client(on_complete=lambda client: None, timer_wheel=unittest.mock.Mock(),
+                        download_directory=self.directory.name)
+        client.add_torrent(self.torrent_path)
+        peer = Peer('-DD0001-000000000009', '10.0.0.9', 6881, client.torrent)
+        peer.trace = TraceWriter.for_peer(os.path.join(self.directory.name, 'traces'), peer)
+        client._peers.append(peer)
+        receiver = client.peer_message_receiver(peer)
+
+        def peer_sends(wire):
+            peer.handle_messages(wire)
+            for message in drain(peer.messages_from_peer):
+                if message is not MessageQueue.STOP:
+                    receiver(message)
+            sent = [m for m in drain(peer.messages_to_peer) if m is not MessageQueue.STOP]
+            for message in sent:
+                if message.type != MessageType.CLOSE:
+                    peer.trace.record(OUTBOUND, message)
+            return sent
+
+        peer_sends(get_handshake(peer.peer_id, client.torrent.info_hash).to_bytes())
+        peer_sends(Message(MessageType.BITFIELD, b'\xe0').to_bytes())
+        pending = peer_sends(Message.factory(MessageType.UNCHOKE).to_bytes())
+        while not client.complete:
+            requests = [m for m in pending if m.type == MessageType.REQUEST]
+            pending = []
+            for request in requests:
+                index, offset, length = unpack('!III', request.payload)
+                start = index * 2 ** 15 + offset
+                pending += peer_sends(PieceMessage.from_block(index, offset, self.data[start:start + length]).to_bytes())
+        peer.connection_lost()
+        flush_traces()
+        return peer.trace.path
+
+    def test_trace_has_no_payloads(self):
+        path = self.record_download()
+        header, records = read_trace(path)
+        self.assertEqual(header['ip'], '10.0.0.9')
+        self.assertLess(os.path.getsize(path), len(self.data) // 10)
+        pieces = [r for r in records if r[1] == INBOUND and r[2] == MessageType.PIECE]
+        self.assertEqual(sum(r[5] for r in pieces), len(self.data))
+
+    def test_replay_reproduces_requests(self):
+        path = self.record_download()
+        for data_path in (self.data_path, None):
+            result = replay(self.torrent_path, [path], data_path)
+            self.assertEqual(result.completed_pieces, 3)
+            self.assertEqual(result.divergences(), [])
+
+
+class ProfilingTests(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler(enabled=False)
+
+        @self.profiler.timed('work')
+        def work(value):
+            return value * 2
+        self.work = work
+
+    def test_disabled_records_nothing(self):
+        self.assertEqual(self.work(2), 4)
+        self.assertEqual(self.profiler.snapshot(), {})
+
+    def test_enabled_times_every_call(self):
+        self.profiler.enable()
+        for i in range(5):
+            self.work(i)
+        with self.profiler.timing('block'):
+            pass
+        snapshot = self.profiler.snapshot()
+        self.assertEqual(snapshot['work']['count'], 5)
+        self.assertEqual(snapshot['work']['calls'], 5)
+        self.assertEqual(snapshot['block']['count'], 1)
+
+    def test_sampling(self):
+        self.profiler.enable(sample_every=4)
+        for i in range(20):
+            self.work(i)
+        self.assertEqual(self.profiler.snapshot()['work']['count'], 5)
+        self.profiler.reset()
+        self.assertEqual(self.profiler.snapshot(), {})
+
+    def test_generator_timed_as_consumed(self):
+        @self.profiler.timed('steps')
+        def steps():
+            for i in range(2):
+                time.sleep(0.01)
+                yield i
+
+        self.profiler.enable()
+        generator = steps()
+        self.assertEqual(self.profiler.snapshot(), {}, 'Nothing runs until the generator is consumed')
+        for _ in generator:
+            # The consumer's own time is not the generator's.
+            time.sleep(0.05)
+        snapshot = self.profiler.snapshot()['steps']
+        self.assertEqual(snapshot['count'], 1)
+        self.assertGreaterEqual(snapshot['sum'], 0.02)
+        self.assertLess(snapshot['sum'], 0.05)
+
+    def test_stack_sampler_sees_other_threads(self):
+        finished = threading.Event()
+
+        def waiting_in_a_thread():
+            finished.wait()
+        thread = threading.Thread(target=waiting_in_a_thread)
+        thread.start()
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        time.sleep(0.05)
+        sampler.stop()
+        finished.set()
+        thread.join()
+        self.assertGreater(sampler.samples, 0)
+        self.assertTrue(any('waiting_in_a_thread' in stack for stack in sampler.stacks))
+
+
+class SimulatedSeederTests(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet.task import Clock
+        from twisted.internet.testing import StringTransport
+        self.clock = Clock()
+        self.patcher = unittest.mock.patch('simulate.reactor', self.clock)
+        self.patcher.start()
+        self.data = os.urandom(2 ** 16 + 100)
+        self.swarm = Swarm(self.data, piece_length=2 ** 15, latency=0.5)
+        self.seeder = SimulatedSeeder(self.swarm, '-SIM001-000000000000')
+        self.transport = StringTransport()
+        self.seeder.makeConnection(self.transport)
+        self.seeder.dataReceived(get_handshake('-DD0001-123456789013', self.swarm.info_hash).to_bytes())
+        self.parser = MessageParser()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def received(self):
+        data = self.transport.value()
+        self.transport.clear()
+        return data
+
+    def test_greeting_offers_every_piece(self):
+        data = self.received()
+        self.assertEqual(parse_handshake(data)['info_hash'], self.swarm.info_hash)
+        messages = list(self.parser(data[68:]))
+        self.assertEqual([m.type for m in messages], [MessageType.HAVE_ALL, MessageType.UNCHOKE])
+
+        from twisted.internet.testing import StringTransport
+        seeder = SimulatedSeeder(self.swarm, '-SIM001-000000000001')
+        transport = StringTransport()
+        seeder.makeConnection(transport)
+        seeder.dataReceived(get_handshake('-DD0001-123456789013', self.swarm.info_hash, bytes(8)).to_bytes())
+        messages = list(self.parser(transport.value()[68:]))
+        self.assertEqual([m.type for m in messages], [MessageType.BITFIELD, MessageType.UNCHOKE],
+                         'Peers without the Fast Extension get a bitfield')
+        self.assertEqual(messages[0].payload, b'\xe0')
+
+    def test_blocks_are_served_after_latency(self):
+        self.received()
+        self.seeder.dataReceived(block_message(MessageType.REQUEST, 2, 0, 100).to_bytes())
+        self.seeder.dataReceived(block_message(MessageType.REQUEST, 1, 0, 2 ** 14).to_bytes())
+        self.seeder.dataReceived(block_message(MessageType.CANCEL, 1, 0, 2 ** 14).to_bytes())
+        self.assertEqual(self.received(), b'')
+        self.clock.advance(0.5)
+        messages = list(self.parser(self.received()))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual((messages[0].index, messages[0].offset), (2, 0))
+        self.assertEqual(messages[0].payload, self.data[2 ** 16:])
+
+    def test_corrupt_blocks(self):
+        self.swarm.corrupt = 1.0
+        self.received()
+        self.seeder.dataReceived(block_message(MessageType.REQUEST, 0, 0, 2 ** 14).to_bytes())
+        self.clock.advance(0.5)
+        message = list(self.parser(self.received()))[0]
+        self.assertNotEqual(message.payload, self.data[:2 ** 14])
+        self.assertEqual(self.swarm.corrupted_blocks, 1)
+
+    def test_v2_seeders_send_hashes(self):
+        swarm = Swarm(self.data, piece_length=2 ** 15, v2=True)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        t = Torrent(swarm.write_torrent(directory.name))
+        self.assertEqual(t.info_hash, swarm.info_hash)
+        self.seeder.swarm = swarm
+        self.received()
+        piece = next(merkle_piece_factory(t.piece_layers))
+        self.seeder.dataReceived(piece.hash_request().to_bytes())
+        message = list(self.parser(self.received()))[0]
+        self.assertEqual(message.type, MessageType.HASHES)
+        self.assertEqual(piece.set_block_hashes(parse_hash_message(message.payload)[-1]), [])
+
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'target.bin')
+        self.data = os.urandom(200)
+        self.now = 0
+        self.storage = Storage(self.path, len(self.data), 16, cache_size=100, extent_size=64,
+                               flush_interval=5, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def write(self, index):
+        self.storage.write_piece(index, self.data[index * 16:(index + 1) * 16])
+
+    def on_disk(self):
+        with open(self.path, 'rb') as target_file:
+            return target_file.read()
+
+    def test_complete_extent_is_written_in_one_go(self):
+        for index in (3, 1, 0):
+            self.write(index)
+        self.assertEqual(self.storage.writes, 0)
+        self.write(2)
+        self.assertEqual(self.storage.writes, 1)
+        self.assertEqual(self.storage.cached_bytes, 0)
+        self.assertEqual(self.on_disk()[:64], self.data[:64])
+
+    def test_short_last_extent(self):
+        self.assertEqual(len(self.on_disk()), len(self.data))
+        self.write(12)
+        self.assertEqual(self.storage.writes, 1)
+        self.assertEqual(self.on_disk()[192:], self.data[192:])
+
+    def test_cache_budget_flushes_runs(self):
+        for index in (1, 5, 6, 9, 10, 11):
+            self.write(index)
+        self.assertEqual(self.storage.writes, 0)
+        self.write(2)
+        self.assertEqual(self.storage.writes, 3)
+        self.assertEqual(self.storage.cached_bytes, 0)
+        self.assertEqual(self.on_disk()[144:192], self.data[144:192])
+
+    def test_time_flush(self):
+        self.write(1)
+        self.storage.flush_expired()
+        self.assertEqual(self.storage.writes, 0)
+        self.now = 5
+        self.storage.flush_expired()
+        self.assertEqual(self.storage.writes, 1)
+
+    def test_time_flush_after_extent_write(self):
+        self.write(0)
+        self.now = 3
+        for index in (5, 1, 2, 3):
+            self.write(index)
+        self.assertEqual(self.storage.writes, 1, 'The first extent is written out')
+        self.now = 6
+        self.write(9)
+        self.assertEqual(self.storage.writes, 1, 'Piece 5 has not waited long enough')
+        self.assertEqual(self.storage.cached_bytes, 32)
+        self.now = 8
+        self.storage.flush_expired()
+        self.assertEqual(self.storage.cached_bytes, 0)
+
+    def test_read_piece(self):
+        self.write(9)
+        self.assertEqual(self.storage.read_piece(9), self.data[144:160])
+        self.storage.flush()
+        self.assertEqual(self.storage.read_piece(9), self.data[144:160])
+        self.write(12)
+        self.assertEqual(self.storage.read_piece(12), self.data[192:])
+
+    def test_fsync_after_write(self):
+        self.storage.fsync = True
+        with unittest.mock.patch('storage.os.fsync') as fsync:
+            self.write(1)
+            self.storage.close()
+        fsync.assert_called_once()
+
+    def test_bad_writes(self):
+        with self.assertRaises(StorageError):
+            self.storage.write_piece(0, b'short')
+        with self.assertRaises(StorageError):
+            self.storage.write_piece(13, bytes(8))
+        self.storage.close()
+        with self.assertRaises(StorageError):
+            self.write(0)
+
+
+class ReadCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(200)
+        self.storage = Storage(os.path.join(self.directory.name, 'target.bin'), len(self.data), 16)
+        for index in range(12):
+            self.storage.write_piece(index, self.data[index * 16:(index + 1) * 16])
+        self.storage.flush()
+        self.cache = ReadCache(self.storage, max_bytes=64, read_ahead=2)
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_blocks_of_a_piece_hit(self):
+        self.assertEqual(self.cache.read_block(3, 0, 8), self.data[48:56])
+        self.assertEqual(self.cache.read_block(3, 8, 8), self.data[56:64])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_ratio, 0.5)
+
+    def test_closed_storage(self):
+        self.cache.read_block(3, 0, 8)
+        self.storage.close()
+        with self.assertRaises(StorageError):
+            self.cache.read_block(3, 8, 8)
+        with self.assertRaises(StorageError):
+            self.storage.read_piece(4)
+
+    def test_sequential_reads_read_ahead(self):
+        self.cache.read_block(0, 0, 16)
+        self.cache.read_block(1, 0, 16)
+        self.assertEqual(self.cache.read_ahead_pieces, 2)
+        self.assertEqual(self.cache.read_block(2, 0, 16), self.data[32:48])
+        self.assertEqual(self.cache.read_block(3, 4, 4), self.data[52:56])
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+    def test_read_ahead_stops_at_missing_pieces(self):
+        self.cache.read_block(10, 0, 16)
+        self.cache.read_block(11, 0, 16)
+        self.assertEqual(self.cache.read_ahead_pieces, 0)
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 48
+        for index in (0, 4, 8, 0, 6):
+            self.cache.read_block(index, 0, 16)
+        self.assertEqual(self.cache.evictions, 1)
+        self.cache.read_block(0, 0, 16)
+        self.cache.read_block(4, 0, 16)
+        self.assertEqual(self.cache.misses, 5)
+
+    def test_unstored_and_bad_blocks(self):
+        with self.assertRaises(StorageError):
+            self.cache.read_block(12, 0, 8)
+        with self.assertRaises(StorageError):
+            self.cache.read_block(0, 8, 16)
+
+
+class FastExtensionTests(unittest.TestCase):
+    def setUp(self):
+        torrent = SimpleNamespace(info_hash=bytes(20), num_pieces=8)
+        self.peer = Peer('-DD0001-000000000001', '127.0.0.1', 7000, torrent)
+
+    def test_allowed_fast_set(self):
+        # The example given in BEP 6.
+        info_hash = b'\xaa' * 20
+        self.assertEqual(allowed_fast_set(info_hash, '80.4.4.200', 1313, 7),
+                         {1059, 431, 808, 1217, 287, 376, 1188})
+        self.assertEqual(allowed_fast_set(info_hash, '80.4.4.200', 1313, 9),
+                         {1059, 431, 808, 1217, 287, 376, 1188, 353, 508})
+        self.assertEqual(allowed_fast_set(info_hash, '80.4.4.1', 1313, 7),
+                         allowed_fast_set(info_hash, '80.4.4.200', 1313, 7), 'The set is shared by a /24')
+        self.assertEqual(allowed_fast_set(info_hash, '80.4.4.200', 5, 7), set(range(5)))
+
+    def test_have_all_and_none(self):
+        self.peer.fast = True
+        self.peer._handle_have_all(b'')
+        self.assertEqual(self.peer.pieces, set(range(8)))
+        self.peer._handle_have_none(b'')
+        self.assertEqual(self.peer.pieces, set())
+
+    def test_suggest_and_allowed_fast(self):
+        self.peer.fast = True
+        self.peer._handle_suggest(b'\x00\x00\x00\x03')
+        self.peer._handle_allowed_fast(b'\x00\x00\x00\x05')
+        self.assertEqual(self.peer.suggested, [3])
+        self.assertEqual(self.peer.allowed_fast, {5})
+
+    def test_requires_negotiation(self):
+        with self.assertRaises(PeerError):
+            self.peer._handle_have_all(b'')
+        self.assertEqual(drain(self.peer.messages_to_peer)[0].type, MessageType.CLOSE)
+
+
 class PeerTests(unittest.TestCase):
     def setUp(self):
         t = Torrent('portrait.torrent')
@@ -0,0 +1,114 @@
+from threading import Lock
+
+import constants
+
+"""Account for the memory held by downloads, so that many clients can share
+a host with a predictable footprint."""
+
+CATEGORIES = ('pieces', 'parsers', 'queues', 'storage')
+
+
+class MemoryBudget:
+    """Tracks the bytes held by piece buffers, message parsers, message
+    queues and write caches, against an optional limit.
+
+    Whatever holds memory is given a MemoryAccount (see account), and keeps
+    it up to date as it grows and shrinks. The budget is only advisory: it
+    never refuses an allocation, but clients ask it before starting a new
+    piece (has_room) and how deep to pipeline their requests
+    (request_depth). Once usage passes throttle_at of the limit no new
+    pieces are started, and pipelines shrink towards one request as usage
+    approaches the limit itself.
+
+    With no limit, usage is still tracked but nothing is throttled. A budget
+    may be shared by every client in a session. Safe to use from several
+    threads.
+    """
+    def __init__(self, limit=constants.MEMORY_BUDGET, throttle_at=constants.MEMORY_THROTTLE):
+        self.limit = limit
+        self.throttle_at = throttle_at
+        self._lock = Lock()
+        self._used = dict.fromkeys(CATEGORIES, 0)
+        self._total = 0
+        self.peak = 0
+
+    def account(self, category):
+        """Return a new, empty MemoryAccount counting towards category."""
+        if category not in self._used:
+            raise ValueError('Unknown Memory Category | {}'.format(category))
+        return MemoryAccount(self, category)
+
+    @property
+    def used(self):
+        return self._total
+
+    @property
+    def throttled(self):
+        return self.limit is not None and self._total >= self.limit * self.throttle_at
+
+    def has_room(self, length):
+        """Whether length more bytes can be taken on without passing the
+        throttle threshold."""
+        return self.limit is None or self._total + length <= self.limit * self.throttle_at
+
+    def request_depth(self, depth):
+        """Scale a request pipeline depth down, from depth at the throttle
+        threshold to 1 at the limit."""
+        if not self.throttled:
+            return depth
+        threshold = self.limit * self.throttle_at
+        room = max(self.limit - self._total, 0) / max(self.limit - threshold, 1)
+        return max(1, int(depth * room))
+
+    def usage(self):
+        """Return the bytes in use, in total and by category, with the
+        limit and whether it is throttling."""
+        with self._lock:
+            categories = dict(self._used)
+        return {
+            'limit': self.limit,
+            'used': sum(categories.values()),
+            'peak': self.peak,
+            'throttled': self.throttled,
+            'categories': categories,
+        }
+
+    def _set(self, account, length, relative=False, close=False):
+        with self._lock:
+            if account.closed:
+                return
+            if relative:
+                length += account.bytes
+            delta = length - account.bytes
+            account.bytes = length
+            # Closed under the lock, so no change can land after the bytes
+            # are given back.
+            account.closed = close
+            self._used[account.category] += delta
+            self._total += delta
+            if self._total > self.peak:
+                self.peak = self._total
+
+
+class MemoryAccount:
+    """The bytes held by one owner, such as a piece or a peer's queue,
+    within a MemoryBudget. Once closed its bytes are given back and later
+    changes are ignored."""
+    __slots__ = ('budget', 'category', 'bytes', 'closed')
+
+    def __init__(self, budget, category):
+        self.budget = budget
+        self.category = category
+        self.bytes = 0
+        self.closed = False
+
+    def set(self, length):
+        """The owner now holds length bytes."""
+        self.budget._set(self, length)
+
+    def add(self, delta):
+        if delta:
+            self.budget._set(self, delta, relative=True)
+
+    def close(self):
+        self.budget._set(self, 0, close=True)
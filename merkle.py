@@ -0,0 +1,159 @@
+from bisect import bisect_right
+from functools import lru_cache
+from hashlib import sha256
+
+"""SHA-256 merkle trees of BitTorrent v2 (BEP 52).
+
+Each file of a v2 torrent is hashed as a binary tree whose leaves are the
+hashes of its 16 KiB blocks. The leaves are padded with zero hashes out to a
+power of two. A file's tree is identified by its root, the 'pieces root'.
+The 'piece layer' is the layer of the tree whose nodes each cover one piece,
+and it is carried in the torrent file for every file larger than a piece.
+"""
+
+BLOCK_LENGTH = 2 ** 14
+HASH_LENGTH = 32
+ZERO_HASH = bytes(HASH_LENGTH)
+
+
+class MerkleError(Exception):
+    pass
+
+
+def next_power_of_two(n):
+    return 1 << max(n - 1, 0).bit_length()
+
+
+def block_hashes(data):
+    """The leaf hashes of data, one per 16 KiB block."""
+    view = memoryview(data)
+    return [sha256(view[i:i + BLOCK_LENGTH]).digest() for i in range(0, len(view), BLOCK_LENGTH)]
+
+
+def merkle_root(hashes, width, pad=ZERO_HASH):
+    """The root of the tree with the given hashes as its bottom layer,
+    padded with pad to width (a power of two) hashes."""
+    if len(hashes) > width:
+        raise MerkleError('More Hashes Than the Tree Holds | {} {}'.format(len(hashes), width))
+    layer = [bytes(h) for h in hashes] + [pad] * (width - len(hashes))
+    while len(layer) > 1:
+        layer = [sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return bytes(layer[0])
+
+
+@lru_cache(maxsize=None)
+def pad_hash(width):
+    """The root of a tree of width zero leaves, which pads a piece layer."""
+    return merkle_root([], width)
+
+
+class PieceLayer:
+    """What is needed to verify one piece of a v2 torrent.
+
+    hash is the node of the file's tree covering the piece, or the pieces
+    root itself for a file no larger than a piece. width is the number of
+    leaves under that node, padding included.
+    """
+    __slots__ = ('index', 'root', 'file_piece', 'length', 'hash', 'width')
+
+    def __init__(self, index, root, file_piece, length, hash, width):
+        self.index = index
+        self.root = root
+        self.file_piece = file_piece
+        self.length = length
+        self.hash = hash
+        self.width = width
+
+    @property
+    def first_leaf(self):
+        """The index of the piece's first block among its file's leaves."""
+        return self.file_piece * self.width
+
+
+class PieceLayers:
+    """The piece layers of a v2 torrent, looked up by piece number.
+
+    Files are laid out end to end with each starting on a piece boundary, so
+    a piece never spans two files. Layers are kept as memoryviews of the
+    torrent file, as PieceHashes keeps v1 hashes.
+
+    Args:
+        files: (path, offset, length, pieces root) of each file, in order.
+        layers: the torrent's 'piece layers', pieces root -> layer bytes.
+        piece_length: the torrent's piece length.
+    Raises:
+        MerkleError if a layer is missing, or does not hash to its root.
+    """
+    def __init__(self, files, layers, piece_length):
+        self.piece_length = piece_length
+        self.blocks_per_piece = piece_length // BLOCK_LENGTH
+        # (first piece, path, offset, length, root, layer) of each file with data.
+        self._files = []
+        self._first_pieces = []
+        self._by_root = {}
+        for path, offset, length, root in files:
+            if not length:
+                continue
+            layer = None
+            if length > piece_length:
+                layer = layers.get(bytes(root))
+                num_pieces = -(-length // piece_length)
+                if layer is None or len(layer) != num_pieces * HASH_LENGTH:
+                    raise MerkleError('Missing Piece Layer | {}'.format(path))
+                hashes = [layer[i:i + HASH_LENGTH] for i in range(0, len(layer), HASH_LENGTH)]
+                if merkle_root(hashes, next_power_of_two(num_pieces), pad_hash(self.blocks_per_piece)) != bytes(root):
+                    raise MerkleError('Piece Layer Does Not Match Its Root | {}'.format(path))
+            entry = (offset // piece_length, path, offset, length, bytes(root), layer)
+            self._by_root[entry[4]] = entry
+            self._files.append(entry)
+            self._first_pieces.append(entry[0])
+
+    @property
+    def files(self):
+        """(path, offset, length, pieces root) of each file with data."""
+        return [(path, offset, length, root) for _, path, offset, length, root, _ in self._files]
+
+    @property
+    def layers(self):
+        """The piece layers, pieces root -> layer bytes."""
+        return {root: layer for _, _, _, _, root, layer in self._files if layer is not None}
+
+    def __len__(self):
+        if not self._files:
+            return 0
+        first, _, _, length, _, _ = self._files[-1]
+        return first + -(-length // self.piece_length)
+
+    def __getitem__(self, index):
+        i = bisect_right(self._first_pieces, index) - 1
+        if i < 0:
+            raise IndexError('Piece Index Out of Range | {}'.format(index))
+        first, _, offset, length, root, layer = self._files[i]
+        file_piece = index - first
+        if file_piece * self.piece_length >= length:
+            # Either past the end, or in the padding between two files.
+            raise IndexError('No Piece With That Index | {}'.format(index))
+        piece_length = min(self.piece_length, length - file_piece * self.piece_length)
+        if layer is None:
+            return PieceLayer(index, root, 0, piece_length, root,
+                              next_power_of_two(-(-length // BLOCK_LENGTH)))
+        start = file_piece * HASH_LENGTH
+        return PieceLayer(index, root, file_piece, piece_length, layer[start:start + HASH_LENGTH],
+                          self.blocks_per_piece)
+
+    def __iter__(self):
+        for first, _, _, length, _, _ in self._files:
+            for index in range(first, first + -(-length // self.piece_length)):
+                yield self[index]
+
+    def piece_index(self, root, leaf_index):
+        """The piece of the file with the given pieces root which holds the
+        leaf, or None."""
+        entry = self._by_root.get(bytes(root))
+        if entry is None:
+            return None
+        first, _, _, length, _, layer = entry
+        file_piece = leaf_index // self.blocks_per_piece if layer is not None else 0
+        if file_piece * self.piece_length >= length:
+            return None
+        return first + file_piece
@@ -1,6 +1,7 @@
 from queue import Queue
 from enum import Enum
-from struct import unpack, pack
+from struct import unpack_from, pack
+from profiling import timed
 import constants
 
 """Handle BitTorrent Protocol message parsing duties"""
@@ -28,6 +29,7 @@ class MessageParser:
         self.incomplete_message = b''
         self.counter = 0
 
+    @timed('parse')
     def __call__(self, bytestring):
         """Take in raw bytestring and returns generator that yields messages"""
 
@@ -36,36 +38,39 @@ class MessageParser:
             bytestring = self.incomplete_message + bytestring
             self.incomplete_message = b''
 
-        while bytestring:
-            try:
-                length_bytes, bytestring = _strip_message(bytestring, 4)
-                length = unpack('!I', length_bytes)[0]
-            except ValueError:
-                raise MessageException('Bad Length Bits | {}'.format(bytestring))
-            # NOTE: If this is breaking... it might be because we're getting incomplete length bits.
+        # Walk the bytestring by offset rather than slicing off each message,
+        # so a chunk holding many messages is only copied once per message.
+        i = 0
+        end = len(bytestring)
+        while end - i >= 4:
+            length = unpack_from('!I', bytestring, i)[0]
 
             # Is this a complete message?
-            if len(bytestring) < length:
-                self.incomplete_message = length_bytes + bytestring
+            if end - i - 4 < length:
                 break
-            else:
-                message_bytes, bytestring = _strip_message(bytestring, length)
-                yield self._parse_message(message_bytes)
+            start = i + 4
+            i = start + length
+            yield self._parse_message(bytestring[start:i])
+
+        # Also covers a length prefix split across bytestrings.
+        self.incomplete_message = bytestring[i:]
 
     @staticmethod
     def _parse_message(bytestring):
         """Returns an appropriate Message object"""
         if not bytestring:
-            return Message.factory(MessageType.KEEP_ALIVE)
-        else:
-            id_byte, payload = _strip_message(bytestring, 1)
-            type_id = int.from_bytes(id_byte, byteorder='big')
-            message_type = MessageType(type_id)
+            return KEEP_ALIVE_MESSAGE
 
-            if payload:
-                return Message.factory(message_type, payload)
-            else:
-                return Message.factory(message_type)
+        message_type = _TYPES_BY_ID.get(bytestring[0])
+        if message_type is None:
+            raise MessageException('Unknown Message Type | {}'.format(bytestring[0]))
+
+        if message_type is MessageType.PIECE:
+            return PieceMessage.from_wire(bytestring)
+        elif len(bytestring) > 1:
+            return Message(message_type, bytestring[1:])
+        else:
+            return Message.factory(message_type)
 
 
 class MessageType(Enum):
@@ -80,15 +85,40 @@ class MessageType(Enum):
     BITFIELD = 5
     REQUEST = 6
     PIECE = 7
+    CANCEL = 8
+    # Fast Extension (BEP 6)
+    SUGGEST = 13
+    HAVE_ALL = 14
+    HAVE_NONE = 15
+    REJECT = 16
+    ALLOWED_FAST = 17
+    # BitTorrent v2 (BEP 52)
+    HASH_REQUEST = 21
+    HASHES = 22
+    HASH_REJECT = 23
+
+
+# Wire ids to message types, for the types that appear on the wire.
+_TYPES_BY_ID = {message_type.value: message_type for message_type in MessageType if message_type.value >= 0}
 
 
 class Message:
+    """A message passed to or from a peer.
+
+    Messages are created for every block that crosses the wire, so they are
+    slotted, and messages without a payload are shared instances (see
+    factory). Treat messages as immutable.
+    """
+    __slots__ = ('type', 'payload')
+
     @staticmethod
     def factory(message_type, raw_payload=None):
-        if message_type == MessageType.PIECE:
+        if message_type is MessageType.PIECE:
             return PieceMessage(raw_payload)
-        elif message_type == MessageType.HANDSHAKE:
+        elif message_type is MessageType.HANDSHAKE:
             return HandShakeMessage(raw_payload)
+        elif raw_payload is None and message_type in _PAYLOADLESS_MESSAGES:
+            return _PAYLOADLESS_MESSAGES[message_type]
         else:
             return Message(message_type, raw_payload)
 
@@ -97,34 +127,41 @@ class Message:
         self.payload = payload
 
     def to_bytes(self):
-        # form the length prefix.
-        if self.payload:
-            length = len(self.payload) + 1
-        else:
-            length = 1
+        return b''.join(self.to_chunks())
 
-        length_bytes = pack('!I', length)
-        id_byte = int.to_bytes(self.type.value, length=1, byteorder='big')
-        bytestring = length_bytes + id_byte
+    def to_chunks(self):
+        """Return the message as a list of bytestrings which, written in
+        order, make up the message on the wire. The payload is never copied
+        into the header."""
+        if self.type == MessageType.KEEP_ALIVE:
+            return [KEEP_ALIVE_BYTES]
 
-        if self.payload:
-            bytestring += self.payload
+        header, payload_length = _FIXED_HEADERS.get(self.type, (None, None))
+        if header is None or len(self.payload) != payload_length:
+            length = len(self.payload) + 1 if self.payload else 1
+            header = pack('!IB', length, self.type.value)
 
-        return bytestring
+        if self.payload:
+            return [header, self.payload]
+        return [header]
 
     def __repr__(self):
         return 'Message [ type: {} | payload: {} ]'.format(self.type.name, self.payload or 'No Payload')
 
 
 class HandShakeMessage(Message):
+    __slots__ = ()
+
     def __init__(self, payload):
         super().__init__(MessageType.HANDSHAKE, payload)
 
-    def to_bytes(self):
-            return self.payload
+    def to_chunks(self):
+        return [self.payload]
 
 
 class PieceMessage(Message):
+    __slots__ = ('index', 'offset')
+
     def __init__(self, raw_payload):
         index_bytes = raw_payload[:4]
         self.index = int.from_bytes(index_bytes, byteorder='big')
@@ -132,10 +169,93 @@ class PieceMessage(Message):
         self.offset = int.from_bytes(offset_bytes, byteorder='big')
         super().__init__(MessageType.PIECE, raw_payload[8:])
 
+    @classmethod
+    def from_wire(cls, bytestring):
+        """Create a piece message from a whole message body, id byte
+        included."""
+        message = cls.__new__(cls)
+        message.index, message.offset = unpack_from('!II', bytestring, 1)
+        message.type = MessageType.PIECE
+        message.payload = bytestring[9:]
+        return message
+
+    @classmethod
+    def from_block(cls, index, offset, block):
+        """Create a piece message to send a block of a piece. The block is
+        kept as is, not copied."""
+        message = cls.__new__(cls)
+        message.index = index
+        message.offset = offset
+        Message.__init__(message, MessageType.PIECE, block)
+        return message
+
+    def to_chunks(self):
+        header = pack('!IBII', len(self.payload) + 9, MessageType.PIECE.value, self.index, self.offset)
+        return [header, self.payload]
+
     def __repr__(self):
         return 'Message [ type: {} | index: {} ]'.format(self.type.name, self.index)
 
 
+# Shared instances of the messages which never carry a payload.
+_PAYLOADLESS_MESSAGES = {
+    message_type: Message(message_type)
+    for message_type in (MessageType.KEEP_ALIVE, MessageType.CHOKE, MessageType.UNCHOKE,
+                         MessageType.INTERESTED, MessageType.UNINTERESTED, MessageType.HAVE_ALL,
+                         MessageType.HAVE_NONE)
+}
+KEEP_ALIVE_MESSAGE = _PAYLOADLESS_MESSAGES[MessageType.KEEP_ALIVE]
+
+# Headers (length prefix and id byte) of the messages whose payloads are
+# always the same size, so they need not be packed for every message.
+_FIXED_HEADERS = {
+    MessageType.HAVE: (pack('!IB', 5, MessageType.HAVE.value), 4),
+    MessageType.REQUEST: (pack('!IB', 13, MessageType.REQUEST.value), 12),
+    MessageType.CANCEL: (pack('!IB', 13, MessageType.CANCEL.value), 12),
+    MessageType.REJECT: (pack('!IB', 13, MessageType.REJECT.value), 12),
+    MessageType.SUGGEST: (pack('!IB', 5, MessageType.SUGGEST.value), 4),
+    MessageType.ALLOWED_FAST: (pack('!IB', 5, MessageType.ALLOWED_FAST.value), 4),
+    MessageType.HASH_REQUEST: (pack('!IB', 49, MessageType.HASH_REQUEST.value), 48),
+    MessageType.HASH_REJECT: (pack('!IB', 49, MessageType.HASH_REJECT.value), 48),
+}
+KEEP_ALIVE_BYTES = pack('!I', 0)
+
+
+def block_message(message_type, index, offset, length):
+    """Create a REQUEST, CANCEL or REJECT message for a block.
+
+    Payload format:
+        <4-byte piece index><4-byte block offset><4-byte length>
+    """
+    return Message(message_type, pack('!III', index, offset, length))
+
+
+def hash_message(message_type, root, base_layer, index, length, proof_layers, hashes=b''):
+    """Create a HASH_REQUEST, HASHES or HASH_REJECT message for length
+    hashes of a file's merkle tree, starting at index of the base layer
+    (0 being the leaves). HASHES carries the hashes themselves, followed by
+    the proof_layers uncle hashes which link them to the tree.
+
+    Payload format:
+        <32-byte pieces root><4-byte base layer><4-byte index><4-byte length>
+        <4-byte proof layers>[<32-byte hash>...]
+    """
+    return Message(message_type, bytes(root) + pack('!IIII', base_layer, index, length, proof_layers) + hashes)
+
+
+def parse_hash_message(payload):
+    """Split up the payload of a message made by hash_message.
+
+    Returns:
+        A tuple of (root, base layer, index, length, proof layers, hashes).
+    Raises:
+        MessageException if the payload is too short.
+    """
+    if len(payload) < 48 or (len(payload) - 48) % 32:
+        raise MessageException('Malformed Hash Message | {} bytes'.format(len(payload)))
+    return (bytes(payload[:32]),) + unpack_from('!IIII', payload, 32) + (bytes(payload[48:]),)
+
+
 def _strip_message(message, index):
     """Splits an array at the given index"""
     if index > len(message):
@@ -155,16 +275,19 @@ def is_handshake(data):
     return data[:i] == bytes([pstrlen]) + constants.PSTR
 
 
-def get_handshake(client_id, info_hash):
+def get_handshake(client_id, info_hash, reserved=constants.RESERVED):
     """Return a bytestring that represents our handshake to
     a peer
 
     Message format:
         <pstrlen><pstr><reserved><info_hash><peer_id>
+
+    The reserved bytes advertise the extensions we support (see
+    constants.RESERVED).
     """
 
     pstrlen = bytes([len(constants.PSTR)])
-    payload = b"".join([pstrlen, constants.PSTR, constants.RESERVED, info_hash, client_id.encode()])
+    payload = b"".join([pstrlen, constants.PSTR, reserved, info_hash, client_id.encode()])
     message = Message.factory(MessageType.HANDSHAKE, payload)
     return message
 
@@ -176,6 +299,10 @@ def parse_handshake(data):
     handshake = {}
     pstrlen = len(constants.PSTR)
     i = pstrlen + len(constants.RESERVED) + 1  # 1 for the leading byte
+    handshake['reserved'] = reserved = data[pstrlen + 1:i]
+    # The extension is only used if both sides offer it.
+    handshake['fast'] = bool(reserved[7] & constants.RESERVED[7] & constants.FAST_EXTENSION)
+    handshake['v2'] = bool(reserved[7] & constants.RESERVED[7] & constants.V2_EXTENSION)
     j = i + constants.INFO_HASH_LEN
     handshake['info_hash'] = data[i:j]
 
@@ -188,8 +315,89 @@ def parse_handshake(data):
 
 
 class MessageQueue(Queue):
+    """A queue of messages between a peer connection and whoever is
+    working on them, with high and low water marks.
+
+    When the queue fills to high_water on_high is called, and once it has
+    drained to low_water on_low is called. The callbacks run with the queue's
+    lock held, on whichever thread put or got the message, so they should
+    just hand off to the reactor.
+
+    The payload bytes of the messages waiting are kept in memory, an
+    optional MemoryAccount.
+    """
     STOP = object()
 
+    def __init__(self, high_water=None, low_water=None):
+        super().__init__()
+        self.high_water = high_water
+        self.low_water = low_water if low_water is not None else (high_water or 0) // 2
+        self.on_high = None
+        self.on_low = None
+        self.memory = None
+        self.above_high_water = False
+        self.peak = 0
+        self.total = 0
+
+    def _put(self, item):
+        super()._put(item)
+        if self.memory is not None:
+            self.memory.add(_payload_length(item))
+        depth = len(self.queue)
+        self.total += 1
+        if depth > self.peak:
+            self.peak = depth
+        if self.high_water and depth >= self.high_water and not self.above_high_water:
+            self.above_high_water = True
+            if self.on_high:
+                self.on_high()
+
+    def _get(self):
+        item = super()._get()
+        if self.memory is not None:
+            self.memory.add(-_payload_length(item))
+        if self.above_high_water and len(self.queue) <= self.low_water:
+            self.above_high_water = False
+            if self.on_low:
+                self.on_low()
+        return item
+
+    def stats(self):
+        """Return the queue's depth metrics."""
+        return {
+            'depth': self.qsize(),
+            'peak': self.peak,
+            'total': self.total,
+            'high_water': self.high_water,
+            'above_high_water': self.above_high_water,
+        }
+
+    def remove(self, predicate):
+        """Take the waiting messages for which predicate is true out of the
+        queue, as if they had been got and their work done.
+
+        Returns:
+            The number of messages removed.
+        """
+        with self.mutex:
+            kept, removed = [], []
+            for item in self.queue:
+                (removed if item is not self.STOP and predicate(item) else kept).append(item)
+            if not removed:
+                return 0
+            self.queue.clear()
+            self.queue.extend(kept)
+            if self.memory is not None:
+                self.memory.add(-sum(_payload_length(item) for item in removed))
+            self.unfinished_tasks -= len(removed)
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+            if self.above_high_water and len(self.queue) <= self.low_water:
+                self.above_high_water = False
+                if self.on_low:
+                    self.on_low()
+        return len(removed)
+
     def close(self):
         self.put(self.STOP)
 
@@ -204,6 +412,11 @@ class MessageQueue(Queue):
                 self.task_done()
 
 
+def _payload_length(item):
+    payload = getattr(item, 'payload', None)
+    return len(payload) if payload else 0
+
+
 def message_queue_worker(message_queue, callback):
     """This little guy will keep trying to pull from
     the queue until it's told not to.
@@ -0,0 +1,210 @@
+import json
+import os
+import tempfile
+from hashlib import sha1
+from struct import pack, unpack, error as StructError
+
+from merkle import HASH_LENGTH
+import constants
+
+"""Cache parsed torrent metainfo on disk so large .torrent files do not
+have to be parsed and hashed again every time they are opened."""
+
+MAGIC = b'DDMC'
+VERSION = 2
+ENTRY_SUFFIX = '.meta'
+PIECE_HASH_LENGTH = 20  # of a v1 piece hash; HASH_LENGTH is of a v2 one
+REQUIRED_KEYS = ('path', 'mtime', 'size', 'info_hash', 'announce', 'length', 'piece_length', 'target_file_name',
+                 'files', 'meta_version', 'pieces_length')
+
+
+class MetainfoCacheError(Exception):
+    pass
+
+
+class MetainfoCache:
+    """A size-bounded directory of parsed torrent metadata.
+
+    Each entry is keyed by the absolute path of the .torrent file and records
+    the file's mtime and size when it was parsed. An entry whose file has
+    changed since is treated as a miss and removed. When the entries grow
+    past max_bytes the least recently used ones are evicted.
+
+    Entry format:
+        <4-byte magic><4-byte header length><json header><piece hash blob>
+        [<piece layers>]
+
+    The piece layers of a v2 torrent follow its v1 piece hashes (if it has
+    any), in file order.
+    """
+    def __init__(self, directory, max_bytes=constants.METAINFO_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, tor_file_path, stat=None):
+        """Return the cached entry for the torrent file, or None if there
+        is no valid entry.
+
+        The entry is a dictionary with the keys written by put, with the piece
+        hashes under 'pieces' and each file's piece layer under
+        'piece_layers' as memoryviews.
+        """
+        tor_file_path = os.path.abspath(tor_file_path)
+        stat = stat or os.stat(tor_file_path)
+        entry_path = self._entry_path(tor_file_path)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                data = entry_file.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            entry = self._decode(data)
+        except (MetainfoCacheError, ValueError, KeyError, TypeError, StructError):
+            self._remove(entry_path)
+            return None
+
+        if (entry['path'] != tor_file_path or entry['mtime'] != stat.st_mtime_ns
+                or entry['size'] != stat.st_size):
+            self._remove(entry_path)
+            return None
+
+        # Touch the entry so eviction sees it as recently used.
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, tor_file_path, torrent, stat=None):
+        """Store the parsed metadata of torrent, which was read from
+        tor_file_path. The cache is only an optimisation, so failing to
+        write it is reported and otherwise ignored."""
+        tor_file_path = os.path.abspath(tor_file_path)
+        stat = stat or os.stat(tor_file_path)
+        header = {
+            'version': VERSION,
+            'path': tor_file_path,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'info_hash': torrent.info_hash.hex(),
+            'announce': torrent.announce,
+            'length': torrent.length,
+            'piece_length': torrent.piece_length,
+            'target_file_name': torrent.target_file_name,
+            'files': torrent.files,
+            'meta_version': torrent.meta_version,
+            'pieces_length': None,
+        }
+        blobs = []
+        if torrent.piece_hashes is not None:
+            blobs.append(torrent.piece_hashes.blob)
+            header['pieces_length'] = len(torrent.piece_hashes.blob)
+        if torrent.piece_layers is not None:
+            header['info_hash_v2'] = torrent.info_hash_v2.hex()
+            header['merkle_files'] = [(path, offset, length, root.hex())
+                                      for path, offset, length, root in torrent.piece_layers.files]
+            layers = torrent.piece_layers.layers
+            blobs.extend(layers[root] for _, _, _, root in torrent.piece_layers.files if root in layers)
+        header_bytes = json.dumps(header).encode('utf-8')
+        blob = b''.join(blobs)
+        entry_size = len(MAGIC) + 4 + len(header_bytes) + len(blob)
+        if entry_size > self.max_bytes:
+            return
+
+        # Write to a temporary file first so a reader never sees half an entry.
+        temp_path = None
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as entry_file:
+                entry_file.write(MAGIC + pack('!I', len(header_bytes)))
+                entry_file.write(header_bytes)
+                entry_file.write(blob)
+            os.replace(temp_path, self._entry_path(tor_file_path))
+            self._evict()
+        except OSError as e:
+            print('Could Not Write Metainfo Cache Entry:', tor_file_path, e)
+            if temp_path is not None:
+                self._remove(temp_path)
+
+    def invalidate(self, tor_file_path):
+        self._remove(self._entry_path(os.path.abspath(tor_file_path)))
+
+    def clear(self):
+        for entry_path, _, _ in self._entries():
+            self._remove(entry_path)
+
+    @property
+    def size(self):
+        return sum(size for _, _, size in self._entries())
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in
+        max_bytes."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for entry_path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(entry_path)
+            total -= size
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            entry_path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            yield entry_path, stat.st_mtime_ns, stat.st_size
+
+    def _entry_path(self, tor_file_path):
+        key = sha1(tor_file_path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    @staticmethod
+    def _decode(data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise MetainfoCacheError('Bad Cache Entry Magic')
+        i = len(MAGIC)
+        header_length = unpack('!I', data[i:i + 4])[0]
+        i += 4
+        entry = json.loads(data[i:i + header_length].decode('utf-8'))
+        if entry.get('version') != VERSION:
+            raise MetainfoCacheError('Unknown Cache Entry Version')
+        missing = [key for key in REQUIRED_KEYS if key not in entry]
+        if missing:
+            raise MetainfoCacheError('Cache Entry Is Missing Keys | {}'.format(', '.join(missing)))
+        entry['info_hash'] = bytes.fromhex(entry['info_hash'])
+        entry['files'] = [tuple(span) for span in entry['files']]
+        blob = memoryview(data)[i + header_length:]
+        pieces_length = entry['pieces_length']
+        if pieces_length is not None and (pieces_length % PIECE_HASH_LENGTH or pieces_length > len(blob)):
+            raise MetainfoCacheError('Truncated Piece Hashes | {}'.format(pieces_length))
+        entry['pieces'] = blob[:pieces_length] if pieces_length is not None else None
+        if entry['meta_version'] == 2:
+            entry['info_hash_v2'] = bytes.fromhex(entry['info_hash_v2'])
+            entry['merkle_files'] = [(path, offset, length, bytes.fromhex(root))
+                                     for path, offset, length, root in entry['merkle_files']]
+            entry['piece_layers'] = {}
+            j = pieces_length or 0
+            for _, _, length, root in entry['merkle_files']:
+                if length > entry['piece_length']:
+                    layer_length = -(-length // entry['piece_length']) * HASH_LENGTH
+                    entry['piece_layers'][root] = blob[j:j + layer_length]
+                    j += layer_length
+            if j > len(blob):
+                raise MetainfoCacheError('Truncated Piece Layers')
+        elif pieces_length is None:
+            raise MetainfoCacheError('Cache Entry Has No Piece Hashes')
+        return entry
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,187 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+
+import constants
+
+"""Collect download and upload metrics, and publish them in the Prometheus
+text format."""
+
+
+class RateMeter:
+    """Counts bytes and reports the rolling rate over the last window
+    seconds.
+
+    Counts are kept in one bucket per second, so adding is constant time.
+    Anything added to a meter is also added to its parent, which lets a
+    client's meter total up its peers' meters.
+    """
+    def __init__(self, window=constants.METRICS_RATE_WINDOW, parent=None, clock=time.monotonic):
+        self.window = window
+        self.parent = parent
+        self.total = 0
+        self._clock = clock
+        self._buckets = [0] * window
+        self._second = int(clock())
+        self._lock = Lock()
+
+    def add(self, amount):
+        with self._lock:
+            second = int(self._clock())
+            if second != self._second:
+                self._roll(second)
+            self._buckets[second % self.window] += amount
+            self.total += amount
+        if self.parent is not None:
+            self.parent.add(amount)
+
+    def rate(self):
+        """Bytes per second over the window."""
+        with self._lock:
+            self._roll(int(self._clock()))
+            return sum(self._buckets) / self.window
+
+    def _roll(self, second):
+        """Zero the buckets of the seconds that have passed with nothing
+        added."""
+        if second - self._second >= self.window:
+            self._buckets = [0] * self.window
+        else:
+            for passed in range(self._second + 1, second + 1):
+                self._buckets[passed % self.window] = 0
+        self._second = second
+
+
+class Histogram:
+    """Counts observations into fixed buckets, each counting the values less
+    than or equal to its bound."""
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Return the histogram with cumulative bucket counts, keyed by
+        upper bound ('+Inf' for the last)."""
+        with self._lock:
+            buckets = []
+            running = 0
+            for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+                running += count
+                buckets.append((bound, running))
+            return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class ClientMetrics:
+    """The metrics a Client keeps for its torrent."""
+    def __init__(self):
+        self.download = RateMeter()
+        self.upload = RateMeter()
+        self.wasted_bytes = 0
+        self.hash_failures = 0
+        self.request_rtt = Histogram(constants.REQUEST_RTT_BUCKETS)
+        self.piece_latency = Histogram(constants.PIECE_LATENCY_BUCKETS)
+
+
+def render_prometheus(snapshots):
+    """Render client metrics snapshots in the Prometheus text format.
+
+    Args:
+        snapshots: a dictionary of torrent name (or info_hash, see
+            Session.metrics) to the snapshot returned by
+            Client.metrics_snapshot.
+    Returns:
+        The exposition text, as a str.
+    """
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append('# HELP dripdrop_{} {}'.format(name, help_text))
+        lines.append('# TYPE dripdrop_{} {}'.format(name, kind))
+
+    def sample(name, labels, value):
+        label_text = ','.join('{}="{}"'.format(key, _escape(val)) for key, val in labels)
+        lines.append('dripdrop_{}{{{}}} {}'.format(name, label_text, value))
+
+    torrent_values = (
+        ('downloaded_bytes_total', 'counter', 'Bytes received from peers.'),
+        ('uploaded_bytes_total', 'counter', 'Bytes sent to peers.'),
+        ('download_rate_bytes', 'gauge', 'Rolling download rate in bytes per second.'),
+        ('upload_rate_bytes', 'gauge', 'Rolling upload rate in bytes per second.'),
+        ('wasted_bytes_total', 'counter', 'Bytes downloaded and then thrown away.'),
+        ('hash_failures_total', 'counter', 'Pieces, and v2 blocks, which failed their hash check.'),
+        ('connected_peers', 'gauge', 'Peers currently connected.'),
+        ('inbound_queue_depth', 'gauge', 'Messages waiting for the client, across peers.'),
+        ('read_cache_hits_total', 'counter', 'Uploaded blocks read from the read cache.'),
+        ('read_cache_misses_total', 'counter', 'Uploaded blocks whose piece had to be read from disk.'),
+    )
+    for name, kind, help_text in torrent_values:
+        family(name, kind, help_text)
+        key = name[:-len('_total')] if name.endswith('_total') else name
+        for torrent, snapshot in snapshots.items():
+            sample(name, [('torrent', torrent)], snapshot[key])
+
+    for name, help_text in (('request_rtt_seconds', 'Time from sending a request to receiving its block.'),
+                            ('piece_latency_seconds', 'Time from starting a piece to completing it.')):
+        family(name, 'histogram', help_text)
+        key = name[:-len('_seconds')]
+        for torrent, snapshot in snapshots.items():
+            histogram = snapshot[key]
+            for bound, count in histogram['buckets']:
+                sample(name + '_bucket', [('torrent', torrent), ('le', bound)], count)
+            sample(name + '_sum', [('torrent', torrent)], histogram['sum'])
+            sample(name + '_count', [('torrent', torrent)], histogram['count'])
+
+    family('memory_used_bytes', 'gauge', 'Bytes held against the memory budget the torrent draws on, '
+                                         'which is shared by the torrents of a session.')
+    for torrent, snapshot in snapshots.items():
+        for category, used in sorted(snapshot['memory']['categories'].items()):
+            sample('memory_used_bytes', [('torrent', torrent), ('category', category)], used)
+
+    for name, help_text in (('peer_download_rate_bytes', 'Rolling download rate from a peer.'),
+                            ('peer_upload_rate_bytes', 'Rolling upload rate to a peer.')):
+        family(name, 'gauge', help_text)
+        key = name[len('peer_'):]
+        for torrent, snapshot in snapshots.items():
+            for peer, peer_snapshot in snapshot['peers'].items():
+                sample(name, [('torrent', torrent), ('peer', peer)], peer_snapshot[key])
+
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def listen_metrics(snapshot_source, port=constants.METRICS_PORT, interface='127.0.0.1'):
+    """Serve metrics at http://<interface>:<port>/metrics on the reactor.
+
+    Args:
+        snapshot_source: a callable returning the dictionary given to
+            render_prometheus, called on every scrape.
+    Returns:
+        The twisted listening port, which can be stopped with stopListening.
+    """
+    # Imported here so the web server is only loaded when it is asked for.
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class MetricsResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+            return render_prometheus(snapshot_source()).encode('utf-8')
+
+    root = Resource()
+    root.putChild(b'metrics', MetricsResource())
+    return reactor.listenTCP(port, Site(root), interface=interface)
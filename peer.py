@@ -1,15 +1,29 @@
-from threading import Thread
+import socket
+import time
+from hashlib import sha1
+from types import SimpleNamespace
+from threading import Thread, Lock, Event
 from math import ceil
 from struct import unpack
 
-from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol, ClientFactory, ServerFactory
 from twisted.internet import reactor
+from zope.interface import implementer
 
 from message import Message, MessageParser, MessageType, get_handshake, parse_handshake, \
-    is_handshake, MessageQueue, message_queue_worker
+    is_handshake, MessageQueue, message_queue_worker, parse_hash_message
+from ratelimit import RateLimits
+from metrics import RateMeter
+from tracelog import INBOUND, OUTBOUND
+from profiling import timed
+import constants
 
 """Represent a BitTorrent peer to exchange pieces with."""
 
+HANDSHAKE_LENGTH = 1 + len(constants.PSTR) + len(constants.RESERVED) + constants.INFO_HASH_LEN + \
+    constants.PEER_ID_LEN
+
 
 class PeerError(Exception):
     pass
@@ -24,27 +38,131 @@ class HandshakeException(Exception):
         super().__init__('Peer Returned Bad Handshake | {}'.format(message))
 
 
+class ConnectionLimiter:
+    """Counts open peer connections against a cap shared by every
+    torrent that holds a reference to it."""
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.connections = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        """Claim a connection slot. Returns False if none are free."""
+        with self._lock:
+            if self.connections >= self.max_connections:
+                return False
+            self.connections += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            if self.connections > 0:
+                self.connections -= 1
+
+    @property
+    def available(self):
+        return self.max_connections - self.connections
+
+
+def allowed_fast_set(info_hash, ip, num_pieces, size=constants.ALLOWED_FAST_SET_SIZE):
+    """The canonical allowed fast set of BEP 6: the pieces a peer at ip may
+    request from us while choked. Only defined for IPv4 addresses, so
+    returns an empty set for anything else."""
+    try:
+        ip_bytes = socket.inet_aton(ip)
+    except OSError:
+        return set()
+    size = min(size, num_pieces)
+    allowed = set()
+    # Every peer in the same /24 gets the same set.
+    x = ip_bytes[:3] + b'\x00' + info_hash
+    while len(allowed) < size:
+        x = sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) >= size:
+                break
+            allowed.add(unpack('!I', x[i:i + 4])[0] % num_pieces)
+    return allowed
+
+
 class Peer:
-    def __init__(self, peer_id, ip, port, torrent):
+    def __init__(self, peer_id, ip, port, torrent, rate_limits=None, metrics=None, memory=None):
+        """
+        Args:
+            rate_limits: the RateLimits of the torrent this peer belongs
+                to. The peer's own buckets are made beneath them.
+            metrics: the ClientMetrics of the torrent this peer belongs to,
+                which the peer's rate meters feed into.
+            memory: optional MemoryBudget to account the peer's message
+                queues and partly parsed messages to, until it disconnects.
+        """
         self.peer_id = peer_id
         self.ip = ip
         self.port = port
         self.info_hash = torrent.info_hash
         self.torrent = torrent
         self.hands_shook = False
-        self.choked = False
+        # When the handshake completed, and whether the peer connected to us.
+        self.connected_at = None
+        self.inbound = False
+        # Whether we are choking the peer, refusing its requests.
+        self.choked = True
         self.is_choking = True
         self.interested = False
         self.is_interested = False
         self.pieces = set()
-        self.messages_from_peer = MessageQueue()
-        self.messages_to_peer = MessageQueue()
-        self.working_on_piece = False
-
+        # Fast Extension (BEP 6) state: whether both sides offered it, the
+        # pieces we may request while choked, and the pieces the peer
+        # suggested we download.
+        self.fast = False
+        self.allowed_fast = set()
+        self.suggested = []
+        # The pieces we let the peer request while we choke it.
+        self.granted_fast = set()
+        # BitTorrent v2 (BEP 52) state: whether both sides offered it, whether
+        # the peer has refused to send us hashes, and how many of its blocks
+        # have failed their merkle hash.
+        self.v2 = False
+        self.hashes_rejected = False
+        self.bad_blocks = 0
+        # A piece taken back from the peer after a bad block. Its later
+        # blocks may still be on their way, and would be mistaken for the
+        # answers to new requests, so it is given the piece again last.
+        self.spoiled_piece = None
+        self.messages_from_peer = MessageQueue(constants.INBOUND_QUEUE_HIGH_WATER,
+                                               constants.INBOUND_QUEUE_LOW_WATER)
+        self.messages_to_peer = MessageQueue(constants.OUTBOUND_QUEUE_HIGH_WATER,
+                                             constants.OUTBOUND_QUEUE_LOW_WATER)
+        self.disconnected = False
+
+        # Work assigned by the client: the piece being downloaded from this
+        # peer, and the requests sent for it as (index, offset) -> (length,
+        # time sent), oldest first.
+        self.piece = None
+        self.outstanding_requests = {}
+        self.snubbed = False
+        # When the peer last snubbed us, until it sends a block. It is probed
+        # with a request after SNUB_BACKOFF, and dropped if it snubs again.
+        self.snubbed_at = None
+        # An optional TraceWriter recording every message to and from the peer.
+        self.trace = None
+        self.last_received = self.last_sent = self.last_piece_received = time.monotonic()
+        self.download_meter = RateMeter(parent=metrics.download if metrics else None)
+        self.upload_meter = RateMeter(parent=metrics.upload if metrics else None)
+        self.rate_limits = (rate_limits or RateLimits()).child(constants.PEER_DOWNLOAD_RATE,
+                                                              constants.PEER_UPLOAD_RATE)
+
+        self._disconnect_callbacks = []
         self._connection_thread = None
         self._peer_listener_thread = None
         self._client_listener_thread = None
         self._message_parser = MessageParser()
+        self._handlers = self._build_handler_table()
+        self._parser_memory = None
+        if memory is not None:
+            self.messages_from_peer.memory = memory.account('queues')
+            self.messages_to_peer.memory = memory.account('queues')
+            self._parser_memory = memory.account('parsers')
 
     def connect(self, client_id):
         """Forms a connection to the peer across TCP. Also creates
@@ -64,9 +182,9 @@ class Peer:
         if self._connection_thread:
             raise PeerError("This Peer is already connected.")
 
-        reactor.connectTCP(self.ip, self.port, PeerConnectionFactory(self))
+        # connectTCP is not thread safe, and we may be called off the reactor thread.
+        reactor.callFromThread(reactor.connectTCP, self.ip, self.port, PeerConnectionFactory(self))
         PeerConnectionFactory.ensure_reactor()
-        # # TODO: Handle disconnection.
 
     def close_connection(self):
         """Tells the protocol to close the connection, then notifies the queues
@@ -75,39 +193,131 @@ class Peer:
         self.messages_to_peer.close()
         self.messages_from_peer.close()
 
+    def set_backpressure_handlers(self, pause, resume):
+        """Assigns the callbacks used when either message queue fills up
+        and drains again.
+
+        Both queues pause the same thing, reading from the peer: a full
+        inbound queue means the client is behind, and a full outbound queue
+        means what the peer is asking of us is piling up. The callbacks are
+        called with the queue's name, 'inbound' or 'outbound', so that one
+        queue draining does not undo the other's pause.
+        """
+        for name, queue in (('inbound', self.messages_from_peer), ('outbound', self.messages_to_peer)):
+            queue.on_high = lambda name=name: pause(name)
+            queue.on_low = lambda name=name: resume(name)
+
+    def queue_stats(self):
+        return {
+            'inbound': self.messages_from_peer.stats(),
+            'outbound': self.messages_to_peer.stats(),
+        }
+
+    def connection_lost(self, reason=None):
+        """Called once the TCP connection has gone away, or could not be
+        made. Stops the queue workers and notifies disconnect subscribers."""
+        if self.disconnected:
+            return
+        self.disconnected = True
+        self.messages_to_peer.close()
+        self.messages_from_peer.close()
+        for account in (self.messages_from_peer.memory, self.messages_to_peer.memory, self._parser_memory):
+            if account is not None:
+                account.close()
+        if self.trace:
+            self.trace.close()
+        for callback in self._disconnect_callbacks:
+            callback(self, reason)
+
+    def subscribe_for_disconnect(self, callback):
+        """Assigns a callback to be called with (peer, reason) when the
+        connection to the peer is lost."""
+        self._disconnect_callbacks.append(callback)
+
     def shake_hands(self, client_id):
         # First we shake hands. So Queue that up.
-        handshake_message = get_handshake(client_id, self.info_hash)
+        reserved = constants.RESERVED if self.offers_v2 else constants.RESERVED_V1
+        handshake_message = get_handshake(client_id, self.info_hash, reserved)
         self.message_peer(handshake_message)
 
+    @property
+    def offers_v2(self):
+        """Whether we offer v2 hash requests, which only torrents with
+        piece layers (v2 and hybrid) can answer."""
+        return getattr(self.torrent, 'piece_layers', None) is not None
+
     def has_piece(self, piece_num):
         return piece_num in self.pieces
 
+    @property
+    def working_on_piece(self):
+        return self.piece is not None
+
+    def add_request(self, index, offset, length):
+        """Record a block request sent to the peer."""
+        self.outstanding_requests[(index, offset)] = (length, time.monotonic())
+
+    def complete_request(self, index, offset):
+        """Forget a block request the peer has answered. Returns when the
+        request was sent, or None if it was not outstanding."""
+        request = self.outstanding_requests.pop((index, offset), None)
+        return request[1] if request else None
+
+    def clear_requests(self):
+        """Forget every outstanding request. Returns them as a list of
+        (index, offset, length) tuples."""
+        requests = [(index, offset, length) for (index, offset), (length, _) in self.outstanding_requests.items()]
+        self.outstanding_requests = {}
+        return requests
+
+    def oldest_request_time(self):
+        """Return when the oldest outstanding request was sent, or None."""
+        for length, sent in self.outstanding_requests.values():
+            return sent
+        return None
+
     def message_peer(self, message):
         """Places a message which will be passed to the peer connection"""
+        self.last_sent = time.monotonic()
         self.messages_to_peer.put(message)
 
+    @timed('handle_messages')
     def handle_messages(self, data):
         """Interprets incoming messages and responds or notifies the client
         nas necessary"""
+        self.last_received = time.monotonic()
         if is_handshake(data):
             handshake = parse_handshake(data)
 
-            if handshake['peer_id'] != self.peer_id:
+            # Compact tracker responses leave out peer ids, so adopt the one
+            # the peer gives us if we didn't know it.
+            if self.peer_id is None:
+                self.peer_id = handshake['peer_id']
+            elif handshake['peer_id'] != self.peer_id:
                 raise HandshakeException('Bad Peer Id')
 
             self.hands_shook = True
-            self.messages_from_peer.put(Message.factory(MessageType.HANDSHAKE, data))
+            self.connected_at = time.monotonic()
+            self.fast = handshake['fast']
+            self.v2 = handshake['v2'] and self.offers_v2
+            handshake_message = Message.factory(MessageType.HANDSHAKE, data)
+            if self.trace:
+                self.trace.record(INBOUND, handshake_message)
+            self.messages_from_peer.put(handshake_message)
 
             if 'extra' in handshake:
                 self.handle_messages(handshake['extra'])
 
         else:
-            messages = self._message_parser(data)
-            for message in messages:
-                handler_method = self._message_dispatch(message)
-                handler_method(message.payload)
+            handlers = self._handlers
+            trace = self.trace
+            for message in self._message_parser(data):
+                if trace:
+                    trace.record(INBOUND, message)
+                handlers[message.type](message.payload)
                 self.messages_from_peer.put(message)
+            if self._parser_memory is not None:
+                self._parser_memory.set(len(self._message_parser.incomplete_message))
 
     def subscribe_for_messages_to_peer(self, callback):
         """Assigns a callback for all messages that are intended for the peer"""
@@ -125,15 +335,24 @@ class Peer:
         self._client_listener_thread = thread
         thread.start()
 
+    def _build_handler_table(self):
+        """Map each message type to its bound _handle_<type> method, once
+        per peer rather than once per message."""
+        handlers = {}
+        for message_type in MessageType:
+            method = getattr(self, '_handle_' + message_type.name.lower(), None)
+            if method is not None:
+                handlers[message_type] = method
+        return handlers
+
     def _message_dispatch(self, message):
-        if not isinstance(message, Message):
-            raise ValueError("Dispatch is only valid on Message")
-        name = message.type.name.lower()
-        method_name = '_handle_' + name
-        return getattr(self, method_name)
+        try:
+            return self._handlers[message.type]
+        except (KeyError, AttributeError):
+            raise ValueError("Dispatch is only valid on Message | {}".format(message))
 
     def _handle_keep_alive(self, payload):
-        print("Don't let me die!")
+        pass
 
     def _handle_choke(self, payload):
         self.is_choking = True
@@ -151,7 +370,6 @@ class Peer:
         # Format: Payload is an integer which represents the 0 based
         # index of the piece that it is saying it has.
         # FIXME: This has not been tested with an actual message!
-        print("have found")
         piece_index = unpack('!I', payload)[0]
         self.pieces.add(piece_index)
 
@@ -183,27 +401,102 @@ class Peer:
                 if piece_number >= self.torrent.num_pieces:
                     break
 
+    def _handle_have_all(self, payload):
+        self._require_fast(MessageType.HAVE_ALL)
+        self.pieces = set(range(self.torrent.num_pieces))
+
+    def _handle_have_none(self, payload):
+        self._require_fast(MessageType.HAVE_NONE)
+        self.pieces = set()
+
+    def _handle_suggest(self, payload):
+        self._require_fast(MessageType.SUGGEST)
+        piece_index = unpack('!I', payload)[0]
+        if piece_index not in self.suggested:
+            self.suggested.append(piece_index)
+
+    def _handle_allowed_fast(self, payload):
+        self._require_fast(MessageType.ALLOWED_FAST)
+        piece_index = unpack('!I', payload)[0]
+        if piece_index < self.torrent.num_pieces:
+            self.allowed_fast.add(piece_index)
+
+    def _handle_reject(self, payload):
+        # The client frees the rejected request.
+        self._require_fast(MessageType.REJECT)
+
+    def _require_fast(self, message_type):
+        # BEP 6: these messages must not be sent unless both sides offered the extension.
+        if not self.fast:
+            self.close_connection()
+            raise PeerError('Fast Extension Message Without the Extension | {}'.format(message_type.name))
+
+    def _handle_hash_request(self, payload):
+        # The client answers, or rejects, hash requests.
+        parse_hash_message(payload)
+
+    def _handle_hashes(self, payload):
+        # The client checks the hashes against the piece they are for.
+        parse_hash_message(payload)
+
+    def _handle_hash_reject(self, payload):
+        parse_hash_message(payload)
+        self.hashes_rejected = True
+
     def _handle_request(self, payload):
-        # TODO: handle request from other peer
-        #    (might be more for the client than the peer)
+        # Requests are answered by the client, which has the storage.
         pass
 
+    def _handle_cancel(self, payload):
+        """Drop the block the peer no longer wants, if it is still waiting
+        to be sent."""
+        index, offset, length = unpack('!III', payload)
+        self.messages_to_peer.remove(
+            lambda message: (message.type is MessageType.PIECE and message.index == index
+                             and message.offset == offset and len(message.payload) == length))
+
     def _handle_piece(self, payload):
-        # This is handled in the client.
-        pass
+        # The block itself is handled in the client.
+        self.last_piece_received = time.monotonic()
 
     def __repr__(self):
         return 'Peer {} | {} | {}'.format(self.peer_id, self.ip, self.port)
 
+@implementer(IPushProducer)
 class PeerConnection(Protocol):
+    """The TCP connection to a peer.
+
+    Outgoing messages are not written one at a time. The writer thread
+    collects their chunks and one flush per reactor tick hands everything
+    gathered so far to transport.writeSequence.
+
+    Reads are paused while the peer's download bucket is in debt, and while
+    either of the peer's message queues is above its high water mark. Writes
+    happen on the peer's queue worker thread, which
+    sleeps off upload debt, and also waits while the transport (acting as our
+    consumer) has asked us to pause because its send buffer is full.
+    """
     def __init__(self, factory):
         self.peer = factory.peer
-    # TODO: Idea: create log files that keep track of what has been sent from each peer.
+        self._writable = Event()
+        self._writable.set()
+        self._pause_reasons = set()
+        self._pending_chunks = []
+        self._pending_lock = Lock()
+        self._flush_scheduled = False
 
     def connectionMade(self):
         """Function to be called whenever a connection is established
         for the protocol."""
         print('Connection made with: {}'.format(self.peer))
+        self._attach()
+
+    def _attach(self):
+        """Start moving messages between the peer and the transport."""
+        self.transport.registerProducer(self, True)
+        self.peer.set_backpressure_handlers(
+            lambda queue: reactor.callFromThread(self.pause_reading, queue),
+            lambda queue: reactor.callFromThread(self.resume_reading, queue))
         self.peer.subscribe_for_messages_to_peer(self.send_message)
 
     def dataReceived(self, data):
@@ -212,14 +505,152 @@ class PeerConnection(Protocol):
         Should examine type of message and parse. If initial handshake, should
         examine for authenticity, and prepare for response.
         """
+        self.peer.download_meter.add(len(data))
+        delay = self.peer.rate_limits.download.consume(len(data))
         self.peer.handle_messages(data)
+        if delay and 'rate' not in self._pause_reasons:
+            self.pause_reading('rate')
+            reactor.callLater(delay, self.resume_reading, 'rate')
+
+    def pause_reading(self, reason):
+        """Stop reading from the peer until resume_reading is called with
+        the same reason (and no other reason is holding it paused)."""
+        if not self._pause_reasons:
+            self.transport.pauseProducing()
+        self._pause_reasons.add(reason)
+
+    def resume_reading(self, reason):
+        if reason not in self._pause_reasons:
+            return
+        self._pause_reasons.discard(reason)
+        if not self._pause_reasons and self.transport.connected:
+            self.transport.resumeProducing()
 
     def send_message(self, message):
+        """Queue a message for the next flush to the peer. Called from the
+        peer's queue worker thread, so waiting here holds back the queue
+        rather than the reactor."""
         if message.type == MessageType.CLOSE:
             print('Closing Connection:', self.peer)
+            reactor.callFromThread(self._close)
+            return
+
+        self._writable.wait()
+        if self.peer.trace:
+            self.peer.trace.record(OUTBOUND, message)
+        chunks = message.to_chunks()
+        size = sum(len(chunk) for chunk in chunks)
+        self.peer.upload_meter.add(size)
+        delay = self.peer.rate_limits.upload.consume(size)
+        with self._pending_lock:
+            self._pending_chunks.extend(chunks)
+            schedule = not self._flush_scheduled
+            self._flush_scheduled = True
+        if schedule:
+            reactor.callFromThread(self._flush)
+        if delay:
+            time.sleep(delay)
+
+    def _flush(self):
+        """Write everything queued since the last flush in one call."""
+        with self._pending_lock:
+            chunks = self._pending_chunks
+            self._pending_chunks = []
+            self._flush_scheduled = False
+        if chunks:
+            self.transport.writeSequence(chunks)
+
+    def _close(self):
+        self._flush()
+        self.transport.loseConnection()
+
+    def pauseProducing(self):
+        self._writable.clear()
+
+    def resumeProducing(self):
+        self._writable.set()
+
+    def stopProducing(self):
+        # Let a blocked writer through; its writes go nowhere once the
+        # connection is gone.
+        self._writable.set()
+
+    def connectionLost(self, reason):
+        self._writable.set()
+        self.peer.connection_lost(reason)
+
+
+class InboundPeerConnection(PeerConnection):
+    """A connection a peer made to us. Until its handshake arrives we don't
+    know which torrent it is for, so there is no Peer yet. Once the info_hash
+    is known the Client for it is asked to accept the peer, and the
+    connection carries on as a PeerConnection."""
+    def __init__(self, factory):
+        super().__init__(SimpleNamespace(peer=None))
+        self.factory = factory
+        self._handshake = b''
+
+    def connectionMade(self):
+        pass
+
+    def dataReceived(self, data):
+        if self.peer is not None:
+            return super().dataReceived(data)
+
+        self._handshake += data
+        protocol_prefix = bytes([len(constants.PSTR)]) + constants.PSTR
+        if not protocol_prefix.startswith(self._handshake[:len(protocol_prefix)]):
+            # Not speaking BitTorrent.
             self.transport.loseConnection()
-        else:
-            self.transport.write(message.to_bytes())
+            return
+        if len(self._handshake) < HANDSHAKE_LENGTH:
+            return
+
+        info_hash = parse_handshake(self._handshake)['info_hash']
+        client = self.factory.client_for(info_hash)
+        address = self.transport.getPeer()
+        self.peer = client.accept_peer(address.host, address.port) if client else None
+        if self.peer is None:
+            # Not a torrent we have, or no connections to spare for it.
+            self.transport.loseConnection()
+            return
+
+        print('Connection accepted from: {}'.format(self.peer))
+        self._attach()
+        data, self._handshake = self._handshake, b''
+        super().dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self.peer is not None:
+            super().connectionLost(reason)
+
+
+class PeerListenerFactory(ServerFactory):
+    """Accepts connections from peers, handing each to the Client for the
+    info_hash in its handshake.
+
+    Args:
+        client_for: a callable returning the Client for an info_hash, or
+            None if we are not downloading that torrent. Session.client_for
+            for a session.
+    """
+    protocol = InboundPeerConnection
+
+    def __init__(self, client_for):
+        self.client_for = client_for
+
+    def buildProtocol(self, addr):
+        return InboundPeerConnection(self)
+
+
+def listen_for_peers(client_for, port=constants.LISTENING_PORT, interface=constants.LISTENING_HOST):
+    """Listen for peer connections on the reactor. Must be called on the
+    reactor thread.
+
+    Returns:
+        The twisted listening port, which can be stopped with stopListening.
+    """
+    return reactor.listenTCP(port, PeerListenerFactory(client_for), interface=interface)
 
 
 class PeerConnectionFactory(ClientFactory):
@@ -237,15 +668,17 @@ class PeerConnectionFactory(ClientFactory):
 
     def clientConnectionLost(self, connector, reason):
         print('Lost connection:', reason)
-        pass
 
     def clientConnectionFailed(self, connector, reason):
-        # print('Failed connection:', reason)
-        raise PeerConnectionError(reason)
+        # The connection attempt happens on the reactor, long after connect
+        # returned, so report the failure the same way as a lost connection.
+        self.peer.connection_lost(PeerConnectionError(reason))
 
     @classmethod
     def ensure_reactor(cls):
-        if not cls.connection_thread:
+        """Run the reactor on a background thread, unless it is already
+        running (for instance under a Session)."""
+        if not cls.connection_thread and not reactor.running:
             cls.connection_thread = Thread(target=reactor.run, kwargs={'installSignalHandlers': 0})
             cls.connection_thread.start()
 
@@ -0,0 +1,153 @@
+import json
+import os
+import tempfile
+import time
+from threading import Lock
+
+import constants
+
+"""Remember the peers which served each torrent well, so that a restarted
+download can dial them straight away instead of waiting on the tracker."""
+
+VERSION = 1
+ENTRY_SUFFIX = '.peers'
+
+
+class PeerCache:
+    """A size-bounded directory of the good peers of each torrent.
+
+    Each torrent's peers are kept in memory once loaded, and written to a
+    JSON file named for its info_hash by save. Every peer has the time it
+    was last seen (wall clock, as it must survive restarts), its average
+    download rate over its last connection, and the number of times in a row
+    connecting to it has failed.
+
+    Peers not seen for max_age seconds, or which have failed max_failures
+    times in a row, are forgotten. Only the max_peers best of a torrent are
+    kept: the fastest, then the most recently seen. When the files grow past
+    max_bytes the least recently saved are removed.
+
+    Safe to use from several threads.
+    """
+    def __init__(self, directory, max_peers=constants.PEER_CACHE_PEERS, max_age=constants.PEER_CACHE_MAX_AGE,
+                 max_failures=constants.PEER_CACHE_MAX_FAILURES, max_bytes=constants.PEER_CACHE_SIZE,
+                 clock=time.time):
+        self.directory = directory
+        self.max_peers = max_peers
+        self.max_age = max_age
+        self.max_failures = max_failures
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._lock = Lock()
+        # info_hash -> (ip, port) -> entry
+        self._torrents = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def peers(self, info_hash):
+        """Return the torrent's cached peers, best first, as dictionaries
+        with the keys of a tracker's peer list ('ip', 'port', 'id')."""
+        with self._lock:
+            entries = self._entries(info_hash)
+            self._age(entries)
+            return [{'ip': entry['ip'], 'port': entry['port'], 'id': entry['id']}
+                    for entry in sorted(entries.values(), key=_rank)]
+
+    def record_success(self, info_hash, ip, port, peer_id=None, rate=0.0):
+        """Remember a peer which we exchanged data with, and its average
+        download rate in bytes per second."""
+        with self._lock:
+            entries = self._entries(info_hash)
+            entries[(ip, port)] = {'ip': ip, 'port': port, 'id': peer_id, 'last_seen': self._clock(),
+                                   'rate': rate, 'failures': 0}
+            self._age(entries)
+
+    def record_failure(self, info_hash, ip, port):
+        """Count a failed connection to a cached peer. Peers which are not
+        cached are not added."""
+        with self._lock:
+            entries = self._entries(info_hash)
+            entry = entries.get((ip, port))
+            if entry is not None:
+                entry['failures'] += 1
+                self._age(entries)
+
+    def save(self, info_hash):
+        """Write the torrent's peers out."""
+        with self._lock:
+            entries = self._entries(info_hash)
+            self._age(entries)
+            data = json.dumps({'version': VERSION, 'peers': list(entries.values())}).encode('utf-8')
+
+        # Write to a temporary file first so a reader never sees half an entry.
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as entry_file:
+                entry_file.write(data)
+            os.replace(temp_path, self._entry_path(info_hash))
+        except OSError:
+            _remove(temp_path)
+            raise
+        self._evict()
+
+    def _entries(self, info_hash):
+        """The torrent's peers, read from its file on first use. Call with
+        the lock held."""
+        entries = self._torrents.get(info_hash)
+        if entries is None:
+            entries = self._torrents[info_hash] = {}
+            try:
+                with open(self._entry_path(info_hash), 'rb') as entry_file:
+                    data = json.loads(entry_file.read().decode('utf-8'))
+                if data.get('version') == VERSION:
+                    for entry in data['peers']:
+                        entries[(entry['ip'], entry['port'])] = entry
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError, TypeError):
+                # A damaged file is just forgotten.
+                entries.clear()
+        return entries
+
+    def _age(self, entries):
+        """Forget stale and failing peers, and all but the best max_peers.
+        Call with the lock held."""
+        oldest = self._clock() - self.max_age
+        for key, entry in list(entries.items()):
+            if entry['last_seen'] < oldest or entry['failures'] >= self.max_failures:
+                del entries[key]
+        if len(entries) > self.max_peers:
+            for entry in sorted(entries.values(), key=_rank)[self.max_peers:]:
+                del entries[(entry['ip'], entry['port'])]
+
+    def _evict(self):
+        """Remove least recently saved files until the cache fits in
+        max_bytes."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+    def _entry_path(self, info_hash):
+        return os.path.join(self.directory, info_hash.hex() + ENTRY_SUFFIX)
+
+
+def _rank(entry):
+    return -entry['rate'], -entry['last_seen']
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,7 +1,9 @@
-from hashlib import sha1
+from hashlib import sha1, sha256
 
 import constants
-from message import Message, MessageType
+from merkle import BLOCK_LENGTH, HASH_LENGTH, block_hashes, merkle_root
+from message import MessageType, block_message, hash_message
+from profiling import timed
 
 """Handles pieces, which divisions of the file being passed by the torrent."""
 
@@ -10,14 +12,35 @@ class PieceError(Exception):
     pass
 
 
+class PieceHashError(PieceError):
+    pass
+
+
+class BlockHashError(PieceHashError):
+    """A block of a v2 piece did not match its merkle leaf. The rest of the
+    piece is kept."""
+    def __init__(self, message, offset, source):
+        super().__init__(message)
+        self.offset = offset
+        self.source = source
+
+
 def piece_factory(total_length, piece_length, hashes):
     """Creates the piece divisions for a given length and returns
     a generator object that will yield the pieces until they are all
     done."""
-    num_pieces = (total_length // piece_length) + 1
+    num_pieces = len(hashes)
     for i in range(num_pieces - 1):
         yield Piece(i, piece_length, hashes[i])
-    yield Piece(num_pieces - 1, total_length % piece_length, hashes[num_pieces - 1])
+    yield Piece(num_pieces - 1, total_length - (num_pieces - 1) * piece_length, hashes[num_pieces - 1])
+
+
+def merkle_piece_factory(piece_layers):
+    """Like piece_factory, for the pieces of a v2 torrent (see
+    merkle.PieceLayers)."""
+    last = len(piece_layers) - 1
+    for layer in piece_layers:
+        yield MerklePiece(layer, piece_layers.piece_length if layer.index < last else None)
 
 
 class Piece:
@@ -25,15 +48,22 @@ class Piece:
         self.index = piece_index
         self.length = length
         self.hash = piece_hash
-        self._downloaded_bytes = b''
+        # Blocks are appended in place rather than copying the piece so far for each.
+        self._downloaded_bytes = bytearray()
+        self._next_request_offset = 0
         self.completed = False
+        self.started_at = None
+        # An optional MemoryAccount for the bytes held.
+        self.memory = None
 
     @property
     def bytes_downloaded(self):
         return len(self._downloaded_bytes)
 
-    def download(self, offset, bytestring):
-        """Pass this piece bytes which represent parts of it."""
+    @timed('piece_download')
+    def download(self, offset, bytestring, source=None):
+        """Pass this piece bytes which represent parts of it. source is who
+        sent them, which only a MerklePiece keeps track of."""
         if offset != self.bytes_downloaded:
             raise PieceError("Offset Not Matching | {} {}".format(offset, self.bytes_downloaded))
 
@@ -41,9 +71,31 @@ class Piece:
             raise PieceError('Too Many Bytes for Piece | bytes_len: {} downloaded: {} limit: {}', len(bytestring),
                              self.bytes_downloaded, self.length)
         self._downloaded_bytes += bytestring
+        self._account()
         if self.bytes_downloaded == self.length:
             self._complete()
 
+    @property
+    def has_unrequested_blocks(self):
+        return not self.completed and self._next_request_offset < self.length
+
+    def next_request(self):
+        """Claim the next block of the piece that has not been requested.
+
+        Blocks must arrive in order, so requests are handed out from the
+        front of the piece, running ahead of the bytes downloaded so far.
+
+        Returns:
+            A tuple of (piece index, block offset, block length).
+        """
+        if not self.has_unrequested_blocks:
+            raise PieceError("Piece Has No Blocks Left To Request")
+
+        offset = self._next_request_offset
+        request_length = min(constants.REQUEST_LENGTH, self.length - offset)
+        self._next_request_offset += request_length
+        return self.index, offset, request_length
+
     def get_next_request_message(self):
         """Get the request that will cover the next set of bytes that
         the piece requires
@@ -54,26 +106,42 @@ class Piece:
         if self.completed:
             raise PieceError("Piece Is Already Completed")
 
-        request_length = min(constants.REQUEST_LENGTH, self.length - self.bytes_downloaded)
-        index_bytes = int.to_bytes(self.index, length=4, byteorder='big')
-        offset_bytes = int.to_bytes(self.bytes_downloaded, length=4, byteorder='big')
-        length_bytes = int.to_bytes(request_length, length=4, byteorder='big')
-        request_payload = index_bytes + offset_bytes + length_bytes
+        return block_message(MessageType.REQUEST, *self.next_request())
+
+    def reset_requests(self):
+        """Forget the outstanding requests, so the blocks after what has
+        been downloaded can be requested again (perhaps from another peer)."""
+        self._next_request_offset = self.bytes_downloaded
+
+    def reset(self):
+        """Throw away everything downloaded, after a failed hash check."""
+        self._downloaded_bytes = bytearray()
+        self._next_request_offset = 0
+        self.completed = False
+        self._account()
 
-        return Message(MessageType.REQUEST, request_payload)
+    def take_data(self):
+        """Hand over the bytes of a completed piece, which no longer keeps
+        them."""
+        if not self.completed:
+            raise PieceError("Piece Is Not Completed")
+        data, self._downloaded_bytes = self._downloaded_bytes, bytearray()
+        self._account()
+        return data
 
     def writeout(self, file):
         file.write(self._downloaded_bytes)
 
+    def _account(self):
+        if self.memory is not None:
+            self.memory.set(len(self._downloaded_bytes))
+
     def _complete(self):
         if not self._is_hash_valid():
-            raise PieceError("Piece Has a Bad Hash")
-            # TODO: When the client receives this error, it should recreate a piece
-            #       and request it from a different peer.
-        # TODO: Consider writing the bytes to a temp_file, which can be pulled back
-        #       out via writeout. Then deleted.
+            raise PieceHashError("Piece Has a Bad Hash")
         self.completed = True
 
+    @timed('hash_check')
     def _is_hash_valid(self):
         """Checks hash value for downloaded bytes vs the expected"""
         downloaded_hash = sha1(self._downloaded_bytes).digest()
@@ -84,3 +152,99 @@ class Piece:
 
     def __lt__(self, other):
         return self.index < other.index
+
+
+class MerklePiece(Piece):
+    """A piece of a v2 torrent, checked against its file's merkle tree.
+
+    Once the leaf hashes under the piece are known (see hash_request and
+    set_block_hashes), every block is checked as it arrives, so a bad block
+    is thrown away alone and blamed on the peer which sent it. Until then,
+    or if no peer will send them, the whole piece is checked against its
+    piece layer hash when it completes, as a v1 piece is.
+
+    The last piece of a file is padded with zeros up to the piece length
+    when the file is not the torrent's last, as files start on piece
+    boundaries.
+    """
+    def __init__(self, layer, padded_length=None):
+        super().__init__(layer.index, layer.length, layer.hash)
+        self.layer = layer
+        self.padded_length = padded_length or layer.length
+        self.block_hashes = [bytes(layer.hash)] if layer.width == 1 else None
+        self.hashes_requested = False
+        # Who sent each block downloaded so far, to blame them for a bad one.
+        self._sources = []
+
+    @property
+    def needs_block_hashes(self):
+        return self.block_hashes is None and not self.hashes_requested
+
+    def hash_request(self):
+        """A HASH_REQUEST for the leaf hashes under the piece. The piece
+        layer hash is already known, so no proof is asked for."""
+        layer = self.layer
+        return hash_message(MessageType.HASH_REQUEST, layer.root, 0, layer.first_leaf, layer.width, 0)
+
+    def set_block_hashes(self, hashes):
+        """Take the leaf hashes from a HASHES message, and check the blocks
+        already downloaded against them.
+
+        Returns:
+            A list of (offset, source) of the blocks which failed, which have
+            been thrown away along with everything after them.
+        Raises:
+            PieceHashError if the hashes do not match the piece layer hash.
+        """
+        leaves = [hashes[i:i + HASH_LENGTH] for i in range(0, len(hashes), HASH_LENGTH)]
+        if len(leaves) != self.layer.width or merkle_root(leaves, self.layer.width) != self.hash:
+            raise PieceHashError("Block Hashes Do Not Match Piece")
+        self.block_hashes = leaves[:-(-self.length // BLOCK_LENGTH)]
+
+        bad = []
+        downloaded = self._downloaded_bytes
+        for i, leaf in enumerate(block_hashes(downloaded)):
+            if leaf != self.block_hashes[i]:
+                bad.append((i * BLOCK_LENGTH, self._sources[i]))
+        if bad:
+            offset = bad[0][0]
+            del self._downloaded_bytes[offset:]
+            del self._sources[offset // BLOCK_LENGTH:]
+            self._next_request_offset = offset
+            self._account()
+        return bad
+
+    def download(self, offset, bytestring, source=None):
+        """As Piece.download, checking each block against its leaf hash if
+        it is known.
+
+        Raises:
+            BlockHashError if a block is bad. Nothing of bytestring is kept.
+        """
+        if self.block_hashes is not None and offset == self.bytes_downloaded:
+            view = memoryview(bytestring)
+            for i in range(0, len(view), BLOCK_LENGTH):
+                block = (offset + i) // BLOCK_LENGTH
+                if block >= len(self.block_hashes) or sha256(view[i:i + BLOCK_LENGTH]).digest() != self.block_hashes[block]:
+                    raise BlockHashError("Block Has a Bad Hash", offset + i, source)
+        super().download(offset, bytestring, source)
+        self._sources.extend([source] * -(-len(bytestring) // BLOCK_LENGTH))
+
+    def reset(self):
+        super().reset()
+        self._sources = []
+
+    def take_data(self):
+        data = super().take_data()
+        if len(data) < self.padded_length:
+            data += bytes(self.padded_length - len(data))
+        self._sources = []
+        return data
+
+    @timed('hash_check')
+    def _is_hash_valid(self):
+        """Check the whole piece against the piece layer hash, unless each
+        block has been checked already."""
+        if self.block_hashes is not None:
+            return True
+        return merkle_root(block_hashes(self._downloaded_bytes), self.layer.width) == self.hash
@@ -0,0 +1,232 @@
+import os
+import signal
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from inspect import isgeneratorfunction
+from threading import Thread, get_ident
+
+from metrics import Histogram
+import constants
+
+"""Opt-in timing of the client's hot paths, and sampled stack profiles of a
+running process.
+
+Functions wrapped with timed record how long each call takes into a
+histogram per section, but only while PROFILER is enabled. Disabled, the
+wrapper costs one attribute check per call. Setting sample_every times only
+one call in that many, to cut the overhead further on busy sections. A
+generator function is timed over all of its steps as it is consumed, not
+counting the consumer's time between them.
+
+Profiling a whole download with cProfile only sees the thread it was started
+on, while the work here is spread over the reactor and a thread per peer. The
+StackSampler instead looks at the stacks of every thread at a fixed
+interval, and writes them in the folded format flame graph tools read.
+"""
+
+
+class Section:
+    __slots__ = ('name', 'calls', 'histogram')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.histogram = Histogram(constants.PROFILE_BUCKETS)
+
+
+class Profiler:
+    def __init__(self, enabled=constants.PROFILING, sample_every=1):
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self._sections = {}
+
+    def enable(self, sample_every=1):
+        """Start timing sections, every sample_every'th call of each."""
+        self.sample_every = sample_every
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def section(self, name):
+        section = self._sections.get(name)
+        if section is None:
+            section = self._sections.setdefault(name, Section(name))
+        return section
+
+    def timed(self, name):
+        """Decorate a function to be timed as the named section."""
+        section = self.section(name)
+
+        def decorator(function):
+            if isgeneratorfunction(function):
+                return self._timed_generator(section, function)
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                # Not atomic across threads, which only makes sampling a little uneven.
+                section.calls += 1
+                if section.calls % self.sample_every:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    section.histogram.observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def _timed_generator(self, section, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            generator = function(*args, **kwargs)
+            if not self.enabled:
+                return generator
+            section.calls += 1
+            if section.calls % self.sample_every:
+                return generator
+            return _timed_steps(section, generator)
+        return wrapper
+
+    @contextmanager
+    def timing(self, name):
+        """Time a block of code as the named section."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.section(name).histogram.observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return the histogram snapshot of each section that has been
+        timed, keyed by name, with the number of calls seen."""
+        snapshots = {}
+        for name, section in list(self._sections.items()):
+            histogram = section.histogram.snapshot()
+            if histogram['count']:
+                histogram['calls'] = section.calls
+                snapshots[name] = histogram
+        return snapshots
+
+    def reset(self):
+        for section in list(self._sections.values()):
+            section.calls = 0
+            section.histogram = Histogram(constants.PROFILE_BUCKETS)
+
+
+def _timed_steps(section, generator):
+    """Yield from generator, observing the time spent inside it once it
+    is exhausted, fails or is closed."""
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        generator.close()
+        section.histogram.observe(elapsed)
+
+
+PROFILER = Profiler()
+timed = PROFILER.timed
+
+
+class StackSampler:
+    """Samples the stacks of every thread in the process from a background
+    thread, counting each distinct stack."""
+    def __init__(self, interval=constants.PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_ident = get_ident()
+        while self._running:
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    self.stacks[_fold(frame)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def write_folded(self, path):
+        """Write the stacks as '<frame;frame;...> <count>' lines."""
+        with open(path, 'w') as folded_file:
+            for stack, count in self.stacks.most_common():
+                folded_file.write('{} {}\n'.format(stack, count))
+
+
+def _fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def sample_stacks(duration, interval=constants.PROFILE_SAMPLE_INTERVAL):
+    """Sample every thread's stack for duration seconds, blocking meanwhile.
+
+    Returns:
+        The StackSampler, holding the counted stacks.
+    """
+    sampler = StackSampler(interval)
+    sampler.start()
+    time.sleep(duration)
+    sampler.stop()
+    return sampler
+
+
+def install_signal_handler(signum=signal.SIGUSR2, directory='.', duration=constants.PROFILE_CAPTURE_SECONDS):
+    """Capture a profile of the running process when it receives signum.
+
+    The first signal enables section timing, and stack sampling for duration
+    seconds, after which the stacks are written to
+    dripdrop-<pid>-<time>.folded in directory. Section timings are written
+    beside them, and keep being collected until the next signal turns them
+    off. Must be called from the main thread.
+    """
+    def capture():
+        sampler = sample_stacks(duration)
+        stem = os.path.join(directory, 'dripdrop-{}-{}'.format(os.getpid(), int(time.time())))
+        sampler.write_folded(stem + '.folded')
+        with open(stem + '.sections', 'w') as sections_file:
+            for name, histogram in sorted(PROFILER.snapshot().items()):
+                sections_file.write('{} calls={} timed={} mean={:.9f}s\n'.format(
+                    name, histogram['calls'], histogram['count'], histogram['sum'] / histogram['count']))
+
+    def handle_signal(signum, frame):
+        if PROFILER.enabled:
+            PROFILER.disable()
+        else:
+            PROFILER.enable(PROFILER.sample_every)
+            Thread(target=capture, daemon=True).start()
+
+    signal.signal(signum, handle_signal)
@@ -0,0 +1,78 @@
+import time
+from threading import Lock
+
+import constants
+
+"""Token bucket bandwidth limiting for uploads and downloads.
+
+Buckets form a hierarchy (global -> torrent -> peer). Bytes are charged to a
+bucket and every bucket above it, and the caller is told how long to hold off
+before moving more data.
+"""
+
+
+class TokenBucket:
+    """A token bucket which allows debt.
+
+    Rather than refusing a transfer that is larger than the tokens on hand,
+    consume always charges the full amount and returns how long it will take
+    the bucket to pay the debt back. Large network reads and writes can then
+    be charged in a single call, with no splitting, and the long run rate
+    stays accurate however big the chunks are.
+
+    A rate of None means unlimited. An unlimited bucket with no parent costs
+    one attribute check per call.
+    """
+    def __init__(self, rate=None, burst=None, parent=None, clock=time.monotonic):
+        self.parent = parent
+        self._clock = clock
+        self._lock = Lock()
+        self._rate = None
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate (bytes per second) and burst size (bytes)."""
+        with self._lock:
+            self._rate = rate or None
+            if self._rate is None:
+                self.burst = None
+                self._tokens = 0.0
+            else:
+                self.burst = burst or max(self._rate * constants.RATE_LIMIT_BURST_SECONDS, constants.REQUEST_LENGTH)
+                self._tokens = self.burst
+            self._last = self._clock()
+
+    def consume(self, amount):
+        """Charge amount bytes to this bucket and its parents.
+
+        Returns:
+            The number of seconds the caller should wait before transferring
+            anything more, or 0.
+        """
+        delay = 0.0
+        if self._rate is not None:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                self._tokens -= amount
+                if self._tokens < 0:
+                    delay = -self._tokens / self._rate
+        if self.parent is not None:
+            delay = max(delay, self.parent.consume(amount))
+        return delay
+
+
+class RateLimits:
+    """The download and upload buckets for one level of the hierarchy."""
+    def __init__(self, download_rate=None, upload_rate=None, parent=None):
+        self.download = TokenBucket(download_rate, parent=parent.download if parent else None)
+        self.upload = TokenBucket(upload_rate, parent=parent.upload if parent else None)
+
+    def child(self, download_rate=None, upload_rate=None):
+        """Make the limits for the level below this one."""
+        return RateLimits(download_rate, upload_rate, parent=self)
@@ -0,0 +1,192 @@
+import argparse
+import tempfile
+from hashlib import sha1
+from struct import unpack
+
+from client import Client
+from message import Message, MessageQueue, MessageType, PieceMessage, block_message, get_handshake
+from peer import Peer
+from piece import piece_factory
+from timerwheel import TimerWheel
+from tracelog import read_trace, INBOUND, OUTBOUND
+import constants
+
+"""Replay recorded peer traces (see tracelog) through a Client offline.
+
+The inbound messages of one or more traces are merged by timestamp, turned
+back into wire bytes, and fed through each peer's MessageParser and the
+Client's message handler on this thread, with no network or reactor. What the
+Client sends in response is collected so it can be compared with what it sent
+when the trace was recorded.
+
+Traces hold no piece data. Blocks are read from the downloaded file when one
+is given. Otherwise they are zero filled, and the piece hashes are replaced
+with those of zero filled pieces so that they still pass verification.
+Timer driven behaviour (request timeouts, keep-alives) is not replayed.
+
+Usage:
+    python3 replay.py example.torrent trace1.ddtrace [trace2.ddtrace ...]
+"""
+
+
+class ReplayResult:
+    def __init__(self):
+        self.inbound = 0
+        # (timestamp of the inbound message which caused it, peer, message)
+        self.sent = []
+        # (timestamp, peer, message type, index, offset, length) as recorded.
+        self.recorded = []
+        self.completed_pieces = 0
+
+    def divergences(self, message_types=(MessageType.REQUEST, MessageType.CANCEL)):
+        """Compare the replayed and recorded block requests of each peer.
+
+        Returns:
+            A list of (peer, replayed, recorded) where the sequences of
+            (type, index, offset, length) differ, with both sequences.
+        """
+        replayed = {}
+        for _, peer, message in self.sent:
+            if message.type in message_types:
+                replayed.setdefault(peer, []).append(_describe(message))
+        recorded = {}
+        for _, peer, message_type, index, offset, length in self.recorded:
+            if message_type in message_types:
+                recorded.setdefault(peer, []).append((message_type, index, offset, length))
+
+        result = []
+        for peer in sorted(set(replayed) | set(recorded)):
+            if replayed.get(peer, []) != recorded.get(peer, []):
+                result.append((peer, replayed.get(peer, []), recorded.get(peer, [])))
+        return result
+
+
+def replay(tor_file_path, trace_paths, data_path=None):
+    """Replay the traces through a fresh Client for the torrent.
+
+    Returns:
+        A ReplayResult.
+    """
+    result = ReplayResult()
+    with tempfile.TemporaryDirectory() as download_directory:
+        client = Client(on_complete=lambda client: None, timer_wheel=TimerWheel(),
+                        download_directory=download_directory, trace_directory=None)
+        client.add_torrent(tor_file_path)
+        torrent = client.torrent
+        data_file = open(data_path, 'rb') if data_path else None
+        if data_file is None:
+            client.unrequested_pieces = piece_factory(torrent.length, torrent.piece_length,
+                                                      _ZeroPieceHashes(torrent))
+
+        events = []
+        for trace_path in trace_paths:
+            header, records = read_trace(trace_path)
+            if header['info_hash'] != torrent.info_hash:
+                raise ValueError('Trace Is For Another Torrent | {}'.format(trace_path))
+            name = '{}:{}'.format(header['ip'], header['port'])
+            peer_id = header['peer_id'] if header['peer_id'].strip('\x00') else None
+            peer = Peer(peer_id, header['ip'], header['port'], torrent)
+            client._peers.append(peer)
+            receiver = client.peer_message_receiver(peer)
+            # Traces don't keep the reserved bytes of the handshake, so the
+            # Fast Extension is assumed to have been on if any of its
+            # messages were received.
+            peer.replay_fast = any(record[1] == INBOUND and record[2] in _FAST_TYPES for record in records)
+            for record in records:
+                timestamp, direction, message_type = record[:3]
+                if direction == OUTBOUND:
+                    result.recorded.append((timestamp, name, message_type) + record[3:6])
+                else:
+                    events.append((timestamp, len(events), name, peer, receiver, record))
+
+        try:
+            for timestamp, _, name, peer, receiver, record in sorted(events):
+                peer.handle_messages(_wire_bytes(record, peer, torrent, data_file))
+                while not peer.messages_from_peer.empty():
+                    message = peer.messages_from_peer.get_nowait()
+                    if message is not MessageQueue.STOP:
+                        receiver(message)
+                result.inbound += 1
+                for other in client._peers:
+                    while not other.messages_to_peer.empty():
+                        message = other.messages_to_peer.get_nowait()
+                        if message is not MessageQueue.STOP:
+                            result.sent.append((timestamp, '{}:{}'.format(other.ip, other.port), message))
+        finally:
+            if data_file:
+                data_file.close()
+        result.completed_pieces = client.num_completed_pieces
+    return result
+
+
+def _wire_bytes(record, peer, torrent, data_file):
+    """Rebuild the bytes a peer sent from a trace record."""
+    _, _, message_type, index, offset, length, bitfield = record
+    if message_type is MessageType.HANDSHAKE:
+        reserved = constants.RESERVED if peer.replay_fast else bytes(len(constants.RESERVED))
+        return get_handshake(peer.peer_id or '-RP0001-000000000000', torrent.info_hash, reserved).to_bytes()
+    elif message_type is MessageType.PIECE:
+        if data_file:
+            data_file.seek(index * torrent.piece_length + offset)
+            block = data_file.read(length)
+        else:
+            block = bytes(length)
+        return PieceMessage.from_block(index, offset, block).to_bytes()
+    elif message_type in (MessageType.REQUEST, MessageType.CANCEL, MessageType.REJECT):
+        return block_message(message_type, index, offset, length).to_bytes()
+    elif message_type in (MessageType.HAVE, MessageType.SUGGEST, MessageType.ALLOWED_FAST):
+        return Message(message_type, index.to_bytes(4, 'big')).to_bytes()
+    elif message_type is MessageType.BITFIELD:
+        return Message(MessageType.BITFIELD, bitfield).to_bytes()
+    elif length:
+        return Message(message_type, bytes(length)).to_bytes()
+    return Message.factory(message_type).to_bytes()
+
+
+_FAST_TYPES = frozenset((MessageType.SUGGEST, MessageType.HAVE_ALL, MessageType.HAVE_NONE,
+                         MessageType.REJECT, MessageType.ALLOWED_FAST))
+
+
+def _describe(message):
+    return (message.type,) + unpack('!III', message.payload)
+
+
+class _ZeroPieceHashes:
+    """The piece hashes of a torrent whose data is all zeros."""
+    def __init__(self, torrent):
+        self._torrent = torrent
+        self._full = sha1(bytes(torrent.piece_length)).digest()
+
+    def __len__(self):
+        return self._torrent.num_pieces
+
+    def __getitem__(self, index):
+        if index == self._torrent.num_pieces - 1:
+            last_length = self._torrent.length - index * self._torrent.piece_length
+            return sha1(bytes(last_length)).digest()
+        return self._full
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay DripDrop wire traces through a Client.')
+    parser.add_argument('torrent', help='the .torrent file the traces were recorded for')
+    parser.add_argument('traces', nargs='+', help='trace files to replay together')
+    parser.add_argument('--data', help='the downloaded file, to replay real blocks')
+    args = parser.parse_args()
+
+    result = replay(args.torrent, args.traces, args.data)
+    print('Replayed {} inbound messages; client sent {} messages and completed {} pieces.'.format(
+        result.inbound, len(result.sent), result.completed_pieces))
+    divergences = result.divergences()
+    for peer, replayed, recorded in divergences:
+        print('{}: replay made {} requests, trace recorded {}'.format(peer, len(replayed), len(recorded)))
+        for i, (mine, theirs) in enumerate(zip(replayed, recorded)):
+            if mine != theirs:
+                print('  first difference at #{}: replay {} | trace {}'.format(i, mine, theirs))
+                break
+    if not divergences:
+        print('Replayed requests match the trace.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+from enum import Enum
+
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+
+from client import Client
+from memory import MemoryBudget
+from peer import ConnectionLimiter, PeerConnectionFactory, listen_for_peers
+from ratelimit import RateLimits
+from timerwheel import TimerWheel
+import constants
+
+"""Run many torrents in one process, sharing a single reactor."""
+
+
+class SessionError(Exception):
+    pass
+
+
+class TorrentState(Enum):
+    QUEUED = 'queued'
+    ACTIVE = 'active'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    STOPPED = 'stopped'
+
+
+class Session:
+    """Owns a set of Clients, one per torrent, and schedules them on the
+    shared reactor.
+
+    At most max_active_torrents are downloading at once; the others wait in
+    the order they were added and are started as active ones finish. All
+    clients draw connections from one ConnectionLimiter, so the process as a
+    whole never holds more than max_connections peer connections.
+
+    Bandwidth is limited by a hierarchy of token buckets: the session's
+    global rates, optional per-torrent rates given to add_torrent, then the
+    per-peer rates in constants.
+
+    Every torrent downloads into download_directory.
+
+    The clients share a MemoryBudget of memory_budget bytes (None for no
+    limit), so the pieces, buffers and queues of all of them together stay
+    within it (see memory). memory_usage reports what they hold.
+
+    Clients share the optional peer_cache, which remembers good peers across
+    restarts (see peercache).
+
+    Once running, the session listens on listen_port (None not to listen)
+    on listen_interface ('' for every interface), and incoming connections are routed to the right Client by the info_hash
+    in their handshake (see client_for).
+
+    State changes happen on the reactor thread. Tracker announces block, so
+    clients are started on the reactor's thread pool.
+    """
+    def __init__(self, max_active_torrents=constants.MAX_ACTIVE_TORRENTS,
+                 max_connections=constants.MAX_CONNECTIONS,
+                 max_connections_per_torrent=constants.MAX_CONNECTIONS_PER_TORRENT,
+                 metainfo_cache=None, download_rate=None, upload_rate=None,
+                 listen_port=constants.LISTENING_PORT, peer_cache=None, download_directory='.',
+                 memory_budget=constants.MEMORY_BUDGET, listen_interface=constants.LISTENING_HOST):
+        self.listen_port = listen_port
+        self.listen_interface = listen_interface
+        self.download_directory = download_directory
+        self._listening = None
+        self.rate_limits = RateLimits(download_rate, upload_rate)
+        self.timer_wheel = TimerWheel()
+        self.max_active_torrents = max_active_torrents
+        self.max_connections_per_torrent = max_connections_per_torrent
+        self.connection_limiter = ConnectionLimiter(max_connections)
+        self.memory = MemoryBudget(memory_budget)
+        self._metainfo_cache = metainfo_cache
+        self._peer_cache = peer_cache
+        self._clients = {}
+        self._states = {}
+        self._errors = {}
+        self._queue = []
+
+    def add_torrent(self, tor_file_path, download_rate=None, upload_rate=None):
+        """Load a torrent and queue it for download, optionally with its own
+        rate limits (bytes per second).
+
+        Returns:
+            The torrent's info_hash, which identifies it in the session.
+        Raises:
+            TorrentError if the file cannot be loaded.
+            SessionError if the torrent is already in the session.
+        """
+        client = Client(metainfo_cache=self._metainfo_cache, peer_cache=self._peer_cache,
+                        connection_limiter=self.connection_limiter,
+                        max_connections=self.max_connections_per_torrent,
+                        on_complete=self._handle_client_complete,
+                        on_failed=self._handle_client_starved,
+                        rate_limits=self.rate_limits.child(download_rate, upload_rate),
+                        timer_wheel=self.timer_wheel,
+                        download_directory=self.download_directory,
+                        memory_budget=self.memory)
+        client.add_torrent(tor_file_path)
+        info_hash = client.info_hash
+        if info_hash in self._clients:
+            raise SessionError('Session already has Torrent | {}'.format(info_hash.hex()))
+
+        self._clients[info_hash] = client
+        self._states[info_hash] = TorrentState.QUEUED
+        self._queue.append(info_hash)
+        if reactor.running:
+            reactor.callFromThread(self._schedule)
+        return info_hash
+
+    def remove_torrent(self, info_hash):
+        """Stop a torrent and forget about it."""
+        client = self._clients.pop(info_hash, None)
+        if client is None:
+            raise SessionError('No Torrent With That Info Hash | {}'.format(info_hash.hex()))
+        if info_hash in self._queue:
+            self._queue.remove(info_hash)
+        was_active = self._states.pop(info_hash) == TorrentState.ACTIVE
+        self._errors.pop(info_hash, None)
+        client.stop()
+        if was_active and reactor.running:
+            reactor.callFromThread(self._schedule)
+
+    def client_for(self, info_hash):
+        """Return the active Client for an info_hash, or None. Used to route
+        incoming connections."""
+        if self._states.get(info_hash) == TorrentState.ACTIVE:
+            return self._clients[info_hash]
+        return None
+
+    def status(self):
+        """Return a list of dictionaries describing each torrent."""
+        statuses = []
+        for info_hash, client in self._clients.items():
+            statuses.append({
+                'name': client.torrent.name,
+                'info_hash': info_hash.hex(),
+                'state': self._states[info_hash].value,
+                'pieces': client.num_completed_pieces,
+                'num_pieces': client.torrent.num_pieces,
+                'peers': client.connected_peers,
+                'error': self._errors.get(info_hash),
+            })
+        return statuses
+
+    def metrics(self):
+        """Return a metrics snapshot for each torrent, keyed by info_hash
+        hex, as names need not be unique. This is the snapshot_source for
+        metrics.listen_metrics."""
+        return {info_hash.hex(): client.metrics_snapshot() for info_hash, client in list(self._clients.items())}
+
+    def memory_usage(self):
+        """Return the bytes the session's torrents hold, by category (see
+        MemoryBudget.usage)."""
+        return self.memory.usage()
+
+    @property
+    def active_torrents(self):
+        return sum(1 for state in self._states.values() if state == TorrentState.ACTIVE)
+
+    def run(self):
+        """Run the session on the reactor in this thread until stop is
+        called."""
+        reactor.callWhenRunning(self._listen)
+        reactor.callWhenRunning(self._schedule)
+        self.timer_wheel.start()
+        reactor.run()
+
+    def start(self):
+        """Run the session on a background reactor thread."""
+        PeerConnectionFactory.ensure_reactor()
+        self.timer_wheel.start()
+        reactor.callFromThread(self._listen)
+        reactor.callFromThread(self._schedule)
+
+    def stop(self):
+        for info_hash, client in self._clients.items():
+            if self._states[info_hash] == TorrentState.ACTIVE:
+                self._states[info_hash] = TorrentState.STOPPED
+                client.stop()
+        self._queue = []
+        self.timer_wheel.stop()
+        if self._listening:
+            reactor.callFromThread(self._listening.stopListening)
+            self._listening = None
+        reactor.callFromThread(reactor.stop)
+
+    def _listen(self):
+        if self.listen_port is None or self._listening:
+            return
+        try:
+            self._listening = listen_for_peers(self.client_for, self.listen_port, self.listen_interface)
+        except CannotListenError as e:
+            # Outgoing connections still work, so carry on without.
+            print('Not Accepting Peer Connections:', e)
+
+    def _schedule(self):
+        """Start queued torrents while there are free active slots."""
+        while self._queue and self.active_torrents < self.max_active_torrents:
+            info_hash = self._queue.pop(0)
+            self._states[info_hash] = TorrentState.ACTIVE
+            reactor.callInThread(self._start_client, info_hash, self._clients[info_hash])
+
+    def _start_client(self, info_hash, client):
+        """Runs on the thread pool, as contacting the tracker blocks."""
+        try:
+            client.start_torrent()
+        except Exception as e:
+            reactor.callFromThread(self._handle_client_failed, info_hash, e)
+
+    def _handle_client_complete(self, client):
+        reactor.callFromThread(self._finish, client.info_hash, TorrentState.COMPLETE)
+
+    def _handle_client_starved(self, client, error):
+        reactor.callFromThread(self._handle_client_failed, client.info_hash, error)
+
+    def _handle_client_failed(self, info_hash, error):
+        self._errors[info_hash] = str(error)
+        client = self._clients.get(info_hash)
+        if client:
+            client.stop()
+        self._finish(info_hash, TorrentState.FAILED)
+
+    def _finish(self, info_hash, state):
+        if self._states.get(info_hash) == TorrentState.ACTIVE:
+            self._states[info_hash] = state
+            self._schedule()
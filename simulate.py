@@ -0,0 +1,305 @@
+import argparse
+import os
+import random
+import resource
+import tempfile
+import time
+from hashlib import sha1, sha256
+from math import ceil
+from struct import unpack
+from threading import Event
+
+from bencode3 import bencode
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.threads import blockingCallFromThread
+
+from client import Client
+from merkle import BLOCK_LENGTH, ZERO_HASH, block_hashes, merkle_root, next_power_of_two
+from message import Message, MessageParser, MessageType, PieceMessage, get_handshake, parse_handshake, \
+    hash_message, parse_hash_message
+from peer import PeerConnectionFactory
+import constants
+
+"""Simulate a swarm in this process, to measure a whole Client download.
+
+A stand-in HTTP tracker and a number of seeders listen on loopback, on the
+same reactor the Client uses. Every seeder has the whole file and serves
+block requests over the real wire protocol, with configurable latency and
+bandwidth. Seeders can also drop their connections after a random lifetime
+(churn) and corrupt a share of the blocks they send. The swarm can share a v2
+torrent (BEP 52) instead, whose seeders answer hash requests.
+
+As the seeders run in the same process, the CPU time and peak RSS reported
+include theirs. They do little more than slice the file and write it out, so
+the figures are still good for spotting regressions in the Client.
+
+Usage:
+    python3 simulate.py --seeders 8 --size 64 --latency 0.02
+"""
+
+SEEDER_ID_PREFIX = '-SIM001-'
+
+
+class SimulatedSeeder(Protocol):
+    """One seeder's side of a connection from the Client."""
+    def __init__(self, swarm, seeder_id):
+        self.swarm = swarm
+        self.seeder_id = seeder_id
+        self._buffer = b''
+        self._hands_shook = False
+        self._parser = MessageParser()
+        self._pending = {}
+        self._next_free = 0.0
+
+    def connectionMade(self):
+        if self.swarm.churn:
+            lifetime = self.swarm.random.expovariate(1 / self.swarm.churn)
+            self._pending['churn'] = reactor.callLater(lifetime, self.transport.loseConnection)
+
+    def dataReceived(self, data):
+        if not self._hands_shook:
+            self._buffer += data
+            handshake_length = 49 + len(constants.PSTR)
+            if len(self._buffer) < handshake_length:
+                return
+            handshake, data, self._buffer = self._buffer[:handshake_length], self._buffer[handshake_length:], b''
+            self._hands_shook = True
+            self._greet(parse_handshake(handshake)['fast'])
+
+        for message in self._parser(data):
+            if message.type == MessageType.REQUEST:
+                self._schedule_block(*unpack('!III', message.payload))
+            elif message.type == MessageType.CANCEL:
+                index, offset, _ = unpack('!III', message.payload)
+                call = self._pending.pop((index, offset), None)
+                if call is not None and call.active():
+                    call.cancel()
+            elif message.type == MessageType.HASH_REQUEST:
+                self._send_hashes(*parse_hash_message(message.payload)[:5])
+
+    def _greet(self, fast):
+        """Answer the handshake, and offer every piece."""
+        if fast:
+            have = Message.factory(MessageType.HAVE_ALL)
+        else:
+            num_pieces = self.swarm.num_pieces
+            bitfield = bytearray(b'\xff' * ceil(num_pieces / 8))
+            if num_pieces % 8:
+                bitfield[-1] = (0xff << (8 - num_pieces % 8)) & 0xff
+            have = Message(MessageType.BITFIELD, bytes(bitfield))
+        self.transport.writeSequence([
+            get_handshake(self.seeder_id, self.swarm.info_hash).to_bytes(),
+            have.to_bytes(),
+            Message.factory(MessageType.UNCHOKE).to_bytes(),
+        ])
+
+    def _schedule_block(self, index, offset, length):
+        """Send a block after the link's latency, and after the blocks
+        ahead of it have been sent at the link's bandwidth."""
+        now = reactor.seconds()
+        send_at = max(now + self.swarm.latency, self._next_free)
+        if self.swarm.bandwidth:
+            self._next_free = send_at + (length + 13) / self.swarm.bandwidth
+        self._pending[(index, offset)] = reactor.callLater(send_at - now, self._send_block, index, offset, length)
+
+    def _send_block(self, index, offset, length):
+        self._pending.pop((index, offset), None)
+        start = index * self.swarm.piece_length + offset
+        block = self.swarm.data[start:start + length]
+        if self.swarm.random.random() < self.swarm.corrupt:
+            block = bytes([block[0] ^ 0xff]) + bytes(block[1:])
+            self.swarm.corrupted_blocks += 1
+        self.transport.writeSequence(PieceMessage.from_block(index, offset, block).to_chunks())
+
+    def _send_hashes(self, root, base_layer, index, length, proof_layers):
+        """Answer a request for leaf hashes. Anything else is rejected."""
+        leaves = self.swarm.leaves
+        if base_layer or proof_layers or not leaves or root != self.swarm.pieces_root:
+            self.transport.write(hash_message(MessageType.HASH_REJECT, root, base_layer, index, length,
+                                              proof_layers).to_bytes())
+            return
+        hashes = leaves[index:index + length]
+        hashes += [ZERO_HASH] * (length - len(hashes))
+        self.transport.write(hash_message(MessageType.HASHES, root, 0, index, length, 0, b''.join(hashes)).to_bytes())
+
+    def connectionLost(self, reason):
+        for call in self._pending.values():
+            if call.active():
+                call.cancel()
+        self._pending = {}
+
+
+class Swarm:
+    """A tracker and seeders for one file, on the running reactor.
+
+    Args:
+        data: the file being shared.
+        seeders: how many seeders to run.
+        latency: seconds each seeder waits before answering a request.
+        bandwidth: bytes per second each seeder can send, or None.
+        churn: mean seconds a seeder keeps a connection before dropping it,
+            or None to keep connections. The tracker lists every seeder
+            several times over, as the Client does not announce again and
+            would otherwise run out of peers.
+        corrupt: the share of blocks sent with a flipped byte.
+        v2: share a v2 only torrent rather than a v1 one.
+    """
+    def __init__(self, data, piece_length=2 ** 18, seeders=4, latency=0.0, bandwidth=None, churn=None,
+                 corrupt=0.0, seed=0, v2=False):
+        self.data = bytes(data)
+        self.piece_length = piece_length
+        self.num_pieces = ceil(len(data) / piece_length)
+        self.seeders = seeders
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.churn = churn
+        self.corrupt = corrupt
+        self.random = random.Random(seed)
+        self.corrupted_blocks = 0
+        self.leaves = self.pieces_root = None
+        self.piece_layers = {}
+        if v2:
+            self.leaves = block_hashes(self.data)
+            self.pieces_root = merkle_root(self.leaves, next_power_of_two(len(self.leaves)))
+            blocks_per_piece = piece_length // BLOCK_LENGTH
+            if len(data) > piece_length:
+                self.piece_layers[self.pieces_root] = b''.join(
+                    merkle_root(self.leaves[i:i + blocks_per_piece], blocks_per_piece)
+                    for i in range(0, len(self.leaves), blocks_per_piece))
+            self.info = {
+                'name': 'simulated.bin',
+                'piece length': piece_length,
+                'meta version': 2,
+                'file tree': {'simulated.bin': {'': {'length': len(data), 'pieces root': self.pieces_root}}},
+            }
+            self.info_hash = sha256(bencode(self.info)).digest()[:20]
+        else:
+            self.info = {
+                'name': 'simulated.bin',
+                'length': len(data),
+                'piece length': piece_length,
+                'pieces': b''.join(sha1(data[i:i + piece_length]).digest()
+                                   for i in range(0, len(data), piece_length)),
+            }
+            self.info_hash = sha1(bencode(self.info)).digest()
+        self.tracker_port = None
+        self._ports = []
+
+    def listen(self):
+        """Start the tracker and seeders. Must run on the reactor thread."""
+        from twisted.web.resource import Resource
+        from twisted.web.server import Site
+
+        for i in range(self.seeders):
+            factory = Factory.forProtocol(SimulatedSeeder)
+            seeder_id = '{}{:012d}'.format(SEEDER_ID_PREFIX, i)
+            factory.buildProtocol = lambda addr, seeder_id=seeder_id: SimulatedSeeder(self, seeder_id)
+            self._ports.append(reactor.listenTCP(0, factory, interface='127.0.0.1'))
+
+        peers = [{'ip': '127.0.0.1', 'port': port.getHost().port} for port in self._ports]
+        if self.churn:
+            peers *= 8
+        response = bencode({'interval': 1800, 'peers': peers})
+
+        class Announce(Resource):
+            isLeaf = True
+
+            def render_GET(self, request):
+                return response
+
+        root = Resource()
+        root.putChild(b'announce', Announce())
+        tracker = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self._ports.append(tracker)
+        self.tracker_port = tracker.getHost().port
+
+    def close(self):
+        for port in self._ports:
+            port.stopListening()
+        self._ports = []
+
+    def write_torrent(self, directory):
+        """Write the .torrent for the swarm and return its path."""
+        metadict = {'announce': 'http://127.0.0.1:{}/announce'.format(self.tracker_port), 'info': self.info}
+        if self.piece_layers:
+            metadict['piece layers'] = self.piece_layers
+        path = os.path.join(directory, 'simulated.torrent')
+        with open(path, 'wb') as tor_file:
+            tor_file.write(bencode(metadict))
+        return path
+
+
+def run_download(swarm, timeout=300, **client_options):
+    """Download the swarm's file with a fresh Client.
+
+    Returns:
+        A dictionary of the download's size, seconds, MB/s, CPU seconds per
+        GB, peak RSS in MB and the Client's wasted bytes and hash failures.
+    Raises:
+        TimeoutError if the download does not complete within timeout.
+    """
+    PeerConnectionFactory.ensure_reactor()
+    blockingCallFromThread(reactor, swarm.listen)
+    done = Event()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            client = Client(on_complete=lambda client: done.set(), download_directory=directory, **client_options)
+            client.add_torrent(swarm.write_torrent(directory))
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            start = time.perf_counter()
+            client.start_torrent()
+            if not done.wait(timeout):
+                client.stop()
+                raise TimeoutError('Download Did Not Complete in {} Seconds'.format(timeout))
+            elapsed = time.perf_counter() - start
+            finished = resource.getrusage(resource.RUSAGE_SELF)
+            with open(os.path.join(directory, client.torrent.target_file_name), 'rb') as target_file:
+                if target_file.read() != swarm.data:
+                    raise ValueError('Downloaded File Does Not Match')
+    finally:
+        blockingCallFromThread(reactor, swarm.close)
+
+    size = len(swarm.data)
+    cpu = (finished.ru_utime - usage.ru_utime) + (finished.ru_stime - usage.ru_stime)
+    return {
+        'bytes': size,
+        'seconds': elapsed,
+        'mb_per_second': size / elapsed / 2 ** 20,
+        'cpu_seconds_per_gb': cpu / (size / 2 ** 30),
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': finished.ru_maxrss / 1024,
+        'wasted_bytes': client.metrics.wasted_bytes,
+        'hash_failures': client.metrics.hash_failures,
+    }
+
+
+def format_result(result):
+    return ('{mb_per_second:.1f} MB/s | {cpu_seconds_per_gb:.1f} CPU s/GB | peak RSS {peak_rss_mb:.0f} MB | '
+            '{seconds:.2f} s | wasted {wasted_bytes} B | hash failures {hash_failures}').format(**result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download from a simulated swarm and report throughput.')
+    parser.add_argument('--seeders', type=int, default=4)
+    parser.add_argument('--size', type=float, default=64, help='file size in MiB')
+    parser.add_argument('--piece-length', type=int, default=2 ** 18)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each block is sent')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MiB/s each seeder can send')
+    parser.add_argument('--churn', type=float, default=None, help='mean seconds a seeder keeps a connection')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='share of blocks corrupted')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--v2', action='store_true', help='share a v2 torrent')
+    args = parser.parse_args()
+
+    data = random.Random(args.seed).randbytes(int(args.size * 2 ** 20))
+    swarm = Swarm(data, args.piece_length, args.seeders, args.latency,
+                  args.bandwidth * 2 ** 20 if args.bandwidth else None, args.churn, args.corrupt, args.seed, args.v2)
+    try:
+        print(format_result(run_download(swarm)))
+    finally:
+        reactor.callFromThread(reactor.stop)
+
+
+if __name__ == '__main__':
+    main()
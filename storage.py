@@ -0,0 +1,295 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import constants
+
+"""Write downloaded pieces to the target file, through a write-back cache,
+and read them back through an LRU cache to upload them."""
+
+
+class StorageError(Exception):
+    pass
+
+
+class Storage:
+    """The file a torrent downloads into.
+
+    Pieces are verified in whatever order peers deliver them, so writing
+    each one as it completes means many small writes scattered over the
+    file. Instead completed pieces are held in a cache and written in large
+    contiguous runs.
+
+    The file is divided into extents of extent_size bytes, aligned to the
+    start of the file. As soon as every piece overlapping an extent has
+    arrived, the cached ones are written together. Whatever else is cached
+    is written when the cache holds more than cache_size bytes, or when its
+    oldest piece has waited flush_interval seconds (see flush_expired).
+    Writes are only aligned if extent_size is a multiple of the piece length.
+
+    After writing, the file can be fsynced, and the written range dropped
+    from the page cache with posix_fadvise where the platform has it, so a
+    long download does not crowd everything else out of memory.
+
+    Safe to use from several threads.
+    """
+    def __init__(self, path, length, piece_length, cache_size=constants.WRITE_CACHE_SIZE,
+                 extent_size=constants.WRITE_EXTENT_SIZE, flush_interval=constants.WRITE_FLUSH_INTERVAL,
+                 fsync=constants.WRITE_FSYNC, fadvise=constants.WRITE_FADVISE, clock=time.monotonic):
+        self.path = path
+        self.length = length
+        self.piece_length = piece_length
+        self.num_pieces = -(-length // piece_length)
+        self.cache_size = cache_size
+        self.extent_size = extent_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self.closed = False
+        self._clock = clock
+        self._lock = Lock()
+        # Pieces waiting to be written, index -> data, and when each arrived,
+        # oldest first.
+        self._cache = {}
+        self._cached_bytes = 0
+        self._arrived = {}
+        # Every piece that has been given to us, written or not.
+        self._stored = set()
+        self.writes = 0
+        self.written_bytes = 0
+
+        try:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            os.ftruncate(self._fd, length)
+        except OSError as e:
+            raise StorageError('Could Not Open Target File | {} | {}'.format(path, e))
+
+    def write_piece(self, index, data):
+        """Store a verified piece. It is written out once its extent is
+        complete, or the cache fills or times out."""
+        if len(data) != self._piece_size(index):
+            raise StorageError('Wrong Length for Piece | {} {}'.format(index, len(data)))
+
+        with self._lock:
+            if self.closed:
+                raise StorageError('Storage Is Closed')
+            if index not in self._cache:
+                self._cached_bytes += len(data)
+            self._cache[index] = data
+            self._stored.add(index)
+            self._arrived.setdefault(index, self._clock())
+
+            start = index * self.piece_length
+            for extent in range(start // self.extent_size, (start + len(data) - 1) // self.extent_size + 1):
+                pieces = self._extent_pieces(extent)
+                if all(i in self._stored for i in pieces):
+                    self._write(i for i in pieces if i in self._cache)
+
+            if self._cached_bytes > self.cache_size or self._expired():
+                self._write(list(self._cache))
+
+    def read_piece(self, index):
+        """Return a stored piece, from the cache if it has not been written
+        yet."""
+        return self.read_pieces(index, 1)[0]
+
+    def read_pieces(self, index, count):
+        """Return count consecutive pieces starting at index, read from the
+        file in one call.
+
+        Raises:
+            StorageError if the storage is closed or the file can't be read.
+        """
+        start = index * self.piece_length
+        end = start + sum(self._piece_size(i) for i in range(index, index + count))
+        # Held while reading, so a piece can't be written out between reading
+        # the file and looking in the cache, nor the file closed under us.
+        with self._lock:
+            if self.closed:
+                raise StorageError('Storage Is Closed')
+            try:
+                data = os.pread(self._fd, end - start, start)
+            except OSError as e:
+                raise StorageError('Could Not Read Target File | {} | {}'.format(self.path, e))
+            pieces = [data[i:i + self.piece_length] for i in range(0, len(data), self.piece_length)]
+            for i in range(count):
+                cached = self._cache.get(index + i)
+                if cached is not None:
+                    pieces[i] = bytes(cached)
+        return pieces
+
+    def has_piece(self, index):
+        return index in self._stored
+
+    def piece_size(self, index):
+        return self._piece_size(index)
+
+    def flush_expired(self):
+        """Write the cache out if its oldest piece has waited long enough.
+        Meant to be called periodically, so a stalled download does not hold
+        pieces in memory indefinitely."""
+        with self._lock:
+            if not self.closed and self._expired():
+                self._write(list(self._cache))
+
+    def flush(self):
+        """Write everything cached."""
+        with self._lock:
+            self._write(list(self._cache))
+
+    def close(self):
+        """Write everything cached and close the file."""
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self._write(list(self._cache))
+            finally:
+                self.closed = True
+                os.close(self._fd)
+
+    @property
+    def cached_bytes(self):
+        return self._cached_bytes
+
+    def stats(self):
+        return {
+            'cached_bytes': self._cached_bytes,
+            'stored_pieces': len(self._stored),
+            'writes': self.writes,
+            'written_bytes': self.written_bytes,
+        }
+
+    def _piece_size(self, index):
+        if not 0 <= index < self.num_pieces:
+            raise StorageError('No Piece With That Index | {}'.format(index))
+        return min(self.piece_length, self.length - index * self.piece_length)
+
+    def _extent_pieces(self, extent):
+        start = extent * self.extent_size
+        end = min(start + self.extent_size, self.length)
+        return range(start // self.piece_length, (end - 1) // self.piece_length + 1)
+
+    def _expired(self):
+        oldest = next(iter(self._arrived.values()), None)
+        return oldest is not None and self._clock() - oldest >= self.flush_interval
+
+    def _write(self, indexes):
+        """Write cached pieces, joining neighbours into single writes. Call
+        with the lock held."""
+        indexes = sorted(indexes)
+        if not indexes:
+            return
+
+        runs = [[indexes[0]]]
+        for index in indexes[1:]:
+            if index == runs[-1][-1] + 1:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+
+        try:
+            ranges = [self._write_run(run) for run in runs]
+            if self.fsync:
+                os.fsync(self._fd)
+            if self.fadvise:
+                # Only pages that have been written back can be dropped.
+                for offset, length in ranges:
+                    os.posix_fadvise(self._fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            raise StorageError('Could Not Write Target File | {} | {}'.format(self.path, e))
+
+    def _write_run(self, run):
+        offset = run[0] * self.piece_length
+        data = memoryview(b''.join(self._cache[index] for index in run))
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self._fd, data[written:], offset + written)
+
+        for index in run:
+            del self._cache[index]
+            del self._arrived[index]
+        self._cached_bytes -= len(data)
+        self.writes += 1
+        self.written_bytes += len(data)
+        return offset, len(data)
+
+
+class ReadCache:
+    """Whole pieces read back from a Storage to answer peers' block
+    requests, so the blocks of a piece wanted by several peers are read from
+    disk once.
+
+    Pieces are evicted least recently used first once the cache holds more
+    than max_bytes. A miss on the piece after one already cached looks like
+    a sequential read, so the next read_ahead stored pieces are read with it
+    in the same call.
+    """
+    def __init__(self, storage, max_bytes=constants.READ_CACHE_SIZE, read_ahead=constants.READ_AHEAD_PIECES):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.read_ahead = read_ahead
+        self._pieces = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.read_ahead_pieces = 0
+        self.evictions = 0
+
+    def read_block(self, index, offset, length):
+        """Return the bytes of a block of a stored piece.
+
+        Raises:
+            StorageError if the storage is closed, the piece is not stored or
+            the block is not in it.
+        """
+        if self.storage.closed:
+            raise StorageError('Storage Is Closed')
+        if not self.storage.has_piece(index) or offset + length > self.storage.piece_size(index):
+            raise StorageError('No Such Block | {} {} {}'.format(index, offset, length))
+
+        with self._lock:
+            data = self._pieces.get(index)
+            if data is not None:
+                self._pieces.move_to_end(index)
+                self.hits += 1
+                return data[offset:offset + length]
+            self.misses += 1
+            sequential = index - 1 in self._pieces
+
+        count = 1
+        if sequential:
+            while (count <= self.read_ahead and self.storage.has_piece(index + count)
+                   and index + count not in self._pieces):
+                count += 1
+        pieces = self.storage.read_pieces(index, count)
+
+        with self._lock:
+            self.read_ahead_pieces += count - 1
+            # The piece asked for goes in last, as the most recently used.
+            for i in list(range(1, count)) + [0]:
+                if index + i not in self._pieces:
+                    self._pieces[index + i] = pieces[i]
+                    self._bytes += len(pieces[i])
+            while self._bytes > self.max_bytes and len(self._pieces) > 1:
+                _, evicted = self._pieces.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+        return pieces[0][offset:offset + length]
+
+    @property
+    def hit_ratio(self):
+        reads = self.hits + self.misses
+        return self.hits / reads if reads else 0.0
+
+    def stats(self):
+        return {
+            'cached_bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+            'read_ahead_pieces': self.read_ahead_pieces,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,93 @@
+import time
+from math import ceil
+from threading import Lock
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+import constants
+
+"""A hashed timer wheel, for the many coarse timers that peer connections
+need (keep-alives, request timeouts) without a reactor DelayedCall each."""
+
+
+class Timer:
+    __slots__ = ('deadline', 'rounds', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, rounds, callback, args):
+        self.deadline = deadline
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Timers are hashed into slots by the tick they expire on. Each tick
+    only the current slot is looked at, so scheduling, cancelling and
+    expiring timers are all constant time however many there are. Timers
+    fire up to one tick late.
+
+    The wheel is advanced by a LoopingCall on the reactor, so callbacks run on
+    the reactor thread. Timers may be scheduled from any thread.
+    """
+    def __init__(self, tick=constants.TIMER_WHEEL_TICK, slots=constants.TIMER_WHEEL_SLOTS,
+                 clock=time.monotonic):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._clock = clock
+        self._lock = Lock()
+        self._current = 0
+        self._last_tick = clock()
+        self._loop = None
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds. Returns a Timer which
+        can be cancelled."""
+        with self._lock:
+            deadline = self._clock() + delay
+            # Round up so a timer never fires early.
+            ticks = max(1, ceil((deadline - self._last_tick) / self.tick))
+            # The slot is passed once per turn of the wheel before the timer is due.
+            rounds = (ticks - 1) // len(self._slots)
+            timer = Timer(deadline, rounds, callback, args)
+            self._slots[(self._current + ticks) % len(self._slots)].append(timer)
+        return timer
+
+    def advance(self):
+        """Move the wheel forward to the current time, firing every timer
+        that has expired along the way."""
+        now = self._clock()
+        while now - self._last_tick >= self.tick:
+            with self._lock:
+                self._last_tick += self.tick
+                self._current = (self._current + 1) % len(self._slots)
+                slot = self._slots[self._current]
+                expired = [timer for timer in slot if timer.rounds == 0]
+                remaining = []
+                for timer in slot:
+                    if timer.rounds and not timer.cancelled:
+                        timer.rounds -= 1
+                        remaining.append(timer)
+                self._slots[self._current] = remaining
+            for timer in expired:
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+    def start(self):
+        """Start advancing the wheel on the reactor. Safe to call from any
+        thread, and more than once."""
+        if self._loop is None:
+            self._loop = LoopingCall(self.advance)
+            reactor.callFromThread(self._loop.start, self.tick, False)
+
+    def stop(self):
+        if self._loop is not None:
+            loop, self._loop = self._loop, None
+            reactor.callFromThread(lambda: loop.running and loop.stop())
+
+    def __len__(self):
+        return sum(1 for slot in self._slots for timer in slot if not timer.cancelled)
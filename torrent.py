@@ -1,10 +1,12 @@
 import os
-from hashlib import sha1
+from hashlib import sha1, sha256
 
-from bencode3 import bdecode, bencode
+from merkle import PieceLayers, MerkleError, BLOCK_LENGTH
 
 """Handle data related to a torrent and its torrent file"""
 
+HASH_LENGTH = 20
+
 
 class TorrentError(Exception):
     pass
@@ -12,11 +14,57 @@ class TorrentError(Exception):
 
 class Torrent:
     """Hold information coming from a torrent file."""
-    def __init__(self, tor_file_path):
+    def __init__(self, tor_file_path, cache=None):
+        """
+        Args:
+            tor_file_path: path to the .torrent file.
+            cache: optional MetainfoCache. When the file has a valid entry
+                the metadata is loaded from it and the file is not parsed.
+                The raw info dictionary is only available (as self.info) when
+                the file was actually parsed.
+        """
         self.path = tor_file_path
         self.file_name = os.path.basename(tor_file_path)
         self.name = os.path.splitext(self.file_name)[0]
-        self._handle_file(self.path)
+        self.info = None
+        # Set for v2 and hybrid torrents (BEP 52), whose pieces are verified
+        # against merkle trees. v2 only torrents have no piece_hashes.
+        self.meta_version = 1
+        self.info_hash_v2 = None
+        self.piece_layers = None
+
+        try:
+            stat = os.stat(tor_file_path)
+        except FileNotFoundError:
+            raise TorrentError("No Torrent File With That Name.")
+
+        entry = cache.get(tor_file_path, stat) if cache is not None else None
+        if entry:
+            try:
+                self._handle_cache_entry(entry)
+            except (TorrentError, MerkleError):
+                # A damaged entry is thrown away, and the file parsed instead.
+                cache.invalidate(tor_file_path)
+                self.info_hash_v2 = self.piece_layers = None
+                entry = None
+        if not entry:
+            self._handle_file(self.path)
+            if cache is not None:
+                cache.put(tor_file_path, self, stat)
+
+    def _handle_cache_entry(self, entry):
+        self.info_hash = entry['info_hash']
+        self.announce = entry['announce']
+        self.length = entry['length']
+        self.piece_length = entry['piece_length']
+        self.target_file_name = entry['target_file_name']
+        self.files = entry['files']
+        self.piece_hashes = PieceHashes(entry['pieces']) if entry['pieces'] is not None else None
+        self.meta_version = entry['meta_version']
+        if self.meta_version == 2:
+            self.info_hash_v2 = entry['info_hash_v2']
+            self.piece_layers = PieceLayers(entry['merkle_files'], entry['piece_layers'], self.piece_length)
+        self.num_pieces = len(self.piece_layers if self.piece_hashes is None else self.piece_hashes)
 
     def _handle_file(self, tor_file_path):
         try:
@@ -25,23 +73,221 @@ class Torrent:
         except FileNotFoundError:
             raise TorrentError("No Torrent File With That Name.")
 
-        metadict = bdecode(metainfo)
-        self.info = metadict['info']
-        self.info_hash = self._hash_info(self.info)
-        self.announce = metadict['announce']
-        self.length = self.info['length']
-        self.piece_length = self.info['piece length']
-        self.target_file_name = self.info['name']
-        # The pieces entry consists of 20 byte hash values for each pieces.
-        self.num_pieces = len(self.info['pieces'])//20
-        self.piece_hashes = []
-        hashes = self.info['pieces']
-        while hashes:
-            self.piece_hashes.append(hashes[:20])
-            hashes = hashes[20:]
-
-    @staticmethod
-    def _hash_info(info):
-        info_bencode = bencode(info)
-        info_hash = sha1(info_bencode).digest()
-        return info_hash
+        try:
+            metadict, info_start, info_end = _decode_metainfo(metainfo)
+            self.info = metadict['info']
+            self.announce = _text(metadict['announce'])
+            self.piece_length = self.info['piece length']
+            self.target_file_name = _text(self.info['name'])
+            self.meta_version = self.info.get('meta version', 1)
+            if self.meta_version == 2:
+                merkle_files = _merkle_spans(self.info, self.piece_length)
+                self.piece_layers = PieceLayers(merkle_files, _piece_layers(metadict), self.piece_length)
+            pieces = self.info.get('pieces')
+            if pieces is None:
+                if self.piece_layers is None:
+                    raise KeyError('pieces')
+                self.files = [(path, offset, length) for path, offset, length, _ in merkle_files]
+                self.length = max(offset + length for _, offset, length in self.files) if self.files else 0
+            else:
+                self.files = _file_spans(self.info)
+                self.length = sum(length for _, _, length in self.files)
+        except (ValueError, IndexError, KeyError, TypeError):
+            raise TorrentError("Malformed Torrent File.")
+        except MerkleError as e:
+            raise TorrentError("Bad Piece Layers | {}".format(e))
+
+        # The info hash is taken over the exact bytes of the info value in the
+        # file, so we never have to bencode the dictionary back up.
+        info = memoryview(metainfo)[info_start:info_end]
+        if self.meta_version == 2:
+            self.info_hash_v2 = sha256(info).digest()
+        if pieces is None:
+            # v2 only swarms use the v2 info hash, truncated, on the wire.
+            self.info_hash = self.info_hash_v2[:HASH_LENGTH]
+            self.piece_hashes = None
+            self.num_pieces = len(self.piece_layers)
+        else:
+            self.info_hash = sha1(info).digest()
+            self.piece_hashes = PieceHashes(pieces)
+            self.num_pieces = len(self.piece_hashes)
+            if self.piece_layers is not None and not _layouts_agree(self.files, self.piece_layers):
+                raise TorrentError("Hybrid Torrent v1 and v2 Layouts Differ.")
+
+
+class PieceHashes:
+    """A read-only view of the 20 byte SHA1 piece hashes, indexed by
+    piece number.
+
+    The view shares memory with the torrent file contents, so looking up
+    a hash never copies the (potentially very large) pieces string.
+    """
+    def __init__(self, blob):
+        if len(blob) % HASH_LENGTH:
+            raise TorrentError("Pieces Entry Is Not a Multiple of {} Bytes.".format(HASH_LENGTH))
+        self.blob = memoryview(blob)
+
+    def __len__(self):
+        return len(self.blob) // HASH_LENGTH
+
+    def __getitem__(self, index):
+        count = len(self)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError('Piece Index Out of Range | {}'.format(index))
+        start = index * HASH_LENGTH
+        return self.blob[start:start + HASH_LENGTH]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def _file_spans(info):
+    """Lay the torrent's files out end to end.
+
+    Returns:
+        A list of (path, offset, length) tuples, where offset is the
+        position of the file's first byte within the torrent's data.
+    """
+    name = _text(info['name'])
+    if 'files' not in info:
+        return [(name, 0, info['length'])]
+
+    spans = []
+    offset = 0
+    for file_entry in info['files']:
+        path = os.path.join(name, *[_text(part) for part in file_entry['path']])
+        spans.append((path, offset, file_entry['length']))
+        offset += file_entry['length']
+    return spans
+
+
+def _merkle_spans(info, piece_length):
+    """Lay out the files of a v2 file tree, each starting on a piece
+    boundary.
+
+    Returns:
+        A list of (path, offset, length, pieces root) tuples. pieces root is
+        None for empty files.
+    """
+    if piece_length < BLOCK_LENGTH or piece_length & (piece_length - 1):
+        raise ValueError('v2 Piece Length Must Be a Power of Two of at Least 16 KiB')
+    name = _text(info['name'])
+    tree = info['file tree']
+    spans = []
+    offset = 0
+
+    def walk(node, parts):
+        nonlocal offset
+        for key, child in node.items():
+            if key == '':
+                length = child['length']
+                root = child.get('pieces root') if length else None
+                if length and len(root) != 32:
+                    raise ValueError('Bad Pieces Root')
+                # A single file torrent's tree holds just the file, named for the torrent.
+                path = os.path.join(name, *parts) if parts != [name] or len(tree) > 1 else name
+                spans.append((path, offset, length, root))
+                offset += -(-length // piece_length) * piece_length
+            else:
+                walk(child, parts + [key])
+
+    walk(tree, [])
+    return spans
+
+
+def _layouts_agree(files, piece_layers):
+    """Whether each file of a hybrid torrent's v2 layout sits at the same
+    place in its v1 layout, which holds pad files to line them up."""
+    v1 = {(offset, length) for _, offset, length in files}
+    return all((offset, length) in v1 for _, offset, length, _ in piece_layers.files)
+
+
+def _decode_metainfo(metainfo):
+    """Decode a torrent file and locate its info dictionary.
+
+    Strings are returned as memoryview slices into the file contents rather
+    than copies. Dictionary keys are decoded to str where they can be.
+
+    Returns:
+        A tuple of the decoded top level dictionary and the start and
+        end offsets of the bencoded info value within the file.
+    """
+    view = memoryview(metainfo)
+    if metainfo[:1] != b'd':
+        raise ValueError('Torrent File Is Not a Dictionary')
+
+    metadict = {}
+    info_start = info_end = None
+    i = 1
+    while metainfo[i] != 0x65:  # 'e'
+        key, i = _decode_string(metainfo, view, i)
+        key = bytes(key).decode('utf-8')
+        start = i
+        metadict[key], i = _decode(metainfo, view, i)
+        if key == 'info':
+            info_start, info_end = start, i
+
+    if info_start is None:
+        raise KeyError('info')
+    return metadict, info_start, info_end
+
+
+def _decode(data, view, i):
+    """Decode the bencoded value at index i. Returns the value and the
+    index just past it."""
+    lead = data[i]
+    if lead == 0x69:  # 'i'
+        end = data.index(b'e', i)
+        return int(data[i + 1:end]), end + 1
+    elif lead == 0x6c:  # 'l'
+        values = []
+        i += 1
+        while data[i] != 0x65:
+            value, i = _decode(data, view, i)
+            values.append(value)
+        return values, i + 1
+    elif lead == 0x64:  # 'd'
+        values = {}
+        i += 1
+        while data[i] != 0x65:
+            key, i = _decode_string(data, view, i)
+            values[_key(key)], i = _decode(data, view, i)
+        return values, i + 1
+    else:
+        return _decode_string(data, view, i)
+
+
+def _decode_string(data, view, i):
+    colon = data.index(b':', i)
+    length = data[i:colon]
+    # int() would take a sign, and a negative length would send the
+    # decoder backwards.
+    if not length.isdigit() or (length[0] == 0x30 and len(length) > 1):
+        raise ValueError('Bad String Length')
+    start = colon + 1
+    end = start + int(length)
+    if end > len(data):
+        raise ValueError('String Runs Past End of File')
+    return view[start:end], end
+
+
+def _key(value):
+    """Decode a dictionary key to str. The keys of 'piece layers' are
+    hashes, which are left as bytes unless they happen to be valid UTF-8."""
+    try:
+        return bytes(value).decode('utf-8')
+    except UnicodeDecodeError:
+        return bytes(value)
+
+
+def _piece_layers(metadict):
+    """The 'piece layers' of a v2 torrent, keyed by pieces root bytes."""
+    layers = metadict.get('piece layers', {})
+    return {key.encode('utf-8') if isinstance(key, str) else key: layer for key, layer in layers.items()}
+
+
+def _text(value):
+    return bytes(value).decode('utf-8')
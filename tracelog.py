@@ -0,0 +1,184 @@
+import os
+import time
+from queue import Queue
+from struct import pack, unpack, calcsize, unpack_from, error as StructError
+from threading import Thread, Lock
+
+from message import MessageType
+
+"""Record a compact binary trace of the messages passed over a peer
+connection, for offline analysis and replay (see replay.py).
+
+A trace file is a header followed by one record per message:
+
+    header: <4-byte magic><1-byte version><20-byte info hash><20-byte peer id>
+            <2-byte ip length><ip><2-byte port>
+    record: <8-byte timestamp><1-byte direction><1-byte signed type id>
+            <4-byte index><4-byte offset><4-byte length>[<bitfield>]
+
+No payload bytes are kept, with one exception: a BITFIELD record is followed
+by the bitfield itself (length bytes), since a replay cannot decide what to
+request without it. For PIECE, REQUEST, CANCEL and REJECT messages index,
+offset and length describe the block; for HAVE, SUGGEST and ALLOWED_FAST,
+index is the piece; otherwise length is the payload length.
+"""
+
+MAGIC = b'DDTR'
+VERSION = 1
+INBOUND = 0
+OUTBOUND = 1
+RECORD = '!dBbIII'
+RECORD_SIZE = calcsize(RECORD)
+TRACE_SUFFIX = '.ddtrace'
+
+_BLOCK_TYPES = frozenset((MessageType.REQUEST, MessageType.CANCEL, MessageType.REJECT))
+_PIECE_INDEX_TYPES = frozenset((MessageType.HAVE, MessageType.SUGGEST, MessageType.ALLOWED_FAST))
+
+
+class TraceError(Exception):
+    pass
+
+
+class TraceWriter:
+    """Buffers trace records for one connection and hands full buffers to
+    a background thread to be written, so recording a message never waits on
+    the disk. Safe to record from several threads."""
+    def __init__(self, path, info_hash, peer_id, ip, port, buffer_size=2 ** 16):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._file = open(path, 'wb')
+        self._lock = Lock()
+        self._closed = False
+        ip_bytes = ip.encode('ascii')
+        peer_id_bytes = _peer_id_bytes(peer_id)
+        self._buffer = bytearray(MAGIC + bytes([VERSION]) + info_hash + peer_id_bytes +
+                                 pack('!H', len(ip_bytes)) + ip_bytes + pack('!H', port))
+
+    @classmethod
+    def for_peer(cls, directory, peer):
+        """Open a trace in directory for a peer's connection."""
+        os.makedirs(directory, exist_ok=True)
+        name = '{}_{}_{}{}'.format(peer.ip, peer.port, int(time.time() * 1000), TRACE_SUFFIX)
+        return cls(os.path.join(directory, name), peer.info_hash, peer.peer_id, peer.ip, peer.port)
+
+    def record(self, direction, message):
+        message_type = message.type
+        index = offset = 0
+        payload = message.payload
+        length = len(payload) if payload else 0
+        extra = b''
+
+        if message_type is MessageType.PIECE:
+            index, offset = message.index, message.offset
+        elif message_type in _BLOCK_TYPES:
+            index, offset, length = unpack('!III', payload)
+        elif message_type in _PIECE_INDEX_TYPES:
+            index = unpack('!I', payload)[0]
+        elif message_type is MessageType.BITFIELD:
+            extra = payload
+
+        with self._lock:
+            if self._closed:
+                return
+            self._buffer += pack(RECORD, time.time(), direction, message_type.value, index, offset, length)
+            self._buffer += extra
+            if len(self._buffer) >= self.buffer_size:
+                self._hand_off()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._hand_off()
+            _flusher().put((self._file, None))
+
+    def _hand_off(self):
+        if self._buffer:
+            _flusher().put((self._file, bytes(self._buffer)))
+            self._buffer = bytearray()
+
+
+_flush_queue = None
+_flush_lock = Lock()
+
+
+def _flusher():
+    """Return the queue of the thread which writes trace buffers out,
+    starting it on first use."""
+    global _flush_queue
+    with _flush_lock:
+        if _flush_queue is None:
+            _flush_queue = Queue()
+            Thread(target=_flush_worker, args=(_flush_queue,), daemon=True).start()
+    return _flush_queue
+
+
+def _flush_worker(queue):
+    while True:
+        trace_file, data = queue.get()
+        try:
+            if data is None:
+                trace_file.close()
+            else:
+                trace_file.write(data)
+        except (OSError, ValueError) as e:
+            print('Trace Write Failed:', e)
+        finally:
+            queue.task_done()
+
+
+def flush_traces():
+    """Wait until every buffer handed off so far has been written."""
+    if _flush_queue is not None:
+        _flush_queue.join()
+
+
+def read_trace(path):
+    """Read a trace file.
+
+    Returns:
+        A tuple of the header dictionary (info_hash, peer_id, ip, port) and
+        a list of records, each a tuple of (timestamp, direction, message
+        type, index, offset, length, bitfield or None).
+    """
+    with open(path, 'rb') as trace_file:
+        data = trace_file.read()
+
+    try:
+        if data[:len(MAGIC)] != MAGIC or data[len(MAGIC)] != VERSION:
+            raise TraceError('Not a Version {} Trace | {}'.format(VERSION, path))
+        i = len(MAGIC) + 1
+        info_hash = data[i:i + 20]
+        peer_id = data[i + 20:i + 40]
+        i += 40
+        ip_length = unpack_from('!H', data, i)[0]
+        ip = data[i + 2:i + 2 + ip_length].decode('ascii')
+        i += 2 + ip_length
+        port = unpack_from('!H', data, i)[0]
+        i += 2
+
+        types = {message_type.value: message_type for message_type in MessageType}
+        records = []
+        while i + RECORD_SIZE <= len(data):
+            timestamp, direction, type_id, index, offset, length = unpack_from(RECORD, data, i)
+            i += RECORD_SIZE
+            message_type = types[type_id]
+            bitfield = None
+            if message_type is MessageType.BITFIELD:
+                bitfield = data[i:i + length]
+                i += length
+            records.append((timestamp, direction, message_type, index, offset, length, bitfield))
+    except (IndexError, KeyError, UnicodeDecodeError, StructError) as e:
+        raise TraceError('Malformed Trace | {} | {}'.format(path, e))
+
+    header = {'info_hash': info_hash, 'peer_id': peer_id.decode('utf-8', 'replace'), 'ip': ip, 'port': port}
+    return header, records
+
+
+def _peer_id_bytes(peer_id):
+    if peer_id is None:
+        return bytes(20)
+    if isinstance(peer_id, str):
+        peer_id = peer_id.encode('utf-8', 'replace')
+    return peer_id[:20].ljust(20, b'\x00')
@@ -2,15 +2,20 @@ from enum import Enum
 from struct import unpack
 
 import requests
-from bencode3 import bdecode, bencode
+from bencode3 import bdecode, bencode, BencodeError
 
 import constants
 
 
+class TrackerError(Exception):
+    pass
+
+
 class TrackerEvent(Enum):
     STARTED = 'started'
     STOPPED = 'stopped'
     COMPLETED = 'completed'
+    NONE = ''  # A regular announce, asking for more peers
     
     
 class Tracker:
@@ -31,16 +36,20 @@ class Tracker:
             port: port number that the client is listening on.
         Returns:
             A decoded dictionary of the response.
+        Raises:
+            TrackerError if the tracker can't be reached or its response
+            can't be read.
         """
         if event == TrackerEvent.STARTED:
             left = 0
         else:
             left = 0
         params = self._prepare_params(event, peer_id, port, left)
-        r = requests.get(self.announce, params=params)
-
-        handled_response = self._handle_response(r.content)
-        return handled_response
+        try:
+            r = requests.get(self.announce, params=params)
+            return self._handle_response(r.content)
+        except (requests.RequestException, BencodeError, ValueError, KeyError, TypeError) as e:
+            raise TrackerError('Announce Failed | {} | {}'.format(self.announce, e))
     
     def _prepare_params(self, event, peer_id, port, left):
         """Organize params for HTTP Tracker request
@@ -52,10 +61,11 @@ class Tracker:
         params = {
             'info_hash': self.info_hash,
             'peer_id': peer_id,
-            'event': event.value,
             'port': port,
             'left': left
         }
+        if event.value:
+            params['event'] = event.value
 
         return params
 